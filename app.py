@@ -9,10 +9,10 @@ import json
 from datetime import datetime
 import csv
 import time
-from extractor.pdf_reader import extract_text_from_pdf, structure_data_with_llm
-from generator.pdf_generator import generate_pdf
-from streamlit_gsheets import GSheetsConnection
-import pandas as pd
+from jobs.job_queue import JobQueue, DONE, FAILED
+from monitoring.metrics import get_registry
+# pandas, la connexion Google Sheets, l'extraction et la génération PDF sont importés à la
+# demande (voir plus bas) : la porte d'entrée s'affiche sans attendre tout le graphe d'imports.
 
 
 # --- Configuration de la Page ---
@@ -45,79 +45,123 @@ def initialize_state():
 
 initialize_state()
 
+@st.cache_resource
+def get_lead_store():
+    """Registre local des leads, partagé par toutes les sessions du serveur."""
+    from streamlit_gsheets import GSheetsConnection
+    from leads.lead_store import GSheetsBackend, LeadStore
+
+    conn = st.connection("gsheets", type=GSheetsConnection)
+    return LeadStore(GSheetsBackend(conn, worksheet="Feuille1"))
+
+@st.cache_resource
+def get_job_queue():
+    """File des analyses en arrière-plan, partagée par toutes les sessions du serveur."""
+    return JobQueue()
+
+def read_secret(name):
+    """Secret Streamlit, ou variable d'environnement en l'absence de fichier de secrets."""
+    try:
+        return st.secrets[name]
+    except (FileNotFoundError, KeyError):
+        return os.environ.get(name)
+
 def update_or_create_lead_gsheets(name, email, profession):
     """
-    Crée ou met à jour un lead dans le Google Sheet en utilisant Pandas
-    pour une robustesse maximale.
+    Crée ou met à jour un lead. La recherche se fait dans l'index local (DuckDB) ;
+    la feuille Google Sheets est mise à jour en arrière-plan, par lots.
     """
     try:
         with st.spinner("Vérification de votre accès..."):
-            conn = st.connection("gsheets", type=GSheetsConnection)
-            
-            # On lit la feuille existante
-            worksheet_df = conn.read(worksheet="Feuille1", use_headers=True, ttl=5).dropna(how="all")
-            # On s'assure que la colonne email est bien de type string pour la comparaison
-            worksheet_df['email'] = worksheet_df['email'].astype(str)
-
-            # On cherche si l'email existe
-            existing_rows = worksheet_df[worksheet_df['email'] == email]
-
-            if not existing_rows.empty:
-                # --- LOGIQUE DE MISE À JOUR ---
-                print(f"UTILISATEUR EXISTANT : {email}.")
-                index = existing_rows.index[0]
-                
-                updated_fields = []
-                if name and worksheet_df.loc[index, 'prenom'] != name:
-                    worksheet_df.loc[index, 'prenom'] = name
-                    updated_fields.append("prénom")
-                if profession and worksheet_df.loc[index, 'metier'] != profession:
-                    worksheet_df.loc[index, 'metier'] = profession
-                
-                # C'est ici qu'on sauvegarde le DataFrame COMPLET mis à jour
-                conn.update(worksheet="Feuille1", data=worksheet_df)
-
-                if updated_fields:
-                    st.toast(f"Informations mises à jour : {', '.join(updated_fields)}.", icon="👍")
-                else:
-                    st.toast("Accès accordé. Bienvenue à nouveau !", icon="👋")
-                st.balloons()
+            created, updated_fields = get_lead_store().upsert(name, email, profession)
 
+        if not created:
+            print(f"UTILISATEUR EXISTANT : {email}.")
+            if updated_fields:
+                st.toast(f"Informations mises à jour : {', '.join(updated_fields)}.", icon="👍")
             else:
-                # --- LOGIQUE DE CRÉATION - LA CORRECTION EST ICI ---
-                print(f"NOUVEL INSCRIT : {email}")
-                
-                # On crée un DataFrame pour la nouvelle ligne
-                new_lead_df = pd.DataFrame([{
-                    'prenom': name,
-                    'email': email,
-                    'metier': profession,
-                    'date_inscription': datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-                }])
-                
-                # On combine l'ancien DataFrame avec le nouveau
-                # C'est la méthode la plus sûre pour ajouter une ligne
-                df_to_write = pd.concat([worksheet_df, new_lead_df], ignore_index=True)
-                
-                # On écrit le DataFrame COMPLET (l'ancien + le nouveau) dans la feuille
-                conn.update(worksheet="Feuille1", data=df_to_write)
-                
-                st.toast("Merci ! Vous êtes maintenant inscrit à la bêta.", icon="✅")
-                st.balloons()
-
+                st.toast("Accès accordé. Bienvenue à nouveau !", icon="👋")
+        else:
+            print(f"NOUVEL INSCRIT : {email}")
+            st.toast("Merci ! Vous êtes maintenant inscrit à la bêta.", icon="✅")
+        st.balloons()
         return True
 
     except Exception as e:
-        print(f"ERREUR GOOGLE SHEETS: {e}")
+        print(f"ERREUR LEADS: {e}")
         st.error("Une erreur est survenue lors de la sauvegarde. Veuillez réessayer.")
         return False
 
+def show_metrics_panel():
+    """Panneau de débogage (URL avec ?debug=1) : durées par étape et dernières mesures."""
+    if st.query_params.get("debug") != "1" and not os.environ.get("MICROFLOW_DEBUG"):
+        return
+    registry = get_registry()
+    with st.sidebar.expander("⏱️ Mesures par étape", expanded=True):
+        summary = registry.summary()
+        if not summary:
+            st.caption("Aucune mesure pour l'instant.")
+            return
+        st.dataframe(pd.DataFrame(summary), hide_index=True)
+        st.caption("Dernières étapes")
+        st.dataframe(pd.DataFrame(registry.recent_spans()[-20:][::-1]), hide_index=True)
+        st.download_button("Export Prometheus", registry.render_prometheus(), file_name="metrics.prom", mime="text/plain")
+
+def quote_views():
+    """Vues (tableaux, totaux) des devis de la session, mémorisées entre les réexécutions."""
+    if "quote_views" not in st.session_state:
+        st.session_state.quote_views = QuoteViewCache()
+    return st.session_state.quote_views
+
+def show_quote_table(view, key):
+    """Tableau des lignes du devis : complet s'il est court, paginé sinon."""
+    if view.page_count == 1:
+        st.table(view.display)
+        return
+    page = st.number_input(f"Page (sur {view.page_count})", min_value=1, max_value=view.page_count, value=1, key=key)
+    st.table(view.page(page))
+    first = (page - 1) * view.page_size + 1
+    st.caption(f"Lignes {first} à {min(first + view.page_size - 1, view.row_count)} sur {view.row_count}")
+
+def forget_job():
+    """Détache la session de sa tâche d'analyse (la tâche elle-même n'est pas interrompue)."""
+    st.session_state.job_id = None
+    st.session_state.submitted_file_key = None
+    if "job" in st.query_params:
+        del st.query_params["job"]
+
+@st.fragment(run_every=1.0)
+def show_job_progress():
+    """Suivi de la tâche d'analyse, rafraîchi chaque seconde sans relancer tout le script."""
+    job = get_job_queue().get(st.session_state.get("job_id"))
+    if job is None:
+        forget_job()
+        st.rerun()
+    if job.status == DONE:
+        st.session_state.raw_data = job.result
+        st.session_state.step = "edit"
+        st.session_state.processed_file_name = st.session_state.get("uploaded_file_name")
+        forget_job()
+        st.rerun()
+    if job.status == FAILED:
+        st.error(job.error)
+        if st.button("Réessayer"):
+            forget_job()
+            st.rerun()
+        return
+    st.progress(job.progress, text=job.message)
+    if job.lines:
+        # Le tableau se remplit ligne par ligne pendant l'analyse
+        st.dataframe(pd.DataFrame(list(job.lines)), hide_index=True)
+
 def restart_process():
     """Réinitialise tout le processus pour un nouveau devis."""
     st.session_state.step = "upload"
     st.session_state.raw_data = None
     st.session_state.final_quote_data = None
     st.session_state.processed_file_name = None
+    forget_job()
+    st.session_state.pop("file_uploader", None)  # Vide le champ d'import
     # Pas besoin de st.rerun() ici, le bouton qui l'appelle le fera.
 
 # =======================================================
@@ -161,6 +205,16 @@ if not st.session_state.access_granted:
 # APPLICATION PRINCIPALE
 # =======================================================
 else:
+    # Modules lourds chargés une seule fois par processus, au premier affichage de l'outil
+    import pandas as pd
+    from extractor.pdf_reader import configure
+    from jobs.quote_analysis import analysis_key, analyze_quote
+    from pricing.adjustments import apply_adjustments
+    from ui.quote_views import QuoteViewCache
+
+    if not configure(hf_token=read_secret("HUGGINGFACE_API_KEY")):
+        st.error("ERREUR DE CONFIGURATION : Clé API Hugging Face non trouvée.")
+
     # --- Conteneur Principal ---
     main_placeholder = st.container()
 
@@ -178,23 +232,22 @@ else:
             )
         st.info("Importez un fichier PDF de devis fournisseur. L'IA va analyser et structurer les données automatiquement.")
 
+        # Une actualisation de la page retrouve l'analyse en cours grâce à l'URL (?job=...)
+        if not st.session_state.get("job_id") and get_job_queue().get(st.query_params.get("job")):
+            st.session_state.job_id = st.query_params["job"]
+
         if uploaded_file is not None:
-            with st.spinner("Analyse du PDF par l'IA... (cela peut prendre jusqu'à 30 secondes, merci de patienter)"):
-                temp_dir = "temp_data"; os.makedirs(temp_dir, exist_ok=True)
-                temp_pdf_path = os.path.join(temp_dir, uploaded_file.name)
-                with open(temp_pdf_path, "wb") as f: f.write(uploaded_file.getbuffer())
-                
-                raw_text = extract_text_from_pdf(temp_pdf_path)
-                if raw_text:
-                    structured_data = structure_data_with_llm(raw_text)
-                    if structured_data:
-                        st.session_state.raw_data = structured_data
-                        st.session_state.step = "edit"
-                        st.session_state.processed_file_name = uploaded_file.name
-                        st.rerun()
-                    else: st.error("L'IA n'a pas pu structurer les données. Veuillez réessayer avec un autre document.")
-                else: st.error("Impossible d'extraire le texte de ce PDF.")
-                os.remove(temp_pdf_path)
+            # L'analyse tourne en arrière-plan : le même fichier n'est jamais analysé deux fois en parallèle
+            file_bytes = uploaded_file.getvalue()
+            file_key = analysis_key(file_bytes)
+            if st.session_state.get("submitted_file_key") != file_key:
+                st.session_state.job_id = get_job_queue().submit(file_key, analyze_quote, file_bytes)
+                st.session_state.submitted_file_key = file_key
+                st.session_state.uploaded_file_name = uploaded_file.name
+                st.query_params["job"] = st.session_state.job_id
+
+        if st.session_state.get("job_id"):
+            show_job_progress()
 
     # ==================== ÉTAPE 2 : AJUSTEMENTS ====================
     elif st.session_state.step == "edit":
@@ -203,8 +256,22 @@ else:
             st.header("2. Appliquez vos ajustements")
 
             st.info("Voici les données extraites. Vous pouvez maintenant appliquer votre marge et ajouter votre main d'œuvre.")
-            df_raw = pd.DataFrame(st.session_state.raw_data.get('lignes_articles', []))
-            st.table(df_raw.style.format(na_rep="-", formatter={"prix_unitaire_ht": "{:.2f} €", "total_ligne_ht": "{:.2f} €"}))
+            if st.session_state.raw_data.get('_morceaux_en_erreur'):
+                st.warning("Certaines pages n'ont pas pu être analysées : vérifiez les lignes extraites.")
+            if st.session_state.raw_data.get('_flux_interrompu'):
+                st.warning("La réponse de l'IA a été interrompue : seules les lignes déjà reçues sont affichées.")
+            validation = st.session_state.raw_data.get('_validation') or {}
+            if validation.get('corrections'):
+                with st.expander(f"{len({c['ligne'] for c in validation['corrections']})} ligne(s) corrigée(s) automatiquement (montants incohérents)"):
+                    st.table(pd.DataFrame(validation['corrections']).assign(ligne=lambda d: d['ligne'] + 1))
+            if validation.get('lignes_a_verifier'):
+                numeros = ", ".join(str(i + 1) for i in validation['lignes_a_verifier'])
+                st.warning(f"Quantité x prix unitaire ne correspond pas au total sur la/les ligne(s) {numeros} : vérifiez-les.")
+            if validation.get('lignes_ignorees'):
+                st.warning(f"{validation['lignes_ignorees']} ligne(s) mal formée(s) renvoyée(s) par l'IA ont été ignorées.")
+            if validation and not validation.get('total_ht_coherent'):
+                st.warning("Le total HT du devis ne correspond pas à la somme des lignes extraites.")
+            show_quote_table(quote_views().get(st.session_state.raw_data), key="raw_table_page")
 
         st.markdown("---")
 
@@ -216,38 +283,18 @@ else:
             mo_hours = st.number_input("Quantité (heures)", min_value=0.0, step=0.5, value=8.0)
             mo_rate = st.number_input("Taux horaire (€/h)", min_value=0.0, step=5.0, value=50.0)
             
-            submitted = st.form_submit_button("Calculer et Prévisualiser le Devis Final (cliquez 2 fois si besoin)")
+            submitted = st.form_submit_button("Calculer et Prévisualiser le Devis Final")
         if st.button("Recommencer (importer un autre PDF ou repartir de zéro)"):
             restart_process()
             st.rerun()
             
         if submitted:
-            with st.spinner("Application de vos ajustements et recalcul des totaux..."):
-                time.sleep(5) # On attend 5 secondes pour l'effet
-            # On applique la marge et ajoute la main d'œuvre
-            final_lines = []
-            for line in st.session_state.raw_data.get('lignes_articles', []):
-                new_line = line.copy()
-                try:
-                    original_price = float(line.get('prix_unitaire_ht', 0))
-                    new_price = original_price * (1 + margin_percentage / 100)
-                    new_line['prix_unitaire_ht'] = new_price
-                    new_line['total_ligne_ht'] = new_price * float(line.get('quantite', 1))
-                    final_lines.append(new_line)
-                except:
-                    final_lines.append(line)
-            
-            if mo_desc and mo_hours > 0 and mo_rate > 0:
-                mo_line = {"description": mo_desc, "quantite": mo_hours, "prix_unitaire_ht": mo_rate, "total_ligne_ht": mo_hours * mo_rate}
-                final_lines.append(mo_line)
-
-            st.session_state.final_quote_data = {
-                "lignes_articles": final_lines,
-                "nom_client": st.session_state.raw_data.get('nom_client'),
-                "date_devis": st.session_state.raw_data.get('date_devis'),
-                "numero_devis": st.session_state.raw_data.get('numero_devis'),
-            }
+            # On applique la marge et ajoute la main d'œuvre (calcul vectorisé, instantané)
+            st.session_state.final_quote_data = apply_adjustments(
+                st.session_state.raw_data, margin_percentage, mo_desc, mo_hours, mo_rate
+            )
             st.session_state.step = "preview"
+            st.rerun()
 
     # ==================== ÉTAPE 3 : APERÇU ET GÉNÉRATION ====================
     elif st.session_state.step == "preview":
@@ -257,13 +304,12 @@ else:
 
         st.success("Votre devis est prêt ! Vérifiez les informations ci-dessous avant de générer le PDF.")
 
-        # Affichage du tableau final pour vérification
-        df_final = pd.DataFrame(st.session_state.final_quote_data.get('lignes_articles', []))
-        st.table(df_final.style.format(na_rep="-", formatter={"prix_unitaire_ht": "{:.2f} €", "total_ligne_ht": "{:.2f} €"}))
+        # Affichage du tableau final pour vérification (tableau et totaux mémorisés entre les réexécutions)
+        final_view = quote_views().get(st.session_state.final_quote_data)
+        show_quote_table(final_view, key="final_table_page")
 
-        # Calcul et affichage des totaux
-        total_ht = df_final['total_ligne_ht'].sum()
-        total_ttc = total_ht * 1.20
+        # Affichage des totaux
+        total_ht, total_ttc = final_view.totals
         col_total1, col_total2 = st.columns(2)
         col_total1.metric("TOTAL HT", f"{total_ht:.2f} €")
         col_total2.metric("TOTAL TTC", f"{total_ttc:.2f} €")
@@ -296,22 +342,22 @@ else:
                 data_to_generate['total_ht'] = total_ht
                 data_to_generate['total_ttc'] = total_ttc
                 
-                output_dir = "output_devis"; os.makedirs(output_dir, exist_ok=True)
                 timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
                 output_filename = f"Devis_Client_{timestamp}.pdf"
-                output_pdf_path = os.path.join(output_dir, output_filename)
 
-                success = generate_pdf(data_to_generate, output_pdf_path)
+                # Le PDF est généré en mémoire et servi tel quel (plus rien n'est écrit dans output_devis/)
+                from generator.pdf_generator import generate_pdf
+                pdf_bytes = generate_pdf(data_to_generate)
 
-                if success:
+                if pdf_bytes:
                     st.success("Devis généré !")
-                    with open(output_pdf_path, "rb") as pdf_file:
-                        # On affiche le bouton de téléchargement directement
-                        st.download_button(
-                            label="Cliquez ici pour télécharger",
-                            data=pdf_file,
-                            file_name=output_filename,
-                            mime="application/pdf"
-                        )
+                    st.download_button(
+                        label="Cliquez ici pour télécharger",
+                        data=pdf_bytes,
+                        file_name=output_filename,
+                        mime="application/pdf"
+                    )
                 else: 
-                    st.error("Erreur lors de la création du PDF.")
\ No newline at end of file
+                    st.error("Erreur lors de la création du PDF.")
+
+    show_metrics_panel()
@@ -0,0 +1,250 @@
+# =======================================================
+# microflow_ai/batch_process.py
+# Traitement par lots, sans interface, d'un dossier de devis fournisseurs.
+#
+# Exemple :
+#   python batch_process.py "devis_fournisseurs/*.pdf" --output-dir devis_clients --margin 25
+#
+# Chaque fichier traité est consigné dans un manifeste JSONL (statut et durées par étape).
+# Relancer la même commande après une interruption ne retraite pas les fichiers déjà réussis.
+# =======================================================
+
+import os
+import sys
+import glob
+import json
+import time
+import hashlib
+import argparse
+import threading
+from datetime import datetime
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+
+from extractor.pdf_reader import extract_text_and_layout, request_structured_data, totals_block_found
+from extractor.layout_parser import try_fast_path, learn_from_extraction
+from extractor.chunked_extraction import CHUNK_MAX_CHARS, structure_data_chunked
+from extractor.text_compactor import compact_text
+from extractor.similarity_index import try_delta_extraction, remember_extraction
+from extractor.validation import validate_and_repair
+from generator.pdf_generator import generate_pdf
+from pricing.adjustments import apply_adjustments, compute_totals
+from monitoring.metrics import get_registry
+
+MANIFEST_NAME = "manifest.jsonl"
+IN_FLIGHT_PER_LLM_SLOT = 2      # Fichiers en cours (extraits ou en extraction) par appel LLM simultané
+
+
+def collect_pdf_paths(inputs):
+    """Développe les dossiers et motifs glob en une liste triée et sans doublon de PDF."""
+    paths = set()
+    for item in inputs:
+        if os.path.isdir(item):
+            matches = glob.glob(os.path.join(item, "**", "*.pdf"), recursive=True)
+            matches += glob.glob(os.path.join(item, "**", "*.PDF"), recursive=True)
+        else:
+            matches = glob.glob(item, recursive=True)
+        paths.update(os.path.abspath(m) for m in matches if os.path.isfile(m))
+    return sorted(paths)
+
+
+def file_sha256(path):
+    h = hashlib.sha256()
+    with open(path, "rb") as f:
+        for block in iter(lambda: f.read(1 << 20), b""):
+            h.update(block)
+    return h.hexdigest()
+
+
+def load_completed(manifest_path):
+    """Empreintes (chemin, sha256) des fichiers déjà traités avec succès."""
+    completed = set()
+    if not os.path.exists(manifest_path):
+        return completed
+    with open(manifest_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue  # Dernière ligne tronquée par une interruption
+            if record.get("status") == "ok":
+                completed.add((record.get("source"), record.get("sha256")))
+    return completed
+
+
+class ManifestWriter:
+    """Ajout thread-safe d'un enregistrement par fichier, écrit sur disque immédiatement."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+
+    def write(self, record):
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                f.write(json.dumps(record, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+
+
+def _extract_worker(path, stop_at_totals=False):
+    """Exécuté dans un processus séparé : extraction du texte brut et de la mise en page."""
+    start = time.perf_counter()
+    text, layout = extract_text_and_layout(path, stop_when=totals_block_found if stop_at_totals else None)
+    return text, layout, time.perf_counter() - start
+
+
+def _process_text(job, text, layout, timings, args):
+    """Exécuté dans un thread : gabarit ou LLM, ajustements et génération du PDF client."""
+    start = time.perf_counter()
+    raw_data = try_fast_path(layout)
+    timings["layout_s"] = time.perf_counter() - start
+    if raw_data is None:
+        start = time.perf_counter()
+        text, job["compaction"] = compact_text(text)
+        raw_data = try_delta_extraction(text)
+        if raw_data is None and len(text) > CHUNK_MAX_CHARS:
+            raw_data = structure_data_chunked(text, max_parallel=args.chunk_parallelism)
+        elif raw_data is None:
+            raw_data = request_structured_data(text)
+        if raw_data:
+            raw_data = validate_and_repair(raw_data, text)
+            job["validation"] = raw_data["_validation"]
+        timings["llm_s"] = time.perf_counter() - start
+        if raw_data:
+            remember_extraction(text, raw_data)
+            learn_from_extraction(layout, raw_data)
+    if not raw_data:
+        raise ValueError("L'IA n'a pas pu structurer les données.")
+
+    start = time.perf_counter()
+    final_quote_data = apply_adjustments(raw_data, args.margin, args.mo_desc, args.mo_hours, args.mo_rate)
+    final_quote_data['total_ht'], final_quote_data['total_ttc'] = compute_totals(final_quote_data)
+    timings["pricing_s"] = time.perf_counter() - start
+
+    start = time.perf_counter()
+    stem = os.path.splitext(os.path.basename(job["source"]))[0]
+    output_path = os.path.join(args.output_dir, f"Devis_Client_{stem}_{job['sha256'][:8]}.pdf")
+    if not generate_pdf(final_quote_data, output_path):
+        raise ValueError("Erreur lors de la création du PDF.")
+    timings["render_s"] = time.perf_counter() - start
+    return output_path, len(final_quote_data["lignes_articles"])
+
+
+def run_batch(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    manifest_path = args.manifest or os.path.join(args.output_dir, MANIFEST_NAME)
+    manifest = ManifestWriter(manifest_path)
+    completed = load_completed(manifest_path)
+
+    jobs = []
+    for path in collect_pdf_paths(args.inputs):
+        job = {"source": path, "sha256": file_sha256(path)}
+        if (job["source"], job["sha256"]) in completed:
+            continue
+        jobs.append(job)
+    print(f"INFO: {len(jobs)} fichier(s) à traiter ({len(completed)} déjà traité(s)).")
+    if not jobs:
+        return 0
+
+    failures = 0
+    failures_lock = threading.Lock()
+
+    def finish(job, timings, started, status, output=None, error=None, nb_lignes=None):
+        nonlocal failures
+        record = {
+            "source": job["source"],
+            "sha256": job["sha256"],
+            "status": status,
+            "output": output,
+            "nb_lignes": nb_lignes,
+            "error": error,
+            "timings": {k: round(v, 3) for k, v in timings.items()},
+            "compaction": job.get("compaction"),
+            "validation": job.get("validation"),
+            "total_s": round(time.perf_counter() - started, 3),
+            "finished_at": datetime.now().isoformat(timespec="seconds"),
+        }
+        manifest.write(record)
+        if status != "ok":
+            with failures_lock:
+                failures += 1
+        print(f"{'SUCCÈS' if status == 'ok' else 'ERREUR'}: {os.path.basename(job['source'])} ({record['total_s']} s)")
+
+    def llm_stage(job, text, layout, timings, started):
+        try:
+            output, nb_lignes = _process_text(job, text, layout, timings, args)
+            finish(job, timings, started, "ok", output=output, nb_lignes=nb_lignes)
+        except Exception as e:
+            finish(job, timings, started, "error", error=str(e))
+
+    # L'extraction va bien plus vite que le LLM : on borne le nombre de fichiers en cours
+    # (texte et mise en page en mémoire), de l'extraction jusqu'à la fin de l'étape LLM
+    max_in_flight = max(1, args.llm_concurrency * IN_FLIGHT_PER_LLM_SLOT)
+    remaining = iter(jobs)
+    started_at = {}
+    with ProcessPoolExecutor(max_workers=args.extract_workers) as extract_pool, \
+            ThreadPoolExecutor(max_workers=args.llm_concurrency) as llm_pool:
+        extracting, processing = {}, set()
+        while True:
+            while len(extracting) + len(processing) < max_in_flight:
+                job = next(remaining, None)
+                if job is None:
+                    break
+                started_at[job["source"]] = time.perf_counter()
+                extracting[extract_pool.submit(_extract_worker, job["source"], args.stop_at_totals)] = job
+            if not extracting and not processing:
+                break
+
+            done, _ = wait(set(extracting) | processing, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future in processing:
+                    processing.discard(future)
+                    future.result()
+                    continue
+                # Chaque texte extrait part immédiatement vers le LLM (concurrence bornée par le pool)
+                job = extracting.pop(future)
+                started = started_at.pop(job["source"])
+                try:
+                    text, layout, extract_s = future.result()
+                except Exception as e:
+                    finish(job, {}, started, "error", error=f"Extraction : {e}")
+                    continue
+                timings = {"extract_s": extract_s}
+                # L'extraction tourne dans un autre processus : sa mesure est reportée ici
+                get_registry().record_span("pdf_extraction", extract_s, attributes={
+                    "pages": len(layout or []), "chars": len(text or ""),
+                })
+                if not text:
+                    finish(job, timings, started, "error", error="Impossible d'extraire le texte de ce PDF.")
+                    continue
+                processing.add(llm_pool.submit(llm_stage, job, text, layout, timings, started))
+
+    print(f"INFO: Terminé. {len(jobs) - failures} réussi(s), {failures} en erreur. Manifeste : {manifest_path}")
+    for row in get_registry().summary():
+        print(f"  {row['étape']:<18} {row['appels']:>5} appel(s)  moyenne {row['moyenne_s']:.3f} s  p95 {row['p95_s']:.3f} s")
+    if args.metrics_out:
+        get_registry().write_prometheus(args.metrics_out)
+        print(f"INFO: Mesures exportées (format Prometheus) : {args.metrics_out}")
+    return 1 if failures else 0
+
+
+def parse_args(argv=None):
+    parser = argparse.ArgumentParser(description="Convertit un lot de devis fournisseurs PDF en devis clients.")
+    parser.add_argument("inputs", nargs="+", help="Dossiers ou motifs glob de fichiers PDF")
+    parser.add_argument("--output-dir", default="output_devis", help="Dossier des devis clients générés")
+    parser.add_argument("--manifest", default=None, help=f"Manifeste JSONL (défaut : <output-dir>/{MANIFEST_NAME})")
+    parser.add_argument("--margin", type=float, default=30, help="Marge sur fournitures (%%)")
+    parser.add_argument("--mo-desc", default="Main d'œuvre - Prestation Globale", help="Description de la main d'œuvre")
+    parser.add_argument("--mo-hours", type=float, default=0.0, help="Quantité de main d'œuvre (heures)")
+    parser.add_argument("--mo-rate", type=float, default=50.0, help="Taux horaire (€/h)")
+    parser.add_argument("--extract-workers", type=int, default=os.cpu_count() or 1, help="Processus d'extraction PDF")
+    parser.add_argument("--llm-concurrency", type=int, default=4, help="Appels LLM simultanés (tous fichiers confondus)")
+    parser.add_argument("--chunk-parallelism", type=int, default=2, help="Appels LLM simultanés par long devis")
+    parser.add_argument("--stop-at-totals", action="store_true",
+                        help="Ne lit pas les pages qui suivent le bloc des totaux (CGV, annexes)")
+    parser.add_argument("--metrics-out", default=None, help="Fichier de mesures par étape (format texte Prometheus)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    sys.exit(run_batch(parse_args()))
@@ -0,0 +1,113 @@
+# microflow_ai/benchmarks/bench_import_time.py
+# Temps d'import à froid des modules, chacun dans un interpréteur neuf, à lancer depuis la
+# racine du projet :
+#   python -m benchmarks.bench_import_time --repeat 5 --app
+#
+# Le cœur (extraction, tarification, génération) ne doit jamais charger Streamlit : le banc
+# échoue (code 1) si c'est le cas, ou si un module dépasse son budget de temps d'import.
+
+import os
+import sys
+import json
+import time
+import argparse
+import statistics
+import subprocess
+
+# Module -> budget (secondes) ; None : mesuré sans budget
+MODULES = {
+    "monitoring.metrics": 0.05,
+    "extractor.pdf_reader": 0.3,
+    "jobs.quote_analysis": 0.5,
+    "pricing.adjustments": 1.0,
+    "generator.pdf_generator": 1.0,
+    "leads.lead_store": 0.5,
+    "batch_process": None,
+}
+HEADLESS_MODULES = ("extractor.pdf_reader", "jobs.quote_analysis", "pricing.adjustments",
+                    "generator.pdf_generator", "batch_process")
+# Bibliothèques lourdes dont le chargement est signalé pour chaque module
+HEAVY = ("streamlit", "pandas", "fitz", "fpdf", "duckdb", "streamlit_gsheets", "huggingface_hub")
+
+_MEASURE = """
+import sys, time, json
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "modules": len(sys.modules),
+                  "heavy": [m for m in {heavy!r} if m in sys.modules]}}))
+"""
+
+_MEASURE_APP = """
+import sys, time, json
+start = time.perf_counter()
+from streamlit.testing.v1 import AppTest
+at = AppTest.from_file("app.py", default_timeout=60).run()
+elapsed = time.perf_counter() - start
+print(json.dumps({{"seconds": elapsed, "modules": len(sys.modules),
+                  "heavy": [m for m in {heavy!r} if m in sys.modules],
+                  "errors": [str(e.value) for e in at.exception]}}))
+"""
+
+
+def measure(code, cwd):
+    out = subprocess.run([sys.executable, "-c", code], cwd=cwd, capture_output=True, text=True)
+    if out.returncode != 0:
+        raise RuntimeError(out.stderr.strip().splitlines()[-1] if out.stderr.strip() else "échec")
+    return json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def bench(label, code, repeat, cwd):
+    runs = [measure(code, cwd) for _ in range(repeat)]
+    last = runs[-1]
+    return {
+        "module": label,
+        "median_s": round(statistics.median(r["seconds"] for r in runs), 4),
+        "min_s": round(min(r["seconds"] for r in runs), 4),
+        "modules": last["modules"],
+        "heavy": last["heavy"],
+        "errors": last.get("errors", []),
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark du temps d'import à froid.")
+    parser.add_argument("--repeat", type=int, default=5, help="Mesures par module (médiane retenue)")
+    parser.add_argument("--app", action="store_true", help="Mesure aussi le premier affichage de app.py (AppTest)")
+    parser.add_argument("--json-out", help="Écrit les résultats dans ce fichier JSON")
+    parser.add_argument("--no-budget", action="store_true", help="Ne compare pas aux budgets")
+    args = parser.parse_args()
+
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    results, problems = [], []
+    for module, budget in MODULES.items():
+        result = bench(module, _MEASURE.format(module=module, heavy=HEAVY), args.repeat, root)
+        result["budget_s"] = budget
+        results.append(result)
+        if module in HEADLESS_MODULES and "streamlit" in result["heavy"]:
+            problems.append(f"{module} charge Streamlit")
+        if budget is not None and not args.no_budget and result["median_s"] > budget:
+            problems.append(f"{module} : {result['median_s']:.3f} s > budget {budget:.3f} s")
+    if args.app:
+        result = bench("app.py (porte d'entrée)", _MEASURE_APP.format(heavy=HEAVY), args.repeat, root)
+        result["budget_s"] = None
+        results.append(result)
+        problems.extend(f"app.py : {error}" for error in result["errors"])
+
+    print(f"{'Module':<28}{'médiane':>10}{'min':>10}{'modules':>9}  bibliothèques lourdes")
+    for r in results:
+        print(f"{r['module']:<28}{r['median_s'] * 1000:>8.0f}ms{r['min_s'] * 1000:>8.0f}ms{r['modules']:>9}  "
+              f"{', '.join(r['heavy']) or '-'}")
+
+    if args.json_out:
+        with open(args.json_out, "w", encoding="utf-8") as f:
+            json.dump({"measured_at": time.strftime("%Y-%m-%dT%H:%M:%S"), "python": sys.version.split()[0],
+                       "results": results}, f, ensure_ascii=False, indent=2)
+
+    for problem in problems:
+        print(f"ERREUR: {problem}")
+    sys.exit(1 if problems else 0)
+
+
+if __name__ == "__main__":
+    main()
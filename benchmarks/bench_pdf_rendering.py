@@ -0,0 +1,81 @@
+# microflow_ai/benchmarks/bench_pdf_rendering.py
+# Débit de génération des devis PDF (devis/seconde), à lancer depuis la racine du projet :
+#   python -m benchmarks.bench_pdf_rendering --quotes 200 --lines 15 --workers 4 --big-lines 5000
+
+import os
+import time
+import argparse
+
+from generator import pdf_generator
+from generator.pdf_generator import generate_pdf, generate_pdfs, warm_font_cache
+
+
+LONG_DESCRIPTION = " - tube cuivre écroui Ø22 mm, raccords laiton à souder, coudes 90°, manchons et gaine ICTA"
+
+
+def make_quote(nb_lines, index=0, long_every=0):
+    lines = [
+        {
+            "description": f"Article {i} - Fourniture de chantier réf. {index:04d}-{i:03d}"
+                           + (LONG_DESCRIPTION * 2 if long_every and i % long_every == 0 else ""),
+            "quantite": (i % 7) + 1,
+            "prix_unitaire_ht": 3.5 + i,
+            "total_ligne_ht": ((i % 7) + 1) * (3.5 + i),
+        }
+        for i in range(nb_lines)
+    ]
+    total_ht = sum(line["total_ligne_ht"] for line in lines)
+    return {
+        "nom_client": f"Client {index}",
+        "date_devis": "01/01/2025",
+        "numero_devis": f"DV-{index:05d}",
+        "lignes_articles": lines,
+        "total_ht": total_ht,
+        "total_ttc": total_ht * 1.2,
+    }
+
+
+def bench_single(quotes, use_font_cache):
+    start = time.perf_counter()
+    for data in quotes:
+        if not use_font_cache:
+            pdf_generator._FONT_PROTOTYPES.clear()
+        generate_pdf(data)
+    return len(quotes) / (time.perf_counter() - start)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark du rendu des devis PDF.")
+    parser.add_argument("--quotes", type=int, default=100, help="Nombre de devis par mesure")
+    parser.add_argument("--lines", type=int, default=15, help="Lignes d'articles par devis")
+    parser.add_argument("--big-lines", type=int, default=5000, help="Lignes du gros devis (mise en page multi-pages)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="Processus pour le rendu en lot")
+    args = parser.parse_args()
+
+    quotes = [make_quote(args.lines, i) for i in range(args.quotes)]
+
+    start = time.perf_counter()
+    warm_font_cache()
+    print(f"Chargement initial des polices : {(time.perf_counter() - start) * 1000:.0f} ms")
+
+    sample = quotes[:max(1, len(quotes) // 5)]
+    print(f"Rendu unitaire sans cache de polices : {bench_single(sample, use_font_cache=False):8.1f} devis/s")
+    warm_font_cache()
+    print(f"Rendu unitaire avec cache de polices : {bench_single(quotes, use_font_cache=True):8.1f} devis/s")
+
+    big_quote = make_quote(args.big_lines, long_every=3)
+    start = time.perf_counter()
+    generate_pdf(big_quote)
+    print(f"Gros devis ({args.big_lines} lignes, 1 sur 3 sur plusieurs lignes) : {time.perf_counter() - start:6.2f} s")
+
+    start = time.perf_counter()
+    results = generate_pdfs(quotes, max_workers=args.workers)
+    elapsed = time.perf_counter() - start
+    failures = sum(1 for r in results if not r)
+    label = f"Rendu en lot ({args.workers} processus)"
+    print(f"{label:<37}: {len(quotes) / elapsed:8.1f} devis/s"
+          f"{f' ({failures} en erreur)' if failures else ''}")
+
+
+if __name__ == "__main__":
+    main()
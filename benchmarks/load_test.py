@@ -0,0 +1,296 @@
+# microflow_ai/benchmarks/load_test.py
+# Test de charge de bout en bout : N sessions simultanées enchaînent porte d'entrée (lead),
+# import et analyse du devis, ajustements, aperçu et génération du PDF client, avec les
+# fonctions du cœur (sans interface). Hugging Face et Google Sheets sont remplacés par le
+# serveur bouchon local (stub_server.py), à latence réglable. À lancer depuis la racine :
+#   python -m benchmarks.load_test --sessions 8 --rounds 3 --llm-latency 2 --sheets-latency 0.3
+#
+# Le corpus de devis fournisseurs est généré avec `generate_pdf` (tailles variées). Chaque
+# exécution part de caches vides (répertoire de travail temporaire) : les raccourcis
+# (gabarits, cache LLM, extraction par différence) s'y remplissent comme en production, et
+# leurs compteurs sont rapportés. Les résultats (débit, p50/p95/p99 par étape, pic de mémoire)
+# sont ajoutés à benchmarks/results/load_test.jsonl avec le commit courant, et comparés à la
+# dernière exécution aux mêmes paramètres.
+
+import os
+import sys
+import json
+import time
+import argparse
+import resource
+import tempfile
+import threading
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+RESULTS_FILE = os.path.join(ROOT, "benchmarks", "results", "load_test.jsonl")
+STAGES = ("acces", "analyse", "ajustements", "apercu", "generation", "session")
+DEFAULT_SIZES = "5,20,80,300"   # Lignes d'articles des devis du corpus (réparties en alternance)
+POLL_SECONDS = 0.05             # Suivi de la tâche d'analyse (l'app interroge chaque seconde)
+PERCENTILES = (50, 95, 99)
+
+
+def build_corpus(sizes, count, corpus_dir):
+    """`count` devis fournisseurs PDF distincts, de tailles alternées ; retourne leurs octets."""
+    from benchmarks.bench_pdf_rendering import make_quote
+    from generator.pdf_generator import generate_pdf
+
+    os.makedirs(corpus_dir, exist_ok=True)
+    corpus = []
+    for index in range(count):
+        nb_lines = sizes[index % len(sizes)]
+        path = os.path.join(corpus_dir, f"fournisseur_{index:04d}_{nb_lines}l.pdf")
+        if not generate_pdf(make_quote(nb_lines, index=index, long_every=5), path):
+            raise RuntimeError(f"Génération du devis {path} impossible.")
+        with open(path, "rb") as f:
+            corpus.append(f.read())
+    return corpus
+
+
+class StageTimer:
+    """Durées par étape, collectées par toutes les sessions (thread-safe)."""
+
+    def __init__(self):
+        self.durations = {stage: [] for stage in STAGES}
+        self.errors = []
+        self._lock = threading.Lock()
+
+    def record(self, stage, seconds):
+        with self._lock:
+            self.durations[stage].append(seconds)
+
+    def run(self, stage, fn, *args, **kwargs):
+        start = time.perf_counter()
+        result = fn(*args, **kwargs)
+        self.record(stage, time.perf_counter() - start)
+        return result
+
+    def stats(self):
+        rows = {}
+        for stage, values in self.durations.items():
+            if not values:
+                continue
+            p50, p95, p99 = np.percentile(values, PERCENTILES)
+            rows[stage] = {"n": len(values), "mean_s": round(float(np.mean(values)), 4),
+                           "p50_s": round(float(p50), 4), "p95_s": round(float(p95), 4),
+                           "p99_s": round(float(p99), 4), "max_s": round(float(np.max(values)), 4)}
+        return rows
+
+
+def run_session(number, pdf_bytes, queue, lead_store, timer):
+    """Parcours complet d'un utilisateur, dans l'ordre des étapes de l'application."""
+    from jobs.job_queue import FAILED
+    from jobs.quote_analysis import analysis_key, analyze_quote
+    from pricing.adjustments import apply_adjustments
+    from generator.pdf_generator import generate_pdf
+    from ui.quote_views import QuoteViewCache
+
+    def analyse():
+        job_id = queue.submit(analysis_key(pdf_bytes), analyze_quote, pdf_bytes)
+        while not queue.get(job_id).finished:
+            time.sleep(POLL_SECONDS)
+        job = queue.get(job_id)
+        if job.status == FAILED:
+            raise RuntimeError(job.error)
+        return job.result
+
+    def adjust(raw_data):
+        views.get(raw_data).page(1)
+        return apply_adjustments(raw_data, 30, "Main d'œuvre - Prestation Globale", 8.0, 50.0)
+
+    def preview(final_quote_data):
+        view = views.get(final_quote_data)
+        view.page(1)
+        return view.totals
+
+    def generate(final_quote_data, totals):
+        data = dict(final_quote_data, total_ht=totals[0], total_ttc=totals[1])
+        if not generate_pdf(data):
+            raise RuntimeError("Erreur lors de la création du PDF.")
+
+    views = QuoteViewCache()
+    start = time.perf_counter()
+    try:
+        timer.run("acces", lead_store.upsert, f"Client {number}", f"client{number}@exemple.fr", "Plombier")
+        raw_data = timer.run("analyse", analyse)
+        final_quote_data = timer.run("ajustements", adjust, raw_data)
+        totals = timer.run("apercu", preview, final_quote_data)
+        timer.run("generation", generate, final_quote_data, totals)
+        timer.record("session", time.perf_counter() - start)
+    except Exception as e:
+        with timer._lock:
+            timer.errors.append(f"session {number} : {e}")
+
+
+def peak_rss_mb():
+    """Pic de mémoire résidente du processus et de ses processus fils (Mo)."""
+    unit = 1024 * 1024 if sys.platform == "darwin" else 1024     # ru_maxrss : octets sur macOS, Ko ailleurs
+    own = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / unit
+    children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / unit
+    return round(own, 1), round(children, 1)
+
+
+def git_revision():
+    try:
+        commit = subprocess.run(["git", "rev-parse", "--short", "HEAD"], cwd=ROOT, capture_output=True,
+                                text=True, timeout=10).stdout.strip()
+        dirty = bool(subprocess.run(["git", "status", "--porcelain", "--untracked-files=no"], cwd=ROOT,
+                                    capture_output=True, text=True, timeout=30).stdout.strip())
+        return commit or None, dirty
+    except (OSError, subprocess.SubprocessError):
+        return None, False
+
+
+def previous_result(path, params):
+    """Dernier résultat enregistré avec les mêmes paramètres, ou None."""
+    if not os.path.exists(path):
+        return None
+    previous = None
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except ValueError:
+                continue
+            if record.get("params") == params:
+                previous = record
+    return previous
+
+
+def compare(current, previous, tolerance):
+    """Régressions (p95 par étape, débit) au-delà de `tolerance` (ex. 0.2 = 20 %)."""
+    regressions = []
+    print(f"\nComparaison avec {previous.get('commit') or '?'} ({previous.get('measured_at')}) :")
+    for stage, row in current["stages"].items():
+        before = previous["stages"].get(stage)
+        if not before or not before["p95_s"]:
+            continue
+        change = row["p95_s"] / before["p95_s"] - 1
+        print(f"  {stage:<12} p95 {before['p95_s']:8.3f} s -> {row['p95_s']:8.3f} s ({change:+.0%})")
+        if change > tolerance:
+            regressions.append(f"{stage} : p95 {change:+.0%}")
+    if previous.get("throughput_sessions_s"):
+        change = current["throughput_sessions_s"] / previous["throughput_sessions_s"] - 1
+        print(f"  {'débit':<12} {previous['throughput_sessions_s']:8.3f} -> {current['throughput_sessions_s']:8.3f} sessions/s ({change:+.0%})")
+        if change < -tolerance:
+            regressions.append(f"débit {change:+.0%}")
+    return regressions
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Test de charge de bout en bout avec services bouchons.")
+    parser.add_argument("--sessions", type=int, default=8, help="Sessions simultanées")
+    parser.add_argument("--rounds", type=int, default=2, help="Parcours successifs par session")
+    parser.add_argument("--sizes", default=DEFAULT_SIZES, help="Lignes par devis du corpus, séparées par des virgules")
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="Latence moyenne du LLM bouchon (s)")
+    parser.add_argument("--sheets-latency", type=float, default=0.2, help="Latence moyenne de la feuille bouchon (s)")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Gigue relative des latences")
+    parser.add_argument("--job-workers", type=int, default=None, help="Tâches d'analyse simultanées (défaut : celui de l'app)")
+    parser.add_argument("--llm-jobs", type=int, default=None, help="Analyses interrogeant le LLM en même temps (défaut : celui de l'app)")
+    parser.add_argument("--workdir", help="Répertoire de travail (caches, corpus) ; temporaire et vide par défaut")
+    parser.add_argument("--results", default=RESULTS_FILE, help="Fichier JSONL des résultats")
+    parser.add_argument("--no-save", action="store_true", help="N'enregistre pas les résultats")
+    parser.add_argument("--max-regression", type=float, default=None,
+                        help="Échoue (code 1) si p95 ou débit se dégradent de plus de cette part (ex. 0.2)")
+    args = parser.parse_args()
+
+    sizes = [int(s) for s in args.sizes.split(",") if s.strip()]
+    total_sessions = args.sessions * args.rounds
+    results_path = os.path.abspath(args.results)
+    sys.path.insert(0, ROOT)
+    os.chdir(args.workdir or tempfile.mkdtemp(prefix="microflow_load_"))
+    print(f"INFO: Répertoire de travail : {os.getcwd()}")
+
+    # Le cœur est importé après le changement de répertoire : caches et index partent de zéro.
+    # Le backend "hf" (client Hugging Face réel) est dirigé vers le serveur bouchon.
+    os.environ["MICROFLOW_LLM_BACKEND"] = "hf"
+    from benchmarks.stub_server import StubSheetsConnection, start_stub_server
+    from extractor.inference import HuggingFaceBackend, InferenceService, set_inference_service
+    from extractor.pdf_reader import MODEL_ID, configure
+    from jobs.job_queue import JobQueue, MAX_LLM_JOBS, MAX_WORKERS
+    from leads.lead_store import GSheetsBackend, LeadStore
+    from monitoring.metrics import get_registry
+
+    server, url, stub_state = start_stub_server(args.llm_latency, args.sheets_latency, args.jitter)
+    configure(hf_token="bouchon")
+    set_inference_service(InferenceService(HuggingFaceBackend(MODEL_ID, "bouchon", base_url=url)), backend="hf")
+    print(f"INFO: Serveur bouchon sur {url}.")
+
+    start = time.perf_counter()
+    corpus = build_corpus(sizes, total_sessions, os.path.join(os.getcwd(), "corpus"))
+    print(f"INFO: Corpus de {len(corpus)} devis généré en {time.perf_counter() - start:.1f} s.")
+    get_registry().reset()
+
+    queue = JobQueue(max_workers=args.job_workers or MAX_WORKERS, max_llm_jobs=args.llm_jobs or MAX_LLM_JOBS)
+    lead_store = LeadStore(GSheetsBackend(StubSheetsConnection(url)), db_path=os.path.join("data", "leads.duckdb"))
+    timer = StageTimer()
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=args.sessions, thread_name_prefix="session") as sessions:
+        for number in range(total_sessions):
+            sessions.submit(run_session, number, corpus[number], queue, lead_store, timer)
+    wall = time.perf_counter() - start
+    lead_store.close()
+    queue.shutdown()
+    server.shutdown()
+
+    completed = len(timer.durations["session"])
+    rss_self, rss_children = peak_rss_mb()
+    commit, dirty = git_revision()
+    registry = get_registry()
+    shortcuts = {}
+    for (name, labels), value in registry.counters.items():
+        if name.endswith("hits_total") or name.endswith("misses_total"):
+            shortcuts.setdefault(dict(labels).get("stage"), {})[name] = value
+    result = {
+        "measured_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+        "commit": commit,
+        "dirty": dirty,
+        "python": sys.version.split()[0],
+        "cpus": os.cpu_count(),
+        "params": {"sessions": args.sessions, "rounds": args.rounds, "sizes": sizes,
+                   "llm_latency": args.llm_latency, "sheets_latency": args.sheets_latency, "jitter": args.jitter,
+                   "job_workers": args.job_workers, "llm_jobs": args.llm_jobs},
+        "wall_s": round(wall, 3),
+        "sessions_ok": completed,
+        "errors": timer.errors,
+        "throughput_sessions_s": round(completed / wall, 4) if wall else 0.0,
+        "stages": timer.stats(),
+        "internal_stages": registry.summary(),
+        "shortcuts": shortcuts,
+        "stub_calls": dict(stub_state.counts),
+        "peak_rss_mb": rss_self,
+        "peak_rss_children_mb": rss_children,
+    }
+
+    print(f"\n{completed}/{total_sessions} session(s) en {wall:.1f} s : "
+          f"{result['throughput_sessions_s']:.2f} sessions/s, {result['throughput_sessions_s'] * 60:.1f} devis/min")
+    print(f"{'Étape':<14}{'n':>5}{'p50':>10}{'p95':>10}{'p99':>10}{'max':>10}")
+    for stage, row in result["stages"].items():
+        print(f"{stage:<14}{row['n']:>5}{row['p50_s']:>9.3f}s{row['p95_s']:>9.3f}s{row['p99_s']:>9.3f}s{row['max_s']:>9.3f}s")
+    print(f"Pic de mémoire : {rss_self:.0f} Mo (processus fils : {rss_children:.0f} Mo)")
+    print(f"Appels aux services bouchons : {result['stub_calls']}")
+    for error in timer.errors[:10]:
+        print(f"ERREUR: {error}")
+
+    regressions = []
+    previous = previous_result(results_path, result["params"])
+    if previous is not None:
+        regressions = compare(result, previous, args.max_regression if args.max_regression is not None else 0.2)
+    if not args.no_save:
+        os.makedirs(os.path.dirname(results_path), exist_ok=True)
+        with open(results_path, "a", encoding="utf-8") as f:
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+        print(f"INFO: Résultats ajoutés à {results_path}")
+
+    if timer.errors or (args.max_regression is not None and regressions):
+        for regression in regressions:
+            print(f"ERREUR: Régression : {regression}")
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
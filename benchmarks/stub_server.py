@@ -0,0 +1,162 @@
+# microflow_ai/benchmarks/stub_server.py
+# Serveur HTTP local qui remplace Hugging Face et Google Sheets pendant les tests de charge.
+#
+#   POST /v1/chat/completions   API de chat compatible OpenAI/TGI (réponse complète ou flux SSE),
+#                               réponse construite par `StubBackend.structure` à partir du prompt
+#   GET  /sheets/<feuille>      lignes de la feuille (JSON)
+#   PUT  /sheets/<feuille>      remplace les lignes de la feuille
+#
+# Les latences sont réglables (moyenne et gigue), séparément pour le LLM et pour la feuille.
+# Lancement seul : python -m benchmarks.stub_server --port 8765 --llm-latency 2
+
+import json
+import time
+import random
+import argparse
+import threading
+from urllib import request as urlrequest
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from extractor.inference import StubBackend
+
+STREAM_CHUNK_CHARS = 32
+
+
+class StubState:
+    def __init__(self, llm_latency=0.0, sheets_latency=0.0, jitter=0.2, seed=0):
+        self.llm_latency = llm_latency
+        self.sheets_latency = sheets_latency
+        self.jitter = jitter            # Gigue relative : latence x (1 ± jitter)
+        self.sheets = {}                # feuille -> lignes
+        self.counts = {"llm": 0, "sheets_read": 0, "sheets_write": 0}
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def wait(self, latency, counter):
+        with self._lock:
+            self.counts[counter] += 1
+            factor = 1 + self._random.uniform(-self.jitter, self.jitter)
+        if latency:
+            time.sleep(latency * factor)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    state = None    # StubState, fixé par `start_stub_server`
+
+    def log_message(self, format, *args):
+        pass
+
+    def _body(self):
+        length = int(self.headers.get("Content-Length") or 0)
+        return json.loads(self.rfile.read(length) or b"{}")
+
+    def _send_json(self, payload, status=200):
+        body = json.dumps(payload, ensure_ascii=False).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        if not self.path.startswith("/sheets/"):
+            return self._send_json({"error": "introuvable"}, 404)
+        self.state.wait(self.state.sheets_latency, "sheets_read")
+        with self.state._lock:
+            rows = list(self.state.sheets.get(self.path[len("/sheets/"):], []))
+        self._send_json(rows)
+
+    def do_PUT(self):
+        if not self.path.startswith("/sheets/"):
+            return self._send_json({"error": "introuvable"}, 404)
+        rows = self._body()
+        self.state.wait(self.state.sheets_latency, "sheets_write")
+        with self.state._lock:
+            self.state.sheets[self.path[len("/sheets/"):]] = rows
+        self._send_json({"rows": len(rows)})
+
+    def do_POST(self):
+        if not self.path.rstrip("/").endswith("/chat/completions"):
+            return self._send_json({"error": "introuvable"}, 404)
+        payload = self._body()
+        self.state.wait(self.state.llm_latency, "llm")
+        prompt = payload["messages"][-1]["content"]
+        text = prompt.split("---")[1] if prompt.count("---") >= 2 else prompt
+        content = json.dumps(StubBackend.structure(text), ensure_ascii=False)
+        usage = {"prompt_tokens": len(prompt) // 4, "completion_tokens": len(content) // 4,
+                 "total_tokens": (len(prompt) + len(content)) // 4}
+        base = {"id": "stub", "created": int(time.time()), "model": payload.get("model") or "stub",
+                "system_fingerprint": "stub"}
+        if not payload.get("stream"):
+            return self._send_json({
+                **base, "object": "chat.completion", "usage": usage,
+                "choices": [{"index": 0, "finish_reason": "stop", "logprobs": None,
+                             "message": {"role": "assistant", "content": content}}],
+            })
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Connection", "close")
+        self.end_headers()
+        for i in range(0, len(content), STREAM_CHUNK_CHARS):
+            chunk = {**base, "object": "chat.completion.chunk",
+                     "choices": [{"index": 0, "finish_reason": None, "logprobs": None,
+                                  "delta": {"role": "assistant", "content": content[i:i + STREAM_CHUNK_CHARS]}}]}
+            self.wfile.write(f"data: {json.dumps(chunk, ensure_ascii=False)}\n\n".encode("utf-8"))
+        self.wfile.write(b"data: [DONE]\n\n")
+        self.close_connection = True
+
+
+def start_stub_server(llm_latency=0.0, sheets_latency=0.0, jitter=0.2, host="127.0.0.1", port=0):
+    """Démarre le serveur dans un thread ; retourne (serveur, URL de base, état)."""
+    state = StubState(llm_latency, sheets_latency, jitter)
+    handler = type("BoundStubHandler", (StubHandler,), {"state": state})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="stub-server", daemon=True).start()
+    return server, f"http://{host}:{server.server_address[1]}", state
+
+
+class StubSheetsConnection:
+    """
+    Remplaçant de `st.connection("gsheets", type=GSheetsConnection)` qui parle au serveur
+    bouchon : mêmes méthodes `read` et `update`, utilisables par `GSheetsBackend`.
+    """
+
+    def __init__(self, base_url, timeout=30):
+        self.base_url = base_url.rstrip("/")
+        self.timeout = timeout
+
+    def read(self, worksheet, use_headers=True, ttl=0):
+        import pandas as pd
+
+        with urlrequest.urlopen(f"{self.base_url}/sheets/{worksheet}", timeout=self.timeout) as response:
+            return pd.DataFrame(json.loads(response.read()))
+
+    def update(self, worksheet, data):
+        body = data.to_json(orient="records", force_ascii=False).encode("utf-8")
+        req = urlrequest.Request(f"{self.base_url}/sheets/{worksheet}", data=body, method="PUT",
+                                 headers={"Content-Type": "application/json"})
+        with urlrequest.urlopen(req, timeout=self.timeout) as response:
+            response.read()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serveur bouchon Hugging Face / Google Sheets.")
+    parser.add_argument("--port", type=int, default=8765)
+    parser.add_argument("--llm-latency", type=float, default=1.0, help="Latence moyenne d'une réponse LLM (s)")
+    parser.add_argument("--sheets-latency", type=float, default=0.3, help="Latence moyenne d'un appel à la feuille (s)")
+    parser.add_argument("--jitter", type=float, default=0.2, help="Gigue relative des latences")
+    args = parser.parse_args()
+
+    server, url, _ = start_stub_server(args.llm_latency, args.sheets_latency, args.jitter, port=args.port)
+    print(f"INFO: Serveur bouchon sur {url} (MICROFLOW_HF_BASE_URL={url}). Ctrl+C pour arrêter.")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
+
+
+if __name__ == "__main__":
+    main()
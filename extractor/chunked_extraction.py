@@ -0,0 +1,143 @@
+# microflow_ai/extractor/chunked_extraction.py
+# Extraction "map-reduce" des longs devis : découpage par pages/lignes,
+# appels LLM en parallèle, puis fusion des résultats partiels.
+
+from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+from extractor.pdf_reader import PAGE_SEPARATOR, request_structured_data
+from monitoring.metrics import annotate, instrument
+
+# --- Configuration ---
+CHUNK_MAX_CHARS = 3500      # Doit rester sous la fenêtre de 4000 caractères du prompt
+CHUNK_OVERLAP_LINES = 2     # Lignes répétées en début de morceau pour ne pas couper un article
+MAX_PARALLEL_CHUNKS = 4     # Nombre maximal d'appels LLM simultanés pour un même devis
+
+HEADER_FIELDS = ("nom_client", "date_devis", "numero_devis")
+TOTAL_FIELDS = ("total_ht", "total_ttc")
+
+
+def _split_long_page(page_text, max_chars):
+    """Découpe une page trop longue sur les fins de ligne (une ligne seule trop longue est tronquée)."""
+    pieces, current, size = [], [], 0
+    for line in page_text.split("\n"):
+        line = line[:max_chars]
+        if current and size + len(line) + 1 > max_chars:
+            pieces.append("\n".join(current))
+            current, size = [], 0
+        current.append(line)
+        size += len(line) + 1
+    if current:
+        pieces.append("\n".join(current))
+    return pieces
+
+
+def split_into_chunks(text_content, max_chars=CHUNK_MAX_CHARS, overlap_lines=CHUNK_OVERLAP_LINES):
+    """
+    Découpe le texte de `extract_text_from_pdf` en morceaux d'au plus `max_chars` caractères,
+    en respectant les limites de pages puis de lignes. Les dernières lignes d'un morceau
+    sont répétées au début du suivant (les doublons sont retirés à la fusion).
+    """
+    pieces = []
+    for page_text in text_content.split(PAGE_SEPARATOR):
+        page_text = page_text.strip("\n")
+        if not page_text.strip():
+            continue
+        if len(page_text) > max_chars:
+            pieces.extend(_split_long_page(page_text, max_chars))
+        else:
+            pieces.append(page_text)
+
+    # On regroupe les pages courtes pour limiter le nombre d'appels
+    chunks, current = [], ""
+    for piece in pieces:
+        if current and len(current) + len(piece) + 1 > max_chars:
+            chunks.append(current)
+            tail = "\n".join(current.split("\n")[-overlap_lines:]) if overlap_lines else ""
+            current = tail if len(tail) + len(piece) + 1 <= max_chars else ""
+        current = f"{current}\n{piece}" if current else piece
+    if current:
+        chunks.append(current)
+    return chunks
+
+
+def _line_signature(line):
+    """Identité d'une ligne d'article, insensible à la casse et aux espaces."""
+    description = " ".join(str(line.get("description") or "").lower().split())
+    return (description, line.get("quantite"), line.get("prix_unitaire_ht"), line.get("total_ligne_ht"))
+
+
+def _merge_lines(partial_results, max_edge_duplicates):
+    """Concatène les `lignes_articles` en retirant les doublons à la jonction de deux morceaux."""
+    merged = []
+    for result in partial_results:
+        lines = [l for l in (result.get("lignes_articles") or []) if isinstance(l, dict)]
+        prev_tail = [_line_signature(l) for l in merged[-max_edge_duplicates:]]
+        head = [_line_signature(l) for l in lines[:max_edge_duplicates]]
+        skip = 0
+        for k in range(min(len(prev_tail), len(head)), 0, -1):
+            if prev_tail[-k:] == head[:k]:
+                skip = k
+                break
+        merged.extend(lines[skip:])
+    return merged
+
+
+def _reconcile_field(values, prefer_last=False):
+    """Valeur la plus fréquente parmi les morceaux (à égalité : la première, ou la dernière pour les totaux)."""
+    values = [v for v in values if v not in (None, "")]
+    if not values:
+        return None
+    if prefer_last:
+        return values[-1]
+    counts = Counter(str(v) for v in values)
+    best = max(counts.values())
+    return next(v for v in values if counts[str(v)] == best)
+
+
+def merge_partial_results(partial_results, max_edge_duplicates=CHUNK_OVERLAP_LINES + 1):
+    """Fusionne les JSON partiels (dans l'ordre des morceaux) en un seul devis structuré."""
+    merged = {field: _reconcile_field([r.get(field) for r in partial_results]) for field in HEADER_FIELDS}
+    # Les totaux se trouvent en fin de document : on garde la dernière valeur trouvée
+    for field in TOTAL_FIELDS:
+        merged[field] = _reconcile_field([r.get(field) for r in partial_results], prefer_last=True)
+    merged["lignes_articles"] = _merge_lines(partial_results, max_edge_duplicates)
+    return merged
+
+
+@instrument("llm_chunked")
+def structure_data_chunked(text_content, max_chars=CHUNK_MAX_CHARS, max_parallel=MAX_PARALLEL_CHUNKS,
+                           extract_fn=request_structured_data):
+    """
+    Extraction d'un devis de longueur quelconque. Les morceaux sont envoyés au modèle en
+    parallèle (au plus `max_parallel` à la fois) : la durée totale suit le morceau le plus lent.
+    Retourne le JSON fusionné, ou None si aucun morceau n'a pu être analysé. Les indices des
+    morceaux en échec sont listés dans la clé "_morceaux_en_erreur".
+    """
+    chunks = split_into_chunks(text_content, max_chars=max_chars)
+    if not chunks:
+        return None
+    print(f"INFO: Extraction en {len(chunks)} morceau(x), {min(max_parallel, len(chunks))} en parallèle.")
+
+    def run(chunk):
+        try:
+            return extract_fn(chunk)
+        except Exception as e:
+            print(f"ERREUR (morceau): {e}")
+            return None
+
+    with ThreadPoolExecutor(max_workers=max(1, min(max_parallel, len(chunks)))) as pool:
+        results = list(pool.map(run, chunks))
+
+    failed = [i for i, r in enumerate(results) if not isinstance(r, dict)]
+    annotate(chunks=len(chunks), failed_chunks=len(failed))
+    partial_results = [r for r in results if isinstance(r, dict)]
+    if not partial_results:
+        return None
+
+    merged = merge_partial_results(partial_results)
+    if failed:
+        print(f"AVERTISSEMENT: {len(failed)} morceau(x) non analysé(s) : {failed}")
+        merged["_morceaux_en_erreur"] = failed
+    print(f"SUCCÈS: {len(merged['lignes_articles'])} ligne(s) fusionnée(s).")
+    return merged
@@ -0,0 +1,419 @@
+# microflow_ai/extractor/inference.py
+# Couche d'inférence : backends interchangeables (Hugging Face, Ollama local, bouchon de
+# test), clients persistants, budget de latence par requête, nouvelles tentatives sur
+# erreurs transitoires et requêtes "couvertes" (hedging) contre les réponses trop lentes.
+
+import os
+import re
+import json
+import time
+import random
+import asyncio
+import threading
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+
+from monitoring.metrics import annotate
+
+# --- Configuration ---
+BACKEND = os.environ.get("MICROFLOW_LLM_BACKEND", "hf")     # "hf", "ollama" ou "stub"
+HF_BASE_URL = os.environ.get("MICROFLOW_HF_BASE_URL")       # Point d'accès compatible (ex. serveur bouchon)
+OLLAMA_HOST = os.environ.get("OLLAMA_HOST", "http://localhost:11434")
+OLLAMA_MODEL = os.environ.get("MICROFLOW_OLLAMA_MODEL", "qwen2.5:7b-instruct")
+LATENCY_BUDGET_SECONDS = 90     # Durée maximale d'une requête, tentatives comprises
+ATTEMPT_TIMEOUT_SECONDS = 60    # Durée maximale d'une tentative
+MAX_ATTEMPTS = 3
+BACKOFF_BASE_SECONDS = 0.5
+HEDGE_AFTER_SECONDS = None      # Ex. 20 : relance une 2e requête si la 1re n'a pas répondu
+MAX_PARALLEL_CALLS = 16         # Appels simultanés par processus (tentatives et couvertures)
+
+TRANSIENT_STATUS_CODES = {408, 425, 429, 500, 502, 503, 504}
+
+
+class InferenceError(RuntimeError):
+    """Échec définitif d'une requête d'inférence."""
+
+
+class TransientInferenceError(InferenceError):
+    """Erreur passagère (surcharge, coupure réseau) : la requête peut être retentée."""
+
+
+class BudgetExceededError(InferenceError):
+    """Le budget de latence de la requête est épuisé."""
+
+
+def is_transient(exc):
+    """Erreurs qui justifient une nouvelle tentative (délais, réseau, 429 et 5xx)."""
+    if isinstance(exc, (TransientInferenceError, TimeoutError, ConnectionError)):
+        return True
+    status = getattr(exc, "status_code", None)
+    if status is None and getattr(exc, "response", None) is not None:
+        status = getattr(exc.response, "status_code", None)
+    if status is not None:
+        return int(status) in TRANSIENT_STATUS_CODES
+    name = type(exc).__name__
+    return "Timeout" in name or "Connect" in name
+
+
+def model_key(backend=None, model_id=None, base_url=HF_BASE_URL):
+    """
+    Identifiant du backend et du modèle qui répondent (ex. "hf:Qwen/...", "ollama:qwen2.5:7b",
+    "stub"), utilisé dans les clés de cache : les réponses du bouchon ou d'un modèle local ne
+    sont jamais servies à la place de celles du modèle en ligne.
+    """
+    name = backend or BACKEND
+    if name == "hf":
+        return f"hf:{model_id}" + (f"@{base_url}" if base_url else "")
+    if name == "ollama":
+        return f"ollama:{model_id or OLLAMA_MODEL}"
+    return name
+
+
+# --- Backends ---
+# `complete` retourne (texte, usage) ; usage = {"prompt_tokens", "completion_tokens"} ou None.
+class HuggingFaceBackend:
+    """API d'inférence Hugging Face, avec un client unique (connexions HTTP réutilisées)."""
+
+    name = "hf"
+
+    def __init__(self, model_id, token, timeout=ATTEMPT_TIMEOUT_SECONDS, base_url=HF_BASE_URL):
+        from huggingface_hub import InferenceClient
+
+        self.model_id = model_id
+        self.model_key = model_key("hf", model_id, base_url)
+        self.client = InferenceClient(token=token, timeout=timeout, base_url=base_url)
+
+    def complete(self, messages, max_tokens, temperature, json_mode):
+        response = self.client.chat_completion(
+            messages=messages,
+            model=self.model_id,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            response_format={"type": "json_object"} if json_mode else None,
+        )
+        usage = getattr(response, "usage", None)
+        if usage is not None:
+            usage = {"prompt_tokens": usage.prompt_tokens, "completion_tokens": usage.completion_tokens}
+        return response.choices[0].message.content, usage
+
+    def stream(self, messages, max_tokens, temperature, json_mode):
+        chunks = self.client.chat_completion(
+            messages=messages,
+            model=self.model_id,
+            max_tokens=max_tokens,
+            temperature=temperature,
+            response_format={"type": "json_object"} if json_mode else None,
+            stream=True,
+        )
+        for chunk in chunks:
+            if chunk.choices:
+                yield chunk.choices[0].delta.content or ""
+
+
+class OllamaBackend:
+    """Modèle local servi par Ollama."""
+
+    name = "ollama"
+
+    def __init__(self, model=OLLAMA_MODEL, host=OLLAMA_HOST, timeout=ATTEMPT_TIMEOUT_SECONDS):
+        import ollama
+
+        self.model = model
+        self.model_key = model_key("ollama", model)
+        self.client = ollama.Client(host=host, timeout=timeout)
+
+    def _options(self, max_tokens, temperature):
+        return {"num_predict": max_tokens, "temperature": temperature}
+
+    def complete(self, messages, max_tokens, temperature, json_mode):
+        response = self.client.chat(
+            model=self.model,
+            messages=messages,
+            format="json" if json_mode else None,
+            options=self._options(max_tokens, temperature),
+        )
+        usage = {"prompt_tokens": response.get("prompt_eval_count") or 0,
+                 "completion_tokens": response.get("eval_count") or 0}
+        return response["message"]["content"], usage
+
+    def stream(self, messages, max_tokens, temperature, json_mode):
+        for chunk in self.client.chat(
+            model=self.model,
+            messages=messages,
+            format="json" if json_mode else None,
+            options=self._options(max_tokens, temperature),
+            stream=True,
+        ):
+            yield chunk["message"]["content"] or ""
+
+
+class StubBackend:
+    """
+    Backend déterministe pour les tests et les bancs d'essai : relit les lignes
+    "description quantité prix total" du texte du prompt, sans réseau.
+    `latency` (secondes) et `failure_rate` (part d'erreurs transitoires) sont réglables.
+    """
+
+    name = "stub"
+    model_key = "stub"
+    _ITEM_RE = re.compile(
+        r"^\s*(?P<desc>\S.*?)\s+(?P<q>\d+(?:[.,]\d+)?)\s+(?P<pu>\d[\d\s]*(?:[.,]\d+)?)\s*(?:€|EUR)?"
+        r"\s+(?P<t>\d[\d\s]*(?:[.,]\d+)?)\s*(?:€|EUR)?\s*$"
+    )
+
+    def __init__(self, latency=0.0, failure_rate=0.0, seed=0):
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.calls = 0
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+
+    def _respond(self, messages):
+        with self._lock:
+            self.calls += 1
+            fail = self._random.random() < self.failure_rate
+        if self.latency:
+            time.sleep(self.latency)
+        if fail:
+            raise TransientInferenceError("Erreur simulée par le bouchon d'inférence.")
+        prompt = messages[-1]["content"]
+        text = prompt.split("---")[1] if prompt.count("---") >= 2 else prompt
+        return json.dumps(self.structure(text), ensure_ascii=False)
+
+    @classmethod
+    def structure(cls, text):
+        def number(value):
+            return float(re.sub(r"\s", "", value).replace(",", "."))
+
+        lines = []
+        for raw_line in text.splitlines():
+            match = cls._ITEM_RE.match(raw_line)
+            if match and not match.group("desc").lower().startswith("total"):
+                lines.append({
+                    "description": match.group("desc").strip(),
+                    "quantite": number(match.group("q")),
+                    "prix_unitaire_ht": number(match.group("pu")),
+                    "total_ligne_ht": number(match.group("t")),
+                })
+        total_ht = round(sum(line["total_ligne_ht"] for line in lines), 2)
+        return {
+            "nom_client": None,
+            "date_devis": None,
+            "numero_devis": None,
+            "total_ht": total_ht,
+            "total_ttc": round(total_ht * 1.2, 2),
+            "lignes_articles": lines,
+        }
+
+    def complete(self, messages, max_tokens, temperature, json_mode):
+        return self._respond(messages), None
+
+    def stream(self, messages, max_tokens, temperature, json_mode):
+        text = self._respond(messages)
+        for i in range(0, len(text), 32):
+            yield text[i:i + 32]
+
+
+# --- Service ---
+class InferenceService:
+    """
+    Point d'entrée unique des appels LLM. Chaque requête dispose d'un budget de latence ;
+    les erreurs transitoires sont retentées avec un délai exponentiel (avec gigue), et une
+    requête de couverture peut être lancée si la première tarde (la plus rapide gagne).
+    """
+
+    def __init__(self, backend, latency_budget=LATENCY_BUDGET_SECONDS, max_attempts=MAX_ATTEMPTS,
+                 hedge_after=HEDGE_AFTER_SECONDS, max_parallel=MAX_PARALLEL_CALLS):
+        self.backend = backend
+        self.latency_budget = latency_budget
+        self.max_attempts = max_attempts
+        self.hedge_after = hedge_after
+        self._pool = ThreadPoolExecutor(max_workers=max_parallel, thread_name_prefix="inference")
+        self._stats_lock = threading.Lock()
+        self.stats = {"requests": 0, "attempts": 0, "retries": 0, "hedges": 0, "hedge_wins": 0, "failures": 0}
+
+    @property
+    def model_key(self):
+        """Backend et modèle servis (voir `model_key`)."""
+        return getattr(self.backend, "model_key", self.backend.name)
+
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self.stats[key] += n
+
+    def _backoff(self, attempt):
+        return BACKOFF_BASE_SECONDS * (2 ** attempt) * (0.5 + random.random())
+
+    def _attempt(self, call, deadline):
+        """Une tentative, éventuellement couverte par une seconde requête identique."""
+        self._count("attempts")
+        first = self._pool.submit(call)
+        futures = {first}
+        if self.hedge_after is not None:
+            done, _ = wait(futures, timeout=min(self.hedge_after, max(0.0, deadline - time.monotonic())))
+            if not done and time.monotonic() < deadline:
+                self._count("hedges")
+                futures.add(self._pool.submit(call))
+        errors = []
+        while futures:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise BudgetExceededError("Budget de latence dépassé.")
+            done, futures = wait(futures, timeout=remaining, return_when=FIRST_COMPLETED)
+            for future in done:
+                if future.exception() is None:
+                    if future is not first:
+                        self._count("hedge_wins")
+                    return future.result()
+                errors.append(future.exception())
+        raise errors[0]
+
+    def _record_usage(self, messages, text, usage, completion_chars=None):
+        """
+        Jetons consommés, ajoutés à l'étape mesurée en cours. Champ absent ou vide dans l'usage
+        fourni par le backend (flux, bouchon, serveur incomplet) : estimation grossière à
+        4 caractères par jeton.
+        """
+        prompt_chars = sum(len(m.get("content") or "") for m in messages)
+        if completion_chars is None:
+            completion_chars = len(text or "")
+        tokens = {"prompt_tokens": (prompt_chars + 3) // 4, "completion_tokens": (completion_chars + 3) // 4}
+        for field, value in (usage or {}).items():
+            if field in tokens and isinstance(value, (int, float)):
+                tokens[field] = int(value)
+        annotate(**tokens)
+
+    def complete(self, messages, max_tokens=2048, temperature=0.1, json_mode=True, budget=None):
+        """Réponse complète du modèle (texte), dans le budget de latence donné."""
+        self._count("requests")
+        deadline = time.monotonic() + (budget or self.latency_budget)
+
+        def call():
+            return self.backend.complete(messages, max_tokens, temperature, json_mode)
+
+        for attempt in range(self.max_attempts):
+            try:
+                text, usage = self._attempt(call, deadline)
+            except BudgetExceededError:
+                self._count("failures")
+                raise
+            except Exception as e:
+                delay = self._backoff(attempt)
+                if not is_transient(e) or attempt == self.max_attempts - 1 or time.monotonic() + delay >= deadline:
+                    self._count("failures")
+                    raise
+                self._count("retries")
+                print(f"AVERTISSEMENT: Erreur transitoire du service IA ({e}), nouvel essai dans {delay:.1f} s.")
+                time.sleep(delay)
+            else:
+                # Hors du bloc des tentatives : une erreur de comptage ne perd jamais une réponse
+                self._record_usage(messages, text, usage)
+                return text
+
+    def stream(self, messages, max_tokens=2048, temperature=0.1, json_mode=True):
+        """
+        Réponse en flux (morceaux de texte). Les erreurs transitoires ne sont retentées
+        qu'avant le premier morceau reçu, pour ne jamais dupliquer du texte déjà émis.
+        """
+        self._count("requests")
+        for attempt in range(self.max_attempts):
+            self._count("attempts")
+            started = False
+            received = 0
+            try:
+                for piece in self.backend.stream(messages, max_tokens, temperature, json_mode):
+                    started = True
+                    received += len(piece)
+                    yield piece
+            except Exception as e:
+                if started or not is_transient(e) or attempt == self.max_attempts - 1:
+                    self._count("failures")
+                    raise
+                self._count("retries")
+                time.sleep(self._backoff(attempt))
+            else:
+                self._record_usage(messages, None, None, completion_chars=received)
+                return
+
+    async def acomplete(self, messages, max_tokens=2048, temperature=0.1, json_mode=True, budget=None):
+        """Version asynchrone de `complete` (même budget, mêmes tentatives, même couverture)."""
+        self._count("requests")
+        loop = asyncio.get_running_loop()
+        deadline = loop.time() + (budget or self.latency_budget)
+
+        def call():
+            return self.backend.complete(messages, max_tokens, temperature, json_mode)
+
+        async def hedged_attempt():
+            self._count("attempts")
+            first = loop.run_in_executor(self._pool, call)
+            tasks = {first}
+            if self.hedge_after is not None:
+                done, _ = await asyncio.wait(tasks, timeout=min(self.hedge_after, max(0.0, deadline - loop.time())))
+                if not done and loop.time() < deadline:
+                    self._count("hedges")
+                    tasks.add(loop.run_in_executor(self._pool, call))
+            errors = []
+            while tasks:
+                remaining = deadline - loop.time()
+                if remaining <= 0:
+                    raise BudgetExceededError("Budget de latence dépassé.")
+                done, tasks = await asyncio.wait(tasks, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is not first:
+                            self._count("hedge_wins")
+                        return task.result()
+                    errors.append(task.exception())
+            raise errors[0]
+
+        for attempt in range(self.max_attempts):
+            try:
+                text, usage = await hedged_attempt()
+            except BudgetExceededError:
+                self._count("failures")
+                raise
+            except Exception as e:
+                delay = self._backoff(attempt)
+                if not is_transient(e) or attempt == self.max_attempts - 1 or loop.time() + delay >= deadline:
+                    self._count("failures")
+                    raise
+                self._count("retries")
+                await asyncio.sleep(delay)
+            else:
+                self._record_usage(messages, text, usage)
+                return text
+
+
+_services = {}
+_services_lock = threading.Lock()
+
+
+def create_backend(name, model_id=None, token=None):
+    if name == "hf":
+        return HuggingFaceBackend(model_id, token)
+    if name == "ollama":
+        return OllamaBackend()
+    if name == "stub":
+        return StubBackend()
+    raise ValueError(f"Backend d'inférence inconnu : {name}")
+
+
+def get_inference_service(model_id=None, token=None, backend=None):
+    """Service partagé par le processus (un client persistant par backend)."""
+    name = backend or BACKEND
+    with _services_lock:
+        if name not in _services:
+            _services[name] = InferenceService(create_backend(name, model_id=model_id, token=token))
+        return _services[name]
+
+
+def discard_inference_service(backend=None):
+    """Oublie le service d'un backend : il sera recréé (nouvelle configuration) au prochain appel."""
+    with _services_lock:
+        _services.pop(backend or BACKEND, None)
+
+
+def set_inference_service(service, backend=None):
+    """Remplace le service d'un backend (tests, bancs d'essai avec un `StubBackend`)."""
+    with _services_lock:
+        _services[backend or BACKEND] = service
@@ -0,0 +1,451 @@
+# microflow_ai/extractor/layout_parser.py
+# Parseur déterministe par "gabarits" fournisseurs, exécuté avant le LLM.
+#
+# Un gabarit est appris à partir d'une extraction LLM réussie : on retrouve dans la mise
+# en page (mots + positions PyMuPDF) les lignes d'articles renvoyées par le modèle, ce qui
+# donne la position des colonnes, les libellés des champs d'en-tête et des totaux, et une
+# signature (mots fixes de l'en-tête du fournisseur). Les devis suivants du même fournisseur
+# sont alors lus directement, sans appel au modèle, si leurs totaux se recoupent.
+
+import os
+import re
+import json
+import hashlib
+import threading
+from datetime import datetime
+
+from monitoring.metrics import annotate, instrument
+
+# --- Configuration ---
+TEMPLATES_DIR = "supplier_templates"
+SIGNATURE_BAND = 0.25           # Part haute de la première page utilisée pour la signature
+SIGNATURE_MIN_WORDS = 3
+SIGNATURE_MAX_WORDS = 30
+SIGNATURE_MATCH_RATIO = 0.8     # Part des mots de la signature qui doivent être présents
+ROW_TOLERANCE = 3.0             # Écart vertical (pt) entre deux mots d'une même ligne
+COLUMN_PADDING = 20.0           # Marge (pt) autour des colonnes numériques apprises
+COLUMN_MATCH_TOLERANCE = 20.0   # Écart max. (pt) entre les centres de colonnes de deux gabarits fusionnés
+FIELD_GAP = 15.0                # Un écart horizontal plus grand termine la valeur d'un champ
+CONTINUATION_GAP = 14.0         # Écart vertical max. pour une suite de description
+MIN_MATCHED_LINES = 2
+
+NUMERIC_FIELDS = ("quantite", "prix_unitaire_ht", "total_ligne_ht")
+HEADER_FIELDS = ("nom_client", "date_devis", "numero_devis")
+TOTAL_FIELDS = ("total_ht", "total_ttc")
+
+_NUMBER_CHARS = re.compile(r"[€\s\xa0 ]|EUR", re.IGNORECASE)
+_NUMBER_RE = re.compile(r"^-?\d+(?:[.,]\d+)?$")
+
+
+# --- Outils ---
+def parse_number(text):
+    """Convertit "1 234,56 €", "1.234,56" ou "8.50" en float. Retourne None sinon."""
+    if text is None:
+        return None
+    s = _NUMBER_CHARS.sub("", str(text))
+    if "," in s and "." in s:
+        # Le dernier séparateur est le séparateur décimal
+        if s.rfind(",") > s.rfind("."):
+            s = s.replace(".", "").replace(",", ".")
+        else:
+            s = s.replace(",", "")
+    else:
+        s = s.replace(",", ".")
+    if not _NUMBER_RE.match(s):
+        return None
+    return float(s)
+
+
+def _as_number(value):
+    if isinstance(value, (int, float)):
+        return float(value)
+    return parse_number(value)
+
+
+def _same_number(a, b):
+    return a is not None and b is not None and abs(a - b) < 0.005
+
+
+def _normalize(text):
+    return " ".join(str(text).lower().split())
+
+
+def group_rows(words):
+    """Regroupe les mots (x0, y0, x1, y1, mot) en lignes visuelles, triées de haut en bas."""
+    rows = []
+    for w in sorted(words, key=lambda w: ((w[1] + w[3]) / 2, w[0])):
+        yc = (w[1] + w[3]) / 2
+        if rows and abs(rows[-1]["yc"] - yc) <= ROW_TOLERANCE:
+            rows[-1]["words"].append(w)
+        else:
+            rows.append({"yc": yc, "words": [w]})
+    for row in rows:
+        row["words"].sort(key=lambda w: w[0])
+    return rows
+
+
+def _row_text(words):
+    return " ".join(w[4] for w in words)
+
+
+def _signature_words(page):
+    limit = page["height"] * SIGNATURE_BAND
+    return {
+        w[4].lower() for w in page["words"]
+        if w[3] <= limit and len(w[4]) >= 3 and w[4].isalpha()
+    }
+
+
+def _words_after_label(words, label_words):
+    """Mots qui suivent le libellé sur la ligne, jusqu'au premier grand écart horizontal."""
+    n = len(label_words)
+    tokens = [w[4].lower().rstrip(":") for w in words]
+    for i in range(len(tokens) - n + 1):
+        if tokens[i:i + n] == label_words:
+            value = []
+            last_x1 = words[i + n - 1][2]
+            for w, token in zip(words[i + n:], tokens[i + n:]):
+                if value and w[0] - last_x1 > FIELD_GAP:
+                    break
+                if token:  # On saute les ":" isolés
+                    value.append(w)
+                last_x1 = w[2]
+            return value
+    return None
+
+
+# --- Apprentissage ---
+def _find_value_label(rows, value, numeric):
+    """Cherche la valeur dans la page et retourne les mots qui la précèdent (son libellé)."""
+    for row in rows:
+        words = row["words"]
+        for i, w in enumerate(words):
+            if numeric:
+                hit = _same_number(parse_number(w[4]), value)
+                n = 1
+            else:
+                target = _normalize(value).split()
+                n = len(target)
+                hit = bool(target) and [x[4].lower() for x in words[i:i + n]] == target
+            if hit and i > 0:
+                label = [x[4].lower().rstrip(":") for x in words[:i] if parse_number(x[4]) is None]
+                label = [x for x in label if x]
+                if label:
+                    return label[-4:]
+    return None
+
+
+def _match_item_row(rows, item, used):
+    """Ligne visuelle contenant la quantité, le prix unitaire et le total d'un article."""
+    targets = {f: _as_number(item.get(f)) for f in NUMERIC_FIELDS}
+    if any(v is None for v in targets.values()):
+        return None
+    for index, row in enumerate(rows):
+        if index in used:
+            continue
+        positions = {}
+        # Les colonnes numériques sont cherchées de droite à gauche (total, prix, quantité)
+        right_limit = float("inf")
+        for field in reversed(NUMERIC_FIELDS):
+            found = None
+            for w in reversed(row["words"]):
+                if w[2] <= right_limit and _same_number(parse_number(w[4]), targets[field]):
+                    found = w
+                    break
+            if found is None:
+                break
+            positions[field] = found
+            right_limit = found[0]
+        if len(positions) == len(NUMERIC_FIELDS):
+            used.add(index)
+            return row, positions
+    return None
+
+
+def learn_template(layout, structured_data):
+    """
+    Construit un gabarit à partir d'une extraction LLM réussie. Retourne None si la mise en
+    page ne permet pas de retrouver assez de lignes ou le total HT.
+    """
+    if not layout or not structured_data:
+        return None
+    items = [i for i in structured_data.get("lignes_articles") or [] if isinstance(i, dict)]
+    spans = {f: [] for f in NUMERIC_FIELDS}
+    desc_x0 = []
+    item_words = set()
+    matched = 0
+    rows_by_page = [group_rows(page["words"]) for page in layout]
+    used_by_page = [set() for _ in layout]
+    for item in items:
+        for rows, used in zip(rows_by_page, used_by_page):
+            found = _match_item_row(rows, item, used)
+            if found:
+                row, positions = found
+                item_words.update(w[4].lower() for w in row["words"])
+                for field, w in positions.items():
+                    spans[field].append((w[0], w[2]))
+                left = min(w[0] for w in positions.values())
+                desc = [w for w in row["words"] if w[2] <= left]
+                if desc:
+                    desc_x0.append(desc[0][0])
+                matched += 1
+                break
+    if matched < max(MIN_MATCHED_LINES, len(items) // 2):
+        return None
+
+    # Le client et les articles changent d'un devis à l'autre : ils ne font pas partie de la signature
+    signature = _signature_words(layout[0]) - item_words
+    for field in HEADER_FIELDS:
+        signature -= set(_normalize(structured_data.get(field) or "").split())
+    if len(signature) < SIGNATURE_MIN_WORDS:
+        return None
+
+    columns = {f: [min(s[0] for s in spans[f]), max(s[1] for s in spans[f])] for f in NUMERIC_FIELDS}
+    ordered = sorted(NUMERIC_FIELDS, key=lambda f: columns[f][0])
+    for left, right in zip(ordered, ordered[1:]):
+        middle = (columns[left][1] + columns[right][0]) / 2
+        columns[left][1] = max(columns[left][1], middle)
+        columns[right][0] = min(columns[right][0], middle)
+    columns[ordered[0]][0] -= COLUMN_PADDING
+    columns[ordered[-1]][1] += COLUMN_PADDING
+
+    all_rows = [row for rows in rows_by_page for row in rows]
+    labels = {}
+    for field in TOTAL_FIELDS:
+        value = _as_number(structured_data.get(field))
+        if value is not None:
+            labels[field] = _find_value_label(reversed(all_rows), value, numeric=True)
+    for field in HEADER_FIELDS:
+        value = structured_data.get(field)
+        if value:
+            labels[field] = _find_value_label(all_rows, value, numeric=False)
+    if not labels.get("total_ht"):
+        return None
+
+    return {
+        "id": hashlib.sha1(" ".join(sorted(signature)).encode("utf-8")).hexdigest()[:12],
+        "signature": sorted(signature)[:SIGNATURE_MAX_WORDS],
+        "columns": columns,
+        "description_x0": min(desc_x0) - COLUMN_PADDING if desc_x0 else 0.0,
+        "labels": {k: v for k, v in labels.items() if v},
+        "learned_lines": matched,
+        "updated_at": datetime.now().isoformat(timespec="seconds"),
+    }
+
+
+# --- Lecture avec un gabarit ---
+def signature_score(template, layout):
+    signature = set(template.get("signature") or [])
+    if not signature or not layout:
+        return 0.0
+    return len(signature & _signature_words(layout[0])) / len(signature)
+
+
+def same_supplier(existing, template):
+    """
+    Deux gabarits ne sont fusionnés que si leurs signatures se recouvrent dans les deux sens
+    et si leurs colonnes numériques sont au même endroit, dans le même ordre.
+    """
+    old, new = set(existing.get("signature") or []), set(template.get("signature") or [])
+    if not old or not new:
+        return False
+    common = old & new
+    if len(common) / len(old) < SIGNATURE_MATCH_RATIO or len(common) / len(new) < SIGNATURE_MATCH_RATIO:
+        return False
+    centers = {}
+    for name, t in (("old", existing), ("new", template)):
+        columns = t.get("columns") or {}
+        if any(f not in columns for f in NUMERIC_FIELDS):
+            return False
+        centers[name] = {f: (columns[f][0] + columns[f][1]) / 2 for f in NUMERIC_FIELDS}
+    if sorted(NUMERIC_FIELDS, key=centers["old"].get) != sorted(NUMERIC_FIELDS, key=centers["new"].get):
+        return False
+    return all(abs(centers["old"][f] - centers["new"][f]) <= COLUMN_MATCH_TOLERANCE for f in NUMERIC_FIELDS)
+
+
+def _column_value(words, span):
+    inside = [w for w in words if span[0] <= (w[0] + w[2]) / 2 <= span[1]]
+    return parse_number("".join(w[4] for w in inside)) if inside else None
+
+
+def parse_with_template(layout, template):
+    """Lit les lignes d'articles, l'en-tête et les totaux d'un devis avec un gabarit."""
+    columns = template["columns"]
+    numeric_left = min(span[0] for span in columns.values())
+    lines = []
+    data = {field: None for field in HEADER_FIELDS + TOTAL_FIELDS}
+    labels = template.get("labels", {})
+
+    for page in layout:
+        previous = None
+        for row in group_rows(page["words"]):
+            words = row["words"]
+            values = {f: _column_value(words, columns[f]) for f in NUMERIC_FIELDS}
+            desc_words = [w for w in words if w[2] <= numeric_left and w[0] >= template.get("description_x0", 0)]
+            description = _row_text(desc_words)
+            if all(v is not None for v in values.values()) and description:
+                line = {"description": description}
+                line.update(values)
+                lines.append(line)
+                previous = (line, row["yc"])
+                continue
+            # Description sur plusieurs lignes : suite directe, sans aucune valeur numérique
+            if (previous and description and len(desc_words) == len(words)
+                    and row["yc"] - previous[1] <= CONTINUATION_GAP):
+                previous[0]["description"] += " " + description
+                previous = (previous[0], row["yc"])
+                continue
+            previous = None
+
+            for field in TOTAL_FIELDS + HEADER_FIELDS:
+                label = labels.get(field)
+                if not label or (data[field] is not None and field in HEADER_FIELDS):
+                    continue
+                value_words = _words_after_label(words, label)
+                if not value_words:
+                    continue
+                if field in TOTAL_FIELDS:
+                    numbers = [parse_number(w[4]) for w in value_words]
+                    numbers = [n for n in numbers if n is not None]
+                    if numbers:
+                        data[field] = numbers[-1]
+                else:
+                    data[field] = _row_text(value_words)
+
+    data["lignes_articles"] = lines
+    return data
+
+
+def totals_reconcile(data):
+    """Vérifie quantité x prix = total de ligne et somme des lignes = total HT."""
+    lines = data.get("lignes_articles") or []
+    total_ht = _as_number(data.get("total_ht"))
+    if not lines or total_ht is None:
+        return False
+    line_sum = 0.0
+    for line in lines:
+        q, pu, t = (_as_number(line.get(f)) for f in NUMERIC_FIELDS)
+        if None in (q, pu, t) or abs(q * pu - t) > 0.011 + 0.005 * abs(t):
+            return False
+        line_sum += t
+    return abs(line_sum - total_ht) <= max(0.02, 0.0005 * abs(total_ht))
+
+
+# --- Stockage des gabarits ---
+class TemplateStore:
+    """Gabarits fournisseurs stockés en JSON (un fichier par gabarit)."""
+
+    def __init__(self, templates_dir=TEMPLATES_DIR):
+        self.templates_dir = templates_dir
+        self._lock = threading.Lock()
+        self._templates = None
+        os.makedirs(self.templates_dir, exist_ok=True)
+
+    def all(self):
+        with self._lock:
+            if self._templates is None:
+                self._templates = {}
+                for name in sorted(os.listdir(self.templates_dir)):
+                    if not name.endswith(".json"):
+                        continue
+                    try:
+                        with open(os.path.join(self.templates_dir, name), "r", encoding="utf-8") as f:
+                            template = json.load(f)
+                        self._templates[template["id"]] = template
+                    except (OSError, ValueError, KeyError) as e:
+                        print(f"AVERTISSEMENT: Gabarit illisible {name} : {e}")
+            return list(self._templates.values())
+
+    def best_match(self, layout):
+        best, best_score = None, 0.0
+        for template in self.all():
+            score = signature_score(template, layout)
+            if score > best_score:
+                best, best_score = template, score
+        return best if best_score >= SIGNATURE_MATCH_RATIO else None
+
+    def save(self, template):
+        self.all()
+        path = os.path.join(self.templates_dir, f"{template['id']}.json")
+        tmp_path = f"{path}.tmp"
+        with self._lock:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(template, f, ensure_ascii=False, indent=2)
+            os.replace(tmp_path, path)
+            self._templates[template["id"]] = template
+
+    def delete(self, template_id):
+        self.all()
+        with self._lock:
+            self._templates.pop(template_id, None)
+            path = os.path.join(self.templates_dir, f"{template_id}.json")
+            if os.path.exists(path):
+                os.remove(path)
+
+
+_default_store = None
+
+
+def get_template_store():
+    global _default_store
+    if _default_store is None:
+        _default_store = TemplateStore()
+    return _default_store
+
+
+# --- Points d'entrée ---
+@instrument("layout_fast_path")
+def try_fast_path(layout, store=None):
+    """
+    Lecture directe d'un devis d'un fournisseur connu. Retourne le JSON structuré, ou None
+    si aucun gabarit ne correspond ou si les totaux ne se recoupent pas (il faut alors le LLM).
+    """
+    if not layout:
+        return None
+    store = store or get_template_store()
+    template = store.best_match(layout)
+    if template is None:
+        return None
+    try:
+        data = parse_with_template(layout, template)
+    except Exception as e:
+        print(f"AVERTISSEMENT: Échec du gabarit {template['id']} : {e}")
+        return None
+    if not totals_reconcile(data):
+        print(f"INFO: Gabarit {template['id']} reconnu mais totaux incohérents, appel au LLM.")
+        return None
+    data["_gabarit"] = template["id"]
+    annotate(template_hits=1)
+    print(f"SUCCÈS: Devis lu avec le gabarit {template['id']} ({len(data['lignes_articles'])} lignes), sans LLM.")
+    return data
+
+
+def learn_from_extraction(layout, structured_data, store=None):
+    """
+    Enregistre (ou met à jour) le gabarit du fournisseur après une extraction LLM réussie.
+    Le gabarit n'est conservé que s'il relit ce même devis avec des totaux cohérents.
+    """
+    try:
+        template = learn_template(layout, structured_data)
+        if template is None or not totals_reconcile(parse_with_template(layout, template)):
+            return None
+    except Exception as e:
+        print(f"AVERTISSEMENT: Apprentissage du gabarit impossible : {e}")
+        return None
+    store = store or get_template_store()
+    existing = store.best_match(layout)
+    if existing is not None and same_supplier(existing, template):
+        # Même fournisseur : on ne garde que les mots communs aux deux signatures
+        common = set(existing["signature"]) & set(template["signature"])
+        if len(common) >= SIGNATURE_MIN_WORDS:
+            template["signature"] = sorted(common)
+        if existing["id"] != template["id"]:
+            store.delete(existing["id"])
+        template["id"] = existing["id"]
+    elif any(t["id"] == template["id"] for t in store.all()):
+        # Même signature mais autre mise en page : nouveau gabarit, l'ancien est conservé
+        geometry = json.dumps(template["columns"], sort_keys=True)
+        template["id"] = hashlib.sha1(f"{template['id']} {geometry}".encode("utf-8")).hexdigest()[:12]
+    store.save(template)
+    print(f"INFO: Gabarit fournisseur {template['id']} enregistré.")
+    return template
@@ -0,0 +1,142 @@
+# microflow_ai/extractor/llm_cache.py
+# Cache disque des extractions LLM, adressé par le contenu du devis.
+
+import os
+import re
+import json
+import time
+import hashlib
+import threading
+
+# --- Configuration ---
+CACHE_DIR = os.path.join("cache", "llm")
+MAX_ENTRIES = 2000                  # Nombre maximal de devis gardés en cache
+MAX_BYTES = 200 * 1024 * 1024       # Taille maximale du cache sur disque (200 Mo)
+MAX_AGE_SECONDS = 30 * 24 * 3600    # Une entrée expire au bout de 30 jours
+
+
+def normalize_text(text):
+    """Normalise le texte extrait pour que deux extractions du même PDF donnent la même clé."""
+    text = (text or "").replace("\r\n", "\n").replace("\r", "\n")
+    lines = (re.sub(r"[ \t\f\v\xa0]+", " ", line).strip() for line in text.split("\n"))
+    return "\n".join(line for line in lines if line)
+
+
+def make_cache_key(text, model_id, prompt_version):
+    """Clé SHA-256 du texte normalisé, du modèle et de la version du prompt."""
+    h = hashlib.sha256()
+    for part in (model_id, prompt_version, normalize_text(text)):
+        h.update(str(part).encode("utf-8"))
+        h.update(b"\x00")
+    return h.hexdigest()
+
+
+class LLMCache:
+    """
+    Cache disque clé -> JSON structuré, avec éviction par âge et par taille
+    (les entrées les moins récemment utilisées partent en premier).
+    """
+
+    def __init__(self, cache_dir=CACHE_DIR, max_entries=MAX_ENTRIES, max_bytes=MAX_BYTES, max_age=MAX_AGE_SECONDS):
+        self.cache_dir = cache_dir
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(self.cache_dir, exist_ok=True)
+
+    def _path(self, key):
+        return os.path.join(self.cache_dir, f"{key}.json")
+
+    def get(self, key):
+        """Retourne le JSON en cache pour cette clé, ou None (entrée absente, expirée ou illisible)."""
+        path = self._path(key)
+        try:
+            if self.max_age and time.time() - os.path.getmtime(path) > self.max_age:
+                os.remove(path)
+                raise FileNotFoundError(path)
+            with open(path, "r", encoding="utf-8") as f:
+                data = json.load(f)
+            os.utime(path)  # On rafraîchit la date d'accès pour l'éviction LRU
+        except (OSError, ValueError):
+            with self._lock:
+                self.misses += 1
+            return None
+        with self._lock:
+            self.hits += 1
+        return data
+
+    def set(self, key, data):
+        """Écrit l'entrée de manière atomique puis applique l'éviction."""
+        path = self._path(key)
+        tmp_path = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmp_path, "w", encoding="utf-8") as f:
+                json.dump(data, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+        except OSError as e:
+            print(f"AVERTISSEMENT: Écriture du cache impossible : {e}")
+            if os.path.exists(tmp_path):
+                os.remove(tmp_path)
+            return
+        self.evict()
+
+    def evict(self):
+        """Supprime les entrées expirées, puis les plus anciennes tant que les limites sont dépassées."""
+        with self._lock:
+            now = time.time()
+            entries = []
+            for name in os.listdir(self.cache_dir):
+                if not name.endswith(".json"):
+                    continue
+                path = os.path.join(self.cache_dir, name)
+                try:
+                    info = os.stat(path)
+                except OSError:
+                    continue
+                if self.max_age and now - info.st_mtime > self.max_age:
+                    self._remove(path)
+                    continue
+                entries.append((info.st_mtime, info.st_size, path))
+
+            entries.sort()
+            total_bytes = sum(size for _, size, _ in entries)
+            while entries and (len(entries) > self.max_entries or total_bytes > self.max_bytes):
+                _, size, path = entries.pop(0)
+                self._remove(path)
+                total_bytes -= size
+
+    def _remove(self, path):
+        try:
+            os.remove(path)
+            self.evictions += 1
+        except OSError:
+            pass
+
+    def clear(self):
+        for name in os.listdir(self.cache_dir):
+            if name.endswith(".json"):
+                self._remove(os.path.join(self.cache_dir, name))
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / total if total else 0.0,
+        }
+
+
+_default_cache = None
+
+
+def get_cache():
+    """Instance partagée par le processus (créée à la première utilisation)."""
+    global _default_cache
+    if _default_cache is None:
+        _default_cache = LLMCache()
+    return _default_cache
@@ -2,47 +2,170 @@
 
 import os
 import json
-import fitz
-import streamlit as st
-from huggingface_hub import InferenceClient
+import re
+from concurrent.futures import ProcessPoolExecutor
+from extractor.inference import BACKEND, discard_inference_service, get_inference_service, model_key
+from extractor.llm_cache import get_cache, make_cache_key
+from extractor.stream_parser import IncrementalQuoteParser
+from monitoring.metrics import annotate, instrument
+
+# Module sans interface : ni Streamlit ni secrets lus à l'import. L'application (ou tout autre
+# appelant) transmet la configuration avec `configure()` ; à défaut, l'environnement est utilisé.
+# PyMuPDF n'est chargé qu'à la première ouverture d'un PDF.
 
 # --- Configuration ---
-HF_TOKEN = None
+HF_TOKEN = os.environ.get("HUGGINGFACE_API_KEY")
 MODEL_ID = "Qwen/Qwen3-Next-80B-A3B-Instruct"  # Modèle puissant pour les tâches de chat
+PROMPT_VERSION = "v1"  # À incrémenter à chaque modification du prompt (invalide le cache)
+PAGE_SEPARATOR = "\f"  # Séparateur de pages dans le texte extrait
+PARALLEL_MIN_PAGES = 40  # En mode automatique, extraction multi-processus à partir de ce nombre de pages
+PAGES_PER_TASK = 16      # Pages par tranche confiée à un processus
+TOTALS_BLOCK_RE = re.compile(r"total\s*t\.?t\.?c|net\s+[àa]\s+payer", re.IGNORECASE)
 
-try:
-    if "HUGGINGFACE_API_KEY" in st.secrets:
-        HF_TOKEN = st.secrets["HUGGINGFACE_API_KEY"]
-        print("INFO: Clé API HF trouvée. Mode en ligne activé.")
-    else:
-        st.error("ERREUR DE CONFIGURATION : Clé API Hugging Face non trouvée.")
-except (FileNotFoundError, KeyError):
-    print("INFO: Lancement en local (le service IA en ligne ne fonctionnera pas).")
+def configure(hf_token=None):
+    """
+    Configuration explicite du service IA (ex. clé lue dans les secrets Streamlit par l'app).
+    Retourne True si le service en ligne est utilisable.
+    """
+    global HF_TOKEN
+    if hf_token and hf_token != HF_TOKEN:
+        HF_TOKEN = hf_token
+        discard_inference_service("hf")  # Le client existant utilisait l'ancienne clé
+        print("INFO: Clé API HF configurée. Mode en ligne activé.")
+    return BACKEND != "hf" or bool(HF_TOKEN)
 
 # --- Fonctions ---
-def extract_text_from_pdf(pdf_path):
-    if not os.path.exists(pdf_path):
-        print(f"ERREUR: Fichier non trouvé : {pdf_path}")
-        return None
+def _open_pdf(pdf_source):
+    """Ouvre un PDF depuis un chemin, des octets ou un tampon (BytesIO, fichier importé Streamlit)."""
+    import fitz
+
+    if isinstance(pdf_source, (str, os.PathLike)):
+        return fitz.open(pdf_source)
+    if isinstance(pdf_source, (bytes, bytearray, memoryview)):
+        return fitz.open(stream=bytes(pdf_source), filetype="pdf")
+    if hasattr(pdf_source, "getvalue"):
+        return fitz.open(stream=pdf_source.getvalue(), filetype="pdf")
+    return fitz.open(stream=pdf_source.read(), filetype="pdf")
+
+def _as_source(pdf_source):
+    """Chemin ou octets : forme réutilisable (plusieurs ouvertures) et transmissible à un autre processus."""
+    if isinstance(pdf_source, (str, os.PathLike, bytes)):
+        return pdf_source
+    if isinstance(pdf_source, (bytearray, memoryview)):
+        return bytes(pdf_source)
+    if hasattr(pdf_source, "getvalue"):
+        return pdf_source.getvalue()
+    return pdf_source.read()
+
+def _page_layout(page):
+    # Mots et positions (x0, y0, x1, y1, mot) de la page, pour le parseur par gabarit
+    return {
+        "width": page.rect.width,
+        "height": page.rect.height,
+        "words": [tuple(w[:5]) for w in page.get_text("words", sort=True)],
+    }
+
+def totals_block_found(page_text):
+    """Critère d'arrêt anticipé : la page contient le bloc des totaux du devis."""
+    return bool(TOTALS_BLOCK_RE.search(page_text))
+
+def iter_pages(pdf_source, pages=None, with_layout=False, stop_when=None):
+    """
+    Générateur paresseux : (numéro de page, texte, mise en page ou None), une page à la fois.
+    `pages` : numéros de pages (à partir de 0) à lire, dans l'ordre ; toutes par défaut.
+    `stop_when(texte_de_page)` : la lecture s'arrête après la première page qui le vérifie.
+    """
+    doc = _open_pdf(pdf_source)
     try:
-        doc = fitz.open(pdf_path)
-        text = "".join(page.get_text("text", sort=True) for page in doc)
+        numbers = range(len(doc)) if pages is None else [n for n in pages if 0 <= n < len(doc)]
+        for number in numbers:
+            page = doc[number]
+            text = page.get_text("text", sort=True)
+            yield number, text, _page_layout(page) if with_layout else None
+            if stop_when is not None and stop_when(text):
+                return
+    finally:
         doc.close()
+
+def _extract_page_batch(pdf_source, numbers, with_layout, stop_when):
+    """Exécuté dans un processus séparé : une tranche de pages."""
+    return list(iter_pages(pdf_source, numbers, with_layout, stop_when))
+
+def extract_pages_parallel(pdf_source, pages=None, with_layout=False, stop_when=None, workers=None):
+    """
+    Extraction des pages par tranches, réparties sur plusieurs processus. Les tranches sont
+    relues dans l'ordre : dès qu'une page vérifie `stop_when`, les tranches suivantes sont
+    abandonnées. `stop_when` doit être une fonction de module (transmise aux processus).
+    Retourne la liste des (numéro de page, texte, mise en page ou None).
+    """
+    source = _as_source(pdf_source)
+    if pages is None:
+        with _open_pdf(source) as doc:
+            pages = range(len(doc))
+    numbers = list(pages)
+    batches = [numbers[i:i + PAGES_PER_TASK] for i in range(0, len(numbers), PAGES_PER_TASK)]
+    if not batches:
+        return []
+
+    results = []
+    pool = ProcessPoolExecutor(max_workers=max(1, min(workers or os.cpu_count() or 1, len(batches))))
+    try:
+        futures = [pool.submit(_extract_page_batch, source, batch, with_layout, stop_when) for batch in batches]
+        for future in futures:
+            batch_pages = future.result()
+            results.extend(batch_pages)
+            if stop_when is not None and batch_pages and stop_when(batch_pages[-1][1]):
+                break
+    finally:
+        pool.shutdown(wait=True, cancel_futures=True)
+    return results
+
+@instrument("pdf_extraction")
+def _read_pdf(pdf_source, with_layout=False, pages=None, stop_when=None, workers=1):
+    if isinstance(pdf_source, (str, os.PathLike)) and not os.path.exists(pdf_source):
+        print(f"ERREUR: Fichier non trouvé : {pdf_source}")
+        return None, None
+    try:
+        source = _as_source(pdf_source)
+        # `pages` peut être un générateur : lu une seule fois ici
+        pages = None if pages is None else list(pages)
+        if workers is None:
+            # Mode automatique (ligne de commande et lots) : plusieurs processus seulement pour les gros documents
+            with _open_pdf(source) as doc:
+                page_count = len(doc) if pages is None else len(pages)
+            workers = (os.cpu_count() or 1) if page_count >= PARALLEL_MIN_PAGES else 1
+        if workers > 1:
+            extracted = extract_pages_parallel(source, pages, with_layout, stop_when, workers)
+        else:
+            extracted = list(iter_pages(source, pages, with_layout, stop_when))
+        # Les pages sont séparées par un saut de page pour permettre le découpage par morceaux
+        text = PAGE_SEPARATOR.join(page_text for _, page_text, _ in extracted)
+        layout = [page_layout for _, _, page_layout in extracted] if with_layout else None
+        annotate(pages=len(extracted), chars=len(text))
         print("SUCCÈS: Texte brut extrait du PDF.")
-        return text
+        return text, layout
     except Exception as e:
+        annotate(failures=1)
         print(f"ERREUR LECTURE PDF: {e}")
-        return None
+        return None, None
 
-def structure_data_with_llm(text_content):
-    if not HF_TOKEN:
-        st.error("Le service IA n'est pas configuré (clé API manquante).")
-        return None
+def extract_text_from_pdf(pdf_source, pages=None, stop_when=None, workers=1):
+    """
+    `pdf_source` : chemin, octets ou tampon contenant le PDF. `pages`, `stop_when` : voir
+    `iter_pages` ; `workers` : processus d'extraction (None : automatique selon la taille).
+    """
+    return _read_pdf(pdf_source, pages=pages, stop_when=stop_when, workers=workers)[0]
 
-    print(f"INFO: Appel API HF avec la tâche 'chat' (Modèle: {MODEL_ID})...")
-    
+def extract_text_and_layout(pdf_source, pages=None, stop_when=None, workers=1):
+    """
+    Retourne (texte brut, mise en page mot à mot), lus ensemble page par page. Avec
+    `workers=1`, le PDF est lu dans le processus courant ; sinon voir `extract_text_from_pdf`.
+    """
+    return _read_pdf(pdf_source, with_layout=True, pages=pages, stop_when=stop_when, workers=workers)
+
+def build_prompt(text_content):
     # Le prompt demande explicitement un JSON structuré
-    prompt = f"""
+    return f"""
     Tu es un assistant expert en extraction de données. Analyse le texte de devis suivant et retourne UNIQUEMENT un objet JSON valide et complet.
 
     Règles:
@@ -56,32 +179,88 @@ def structure_data_with_llm(text_content):
     {text_content[:4000]} 
     ---
     """
-    
-    # On formate la requête pour la tâche 'chat_completion'
-    messages = [{"role": "user", "content": prompt}]
-    
-    try:
-        client = InferenceClient(token=HF_TOKEN, timeout=180) # Timeout plus long pour les gros modèles
-
-        # ON UTILISE LA BONNE MÉTHODE : chat_completion
-        response = client.chat_completion(
-            messages=messages,
-            model=MODEL_ID,
-            max_tokens=2048,
-            temperature=0.1,
-            response_format={"type": "json_object"}, 
-        )
-        
-        # Avec chat_completion, la réponse n'est pas un stream par défaut et est directement accessible
-        generated_text = response.choices[0].message.content
-        
-        print("SUCCÈS: Réponse reçue de l'API via chat_completion.")
-        
-        # Le 'response_format' devrait nous garantir un JSON, mais on vérifie quand même.
-        return json.loads(generated_text)
 
+class LLMConfigurationError(RuntimeError):
+    """Le service IA n'est pas configuré (clé API manquante)."""
+
+def _inference_service():
+    if BACKEND == "hf" and not HF_TOKEN:
+        raise LLMConfigurationError("Clé API Hugging Face manquante.")
+    return get_inference_service(model_id=MODEL_ID, token=HF_TOKEN)
+
+def active_model_key():
+    """Backend et modèle actifs, qui entrent dans les clés du cache LLM et de l'index de similarité."""
+    if BACKEND == "hf" and not HF_TOKEN:
+        return model_key(BACKEND, MODEL_ID)
+    return _inference_service().model_key
+
+@instrument("llm")
+def request_structured_data(text_content, use_cache=True):
+    """
+    Appel LLM brut, sans interface : retourne le JSON structuré ou lève une exception.
+    Utilisable depuis des threads de travail (extraction par morceaux, traitement par lots).
+    """
+    # Un devis déjà analysé (même texte, même modèle, même prompt) est servi depuis le cache disque
+    cache_key = make_cache_key(text_content, active_model_key(), PROMPT_VERSION)
+    if use_cache:
+        cached = get_cache().get(cache_key)
+        annotate(cache_hits=int(cached is not None), cache_misses=int(cached is None))
+        if cached is not None:
+            print("SUCCÈS: Données structurées servies depuis le cache.")
+            return cached
+
+    print(f"INFO: Appel au service IA (modèle: {active_model_key()})...")
+    messages = [{"role": "user", "content": build_prompt(text_content)}]
+
+    # Client persistant, budget de latence, nouvelles tentatives et couverture : voir extractor/inference.py
+    generated_text = _inference_service().complete(messages, max_tokens=2048, temperature=0.1, json_mode=True)
+    print("SUCCÈS: Réponse reçue du service IA.")
+
+    # Le 'response_format' devrait nous garantir un JSON, mais on vérifie quand même.
+    structured_data = json.loads(generated_text)
+    if use_cache:
+        get_cache().set(cache_key, structured_data)
+    return structured_data
+
+@instrument("llm")
+def request_structured_data_stream(text_content, on_line=None, use_cache=True):
+    """
+    Variante en flux de `request_structured_data` : `on_line(ligne)` est appelé pour chaque
+    ligne d'article dès qu'elle est complète. Si le flux est coupé après au moins une ligne,
+    le résultat partiel est retourné (clé "_flux_interrompu") au lieu de lever l'erreur.
+    """
+    cache_key = make_cache_key(text_content, active_model_key(), PROMPT_VERSION)
+    if use_cache:
+        cached = get_cache().get(cache_key)
+        annotate(cache_hits=int(cached is not None), cache_misses=int(cached is None))
+        if cached is not None:
+            print("SUCCÈS: Données structurées servies depuis le cache.")
+            if on_line:
+                for line in cached.get('lignes_articles') or []:
+                    on_line(line)
+            return cached
+
+    service = _inference_service()
+    print(f"INFO: Appel au service IA en flux (modèle: {active_model_key()})...")
+    messages = [{"role": "user", "content": build_prompt(text_content)}]
+    parser = IncrementalQuoteParser()
+
+    try:
+        for piece in service.stream(messages, max_tokens=2048, temperature=0.1, json_mode=True):
+            for line in parser.feed(piece):
+                if on_line:
+                    on_line(line)
     except Exception as e:
-        print(f"ERREUR (Hugging Face): {e}")
-        st.error(f"Erreur de communication avec le service IA. Détails de l'erreur ci-dessous.")
-        st.exception(e) # Affiche l'erreur complète dans l'interface Streamlit pour le débogage
-        return None
\ No newline at end of file
+        if not parser.lines:
+            raise
+        print(f"AVERTISSEMENT: Flux interrompu après {len(parser.lines)} ligne(s) : {e}")
+
+    structured_data = parser.result()
+    if structured_data.get('_flux_interrompu'):
+        if not parser.lines:
+            raise ValueError("Réponse du modèle incomplète ou invalide.")
+    else:
+        print("SUCCÈS: Réponse reçue de l'API en flux.")
+        if use_cache:
+            get_cache().set(cache_key, structured_data)
+    return structured_data
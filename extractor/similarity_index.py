@@ -0,0 +1,292 @@
+# microflow_ai/extractor/similarity_index.py
+# Index de similarité des devis déjà extraits (MinHash + LSH sur des bardeaux de mots).
+#
+# Un fournisseur renvoie souvent le même devis avec quelques lignes ou prix modifiés : le
+# cache exact (llm_cache.py) ne le reconnaît pas. Ici, un devis proche d'un devis déjà
+# analysé est comparé ligne à ligne avec lui ; seules les zones modifiées sont envoyées au
+# modèle, et les lignes d'articles connues sont reprises telles quelles. Le résultat n'est
+# accepté que si ses totaux se recoupent, sinon le devis est extrait en entier.
+
+import os
+import json
+import time
+import zlib
+import uuid
+import hashlib
+import difflib
+import threading
+
+import numpy as np
+
+from extractor.llm_cache import normalize_text
+from extractor.layout_parser import parse_number, totals_reconcile
+from extractor.pdf_reader import PROMPT_VERSION, active_model_key, request_structured_data
+from monitoring.metrics import annotate, instrument
+
+# --- Configuration ---
+INDEX_DIR = os.path.join("cache", "similar")
+MAX_ENTRIES = 2000
+SHINGLE_SIZE = 3                # Bardeaux de 3 mots
+NUM_PERM = 64                   # Taille de la signature MinHash
+BANDS = 16                      # LSH : 16 bandes de 4 valeurs
+SIMILARITY_THRESHOLD = 0.6      # Jaccard estimé minimal pour tenter une extraction par différence
+MAX_CHANGED_RATIO = 0.3         # Au-delà de 30 % de lignes modifiées, extraction complète
+MAX_CHANGED_REGIONS = 6         # Nombre maximal d'appels au modèle pour les zones modifiées
+HEADER_FIELDS = ("nom_client", "date_devis", "numero_devis")
+TOTALS_WORDS = ("total", "net à payer", "net a payer")
+
+_PRIME = (1 << 61) - 1
+_rng = np.random.RandomState(20240611)
+_PERM_A = _rng.randint(1, 1 << 31, size=NUM_PERM).astype(np.uint64)
+_PERM_B = _rng.randint(0, 1 << 31, size=NUM_PERM).astype(np.uint64)
+
+
+def text_lines(text):
+    return normalize_text(text).split("\n")
+
+
+def text_hash(lines):
+    """Empreinte du texte normalisé : un même devis n'est indexé qu'une fois."""
+    return hashlib.blake2b("\n".join(lines).encode("utf-8"), digest_size=16).hexdigest()
+
+
+def minhash_signature(lines):
+    """Signature MinHash (NUM_PERM entiers) des bardeaux de mots du texte."""
+    words = " ".join(lines).lower().split()
+    if len(words) < SHINGLE_SIZE:
+        words = words + [""] * (SHINGLE_SIZE - len(words))
+    shingles = {" ".join(words[i:i + SHINGLE_SIZE]) for i in range(len(words) - SHINGLE_SIZE + 1)}
+    hashes = np.fromiter((zlib.crc32(s.encode("utf-8")) for s in shingles), dtype=np.uint64, count=len(shingles))
+    return ((_PERM_A[:, None] * hashes[None, :] + _PERM_B[:, None]) % _PRIME).min(axis=1)
+
+
+def _band_keys(signature):
+    rows = NUM_PERM // BANDS
+    return [(band, signature[band * rows:(band + 1) * rows].tobytes()) for band in range(BANDS)]
+
+
+def locate_items(lines, items):
+    """
+    Ligne(s) du texte occupée(s) par chaque ligne d'article : liste de (début, fin) inclusifs,
+    ou None si un article n'est pas retrouvé (l'extraction par différence est alors impossible).
+    Un article est reconnu au début de sa description, son total pouvant être sur la ligne
+    suivante quand la description est coupée.
+    """
+    lowered = [line.lower() for line in lines]
+    numbers = [{parse_number(token) for token in line.split()} for line in lines]
+    spans, start_at = [], 0
+    for item in items:
+        description = " ".join(str(item.get("description") or "").lower().split())[:20]
+        total = item.get("total_ligne_ht")
+        total = total if isinstance(total, (int, float)) else parse_number(total)
+        span = None
+        for i in range(start_at, len(lines)):
+            if not description or description not in lowered[i]:
+                continue
+            for j in range(i, min(i + 3, len(lines))):
+                if total is None or any(n is not None and abs(n - total) < 0.005 for n in numbers[j]):
+                    span = (i, j)
+                    break
+            if span:
+                break
+        if span is None:
+            return None
+        spans.append(span)
+        start_at = span[0] + 1
+    return spans
+
+
+class SimilarityIndex:
+    def __init__(self, index_dir=INDEX_DIR, max_entries=MAX_ENTRIES, threshold=SIMILARITY_THRESHOLD):
+        self.index_dir = index_dir
+        self.max_entries = max_entries
+        self.threshold = threshold
+        self._lock = threading.Lock()
+        self._entries = {}      # id -> entrée (lignes, signature, positions des articles, données)
+        self._buckets = {}      # (bande, valeurs) -> ids
+        self._by_hash = {}      # empreinte du texte -> id
+        os.makedirs(index_dir, exist_ok=True)
+        self._load()
+
+    def _load(self):
+        # Seuls les devis extraits par le backend et le modèle actifs sont repris
+        current_model = active_model_key()
+        for file_name in os.listdir(self.index_dir):
+            if not file_name.endswith(".json"):
+                continue
+            try:
+                with open(os.path.join(self.index_dir, file_name), "r", encoding="utf-8") as f:
+                    entry = json.load(f)
+            except (OSError, ValueError):
+                continue
+            if entry.get("model_key") == current_model and entry.get("prompt_version") == PROMPT_VERSION:
+                self._insert(entry)
+
+    def _insert(self, entry):
+        entry["_signature"] = np.asarray(entry["signature"], dtype=np.uint64)
+        self._entries[entry["id"]] = entry
+        self._by_hash[text_hash(entry["lines"])] = entry["id"]
+        for key in _band_keys(entry["_signature"]):
+            self._buckets.setdefault(key, set()).add(entry["id"])
+
+    def _remove(self, entry_id):
+        entry = self._entries.pop(entry_id, None)
+        if entry is None:
+            return
+        for key in _band_keys(entry["_signature"]):
+            self._buckets.get(key, set()).discard(entry_id)
+        digest = text_hash(entry["lines"])
+        if self._by_hash.get(digest) == entry_id:
+            del self._by_hash[digest]
+        try:
+            os.remove(os.path.join(self.index_dir, f"{entry_id}.json"))
+        except OSError:
+            pass
+
+    def add(self, text, structured_data):
+        """
+        Indexe un devis extrait. Ignoré si ses articles ne sont pas retrouvés dans le texte, ou
+        si le même texte est déjà indexé (retourne alors l'id de l'entrée existante).
+        """
+        lines = text_lines(text)
+        with self._lock:
+            existing = self._by_hash.get(text_hash(lines))
+        if existing is not None:
+            return existing
+        items = structured_data.get("lignes_articles") or []
+        spans = locate_items(lines, items)
+        if spans is None:
+            return None
+        signature = minhash_signature(lines)
+        entry = {
+            "id": uuid.uuid4().hex,
+            "model_key": active_model_key(),
+            "prompt_version": PROMPT_VERSION,
+            "created_at": time.time(),
+            "signature": [int(v) for v in signature],
+            "lines": lines,
+            "item_spans": spans,
+            "data": {k: v for k, v in structured_data.items() if not k.startswith("_")},
+        }
+        tmp_path = os.path.join(self.index_dir, f"{entry['id']}.json.tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            json.dump(entry, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(self.index_dir, f"{entry['id']}.json"))
+        with self._lock:
+            self._insert(entry)
+            if len(self._entries) > self.max_entries:
+                oldest = sorted(self._entries.values(), key=lambda e: e["created_at"])
+                for old in oldest[:len(self._entries) - self.max_entries]:
+                    self._remove(old["id"])
+        return entry["id"]
+
+    def find_similar(self, lines):
+        """Devis indexé le plus proche (Jaccard estimé >= seuil) : (entrée, similarité) ou (None, 0)."""
+        signature = minhash_signature(lines)
+        current_model = active_model_key()
+        with self._lock:
+            candidates = set()
+            for key in _band_keys(signature):
+                candidates |= self._buckets.get(key, set())
+            best, best_score = None, 0.0
+            for entry_id in candidates:
+                entry = self._entries[entry_id]
+                if entry.get("model_key") != current_model:
+                    continue
+                score = float(np.mean(entry["_signature"] == signature))
+                if score > best_score:
+                    best, best_score = entry, score
+        if best_score < self.threshold:
+            return None, best_score
+        return best, best_score
+
+    def extract_delta(self, text, extract_fn=request_structured_data):
+        """
+        Extraction par différence avec le devis indexé le plus proche. Retourne le JSON
+        structuré complet, ou None si aucun devis proche n'existe ou si les modifications
+        sont trop importantes ou ambiguës (il faut alors une extraction complète).
+        """
+        lines = text_lines(text)
+        entry, score = self.find_similar(lines)
+        if entry is None:
+            return None
+
+        opcodes = difflib.SequenceMatcher(None, entry["lines"], lines, autojunk=False).get_opcodes()
+        changed = [op for op in opcodes if op[0] != "equal"]
+        changed_lines = sum(max(i2 - i1, j2 - j1) for _, i1, i2, j1, j2 in changed)
+        regions = [op for op in changed if op[0] in ("replace", "insert")]
+        if changed_lines > MAX_CHANGED_RATIO * max(len(lines), 1) or len(regions) > MAX_CHANGED_REGIONS:
+            return None
+
+        # Chaque article connu doit être soit intact, soit entièrement dans une zone modifiée
+        items = entry["data"].get("lignes_articles") or []
+        spans = entry["item_spans"]
+        for start, end in spans:
+            inside = [op for op in opcodes if op[1] <= start and end < op[2]]
+            if not inside:
+                return None
+
+        data = {k: v for k, v in entry["data"].items() if k != "lignes_articles"}
+        new_items = []
+        for tag, i1, i2, j1, j2 in opcodes:
+            if tag == "equal":
+                new_items.extend(item for item, (start, _) in zip(items, spans) if i1 <= start < i2)
+            elif tag in ("replace", "insert"):
+                region = "\n".join(lines[j1:j2])
+                part = extract_fn(region) or {}
+                new_items.extend(part.get("lignes_articles") or [])
+                for field in HEADER_FIELDS:
+                    if part.get(field) is not None:
+                        data[field] = part[field]
+                # Les totaux ne sont repris que si la zone contient le bloc des totaux
+                if any(word in region.lower() for word in TOTALS_WORDS):
+                    for field in ("total_ht", "total_ttc"):
+                        if part.get(field) is not None:
+                            data[field] = part[field]
+        data["lignes_articles"] = new_items
+        if changed and not totals_reconcile(data):
+            print("INFO: Extraction par différence incohérente (totaux), extraction complète.")
+            return None
+
+        annotate(delta_hits=1, delta_regions=len(regions))
+        data["_delta_de"] = entry["id"]
+        print(f"SUCCÈS: Devis proche d'un devis connu (similarité {score:.0%}) : "
+              f"{len(regions)} zone(s) modifiée(s) ré-analysée(s), {len(lines) - changed_lines} ligne(s) reprise(s).")
+        return data
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_similarity_index():
+    global _index
+    if _index is None:
+        with _index_lock:
+            if _index is None:
+                _index = SimilarityIndex()
+    return _index
+
+
+# --- Points d'entrée ---
+@instrument("delta_extraction")
+def try_delta_extraction(text_content, extract_fn=request_structured_data, index=None):
+    """Extraction par différence avec un devis déjà analysé, ou None (voir `extract_delta`)."""
+    try:
+        return (index or get_similarity_index()).extract_delta(text_content, extract_fn)
+    except Exception as e:
+        print(f"AVERTISSEMENT: Extraction par différence impossible : {e}")
+        return None
+
+
+def remember_extraction(text_content, structured_data, index=None):
+    """
+    Indexe un devis après une extraction complète réussie. Les résultats partiels et ceux
+    obtenus par différence (déjà couverts par le devis de référence) sont ignorés.
+    """
+    if not structured_data or any(structured_data.get(flag) for flag in ("_flux_interrompu", "_morceaux_en_erreur", "_delta_de")):
+        return
+    try:
+        (index or get_similarity_index()).add(text_content, structured_data)
+    except Exception as e:
+        print(f"AVERTISSEMENT: Indexation du devis impossible : {e}")
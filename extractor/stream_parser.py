@@ -0,0 +1,102 @@
+# microflow_ai/extractor/stream_parser.py
+# Analyse incrémentale de la réponse JSON du LLM reçue en flux.
+#
+# Chaque objet de "lignes_articles" est émis dès que son accolade fermante arrive,
+# sans attendre la fin de la réponse. Si le flux est coupé, les lignes déjà complètes
+# sont conservées.
+
+import re
+import json
+
+HEADER_FIELDS = ("nom_client", "date_devis", "numero_devis", "total_ht", "total_ttc")
+ITEMS_KEY = "lignes_articles"
+
+
+class IncrementalQuoteParser:
+    """Automate caractère par caractère : suit les chaînes, la profondeur et la clé courante."""
+
+    def __init__(self):
+        self.buffer = []
+        self.lines = []
+        self._pos = 0
+        self._stack = []            # Conteneurs ouverts : "{" ou "["
+        self._in_string = False
+        self._escape = False
+        self._string_start = None
+        self._last_string = None
+        self._keys = {}             # Profondeur -> dernière clé lue à cette profondeur
+        self._items_depth = None    # Profondeur du tableau "lignes_articles"
+        self._item_start = None
+
+    def feed(self, chunk):
+        """Ajoute un morceau de texte et retourne les lignes d'articles nouvellement complètes."""
+        if not chunk:
+            return []
+        self.buffer.append(chunk)
+        emitted = []
+        for ch in chunk:
+            pos = self._pos
+            self._pos += 1
+            if self._in_string:
+                if self._escape:
+                    self._escape = False
+                elif ch == "\\":
+                    self._escape = True
+                elif ch == '"':
+                    self._in_string = False
+                    if self._item_start is None:
+                        self._last_string = self._text(self._string_start + 1, pos)
+                continue
+            if ch == '"':
+                self._in_string = True
+                self._string_start = pos
+            elif ch == ":":
+                if self._stack and self._stack[-1] == "{":
+                    self._keys[len(self._stack)] = self._last_string
+            elif ch in "{[":
+                if (ch == "{" and self._items_depth is not None
+                        and len(self._stack) == self._items_depth and self._item_start is None):
+                    self._item_start = pos
+                self._stack.append(ch)
+                if ch == "[" and len(self._stack) == 2 and self._keys.get(1) == ITEMS_KEY:
+                    self._items_depth = 2
+            elif ch in "}]":
+                if self._stack:
+                    self._stack.pop()
+                if ch == "}" and self._item_start is not None and len(self._stack) == self._items_depth:
+                    line = self._load(self._text(self._item_start, pos + 1))
+                    self._item_start = None
+                    if isinstance(line, dict):
+                        self.lines.append(line)
+                        emitted.append(line)
+                elif ch == "]" and self._items_depth is not None and len(self._stack) < self._items_depth:
+                    self._items_depth = None
+        return emitted
+
+    def _text(self, start, end):
+        # Le tampon est recollé à la demande : les morceaux reçus sont petits et peu nombreux
+        if len(self.buffer) > 1:
+            self.buffer = ["".join(self.buffer)]
+        return self.buffer[0][start:end]
+
+    @staticmethod
+    def _load(text):
+        try:
+            return json.loads(text)
+        except ValueError:
+            return None
+
+    def result(self):
+        """
+        JSON final. Si la réponse est incomplète ou invalide, on reconstruit le devis à partir
+        des lignes déjà émises et des champs d'en-tête lisibles ("_flux_interrompu" vaut True).
+        """
+        text = "".join(self.buffer)
+        data = self._load(text)
+        if isinstance(data, dict):
+            return data
+        partial = {"_flux_interrompu": True, ITEMS_KEY: list(self.lines)}
+        for field in HEADER_FIELDS:
+            match = re.search(rf'"{field}"\s*:\s*("(?:[^"\\]|\\.)*"|null|-?\d+(?:\.\d+)?)\s*[,}}]', text)
+            partial[field] = self._load(match.group(1)) if match else None
+        return partial
@@ -0,0 +1,116 @@
+# microflow_ai/extractor/text_compactor.py
+# Compactage du texte extrait avant l'envoi au modèle : moins de jetons, moins de latence,
+# et plus de lignes d'articles dans la fenêtre de 4000 caractères du prompt.
+#
+# Retire les en-têtes et pieds de page répétés d'une page à l'autre, les numéros de page,
+# les mentions légales connues et le remplissage des colonnes, sans toucher aux lignes
+# qui portent des chiffres : chaque nombre et chaque désignation d'article est conservé.
+
+import re
+from collections import Counter
+
+from extractor.pdf_reader import PAGE_SEPARATOR
+from monitoring.metrics import annotate, instrument
+
+# --- Configuration ---
+REPEAT_MIN_PAGES = 3        # Une ligne vue sur au moins ce nombre de pages...
+REPEAT_MIN_RATIO = 0.5      # ... et sur au moins cette part des pages...
+EDGE_LINES = 4              # ... toujours parmi les premières ou dernières lignes est un en-tête / pied de page
+
+COLUMN_GAP_RE = re.compile(r"[  ]{2,}|\t+")          # Remplissage entre colonnes -> une tabulation
+SPACES_RE = re.compile(r"[  ]+")
+FILLER_RE = re.compile(r"([.\-_=*·…])\1{3,}")              # Points de conduite, traits de séparation
+PAGE_NUMBER_RE = re.compile(r"^(page|p\.)?\s*\d+\s*(/|sur|of)\s*\d+$|^page\s*\d+$", re.IGNORECASE)
+PAGE_MENTION_RE = re.compile(r"\b(page|p\.)\s*\d+(\s*(/|sur|of)\s*\d+)?", re.IGNORECASE)
+DIGIT_RE = re.compile(r"\d")
+BOILERPLATE_RE = re.compile(
+    r"conditions g[ée]n[ée]rales"
+    r"|p[ée]nalit[ée]s? de retard"
+    r"|indemnit[ée] forfaitaire"
+    r"|frais de recouvrement"
+    r"|r[ée]serve de propri[ée]t[ée]"
+    r"|pas d'escompte|escompte pour paiement anticip[ée]"
+    r"|capital (social )?de"
+    r"|\brcs\b|\bsiret\b|\bsiren\b|code (naf|ape)"
+    r"|tva intracommunautaire|n° tva"
+    r"|dispens[ée] d'immatriculation"
+    r"|article l\.? ?441",
+    re.IGNORECASE,
+)
+
+
+def _clean_line(line):
+    line = FILLER_RE.sub(" ", line)
+    line = COLUMN_GAP_RE.sub("\t", line.strip())
+    return SPACES_RE.sub(" ", line).strip(" \t")
+
+
+def _has_figures(line):
+    """Chiffre hors numéro de page : montant, taux, quantité ("TVA 20 %", "Total 1 200 €")."""
+    return bool(DIGIT_RE.search(PAGE_MENTION_RE.sub(" ", line)))
+
+
+def _is_boilerplate(line):
+    # Une ligne chiffrée n'est jamais retirée, même si elle ressemble à une mention légale
+    return bool(BOILERPLATE_RE.search(line)) and not _has_figures(line)
+
+
+def estimate_tokens(text):
+    """Estimation grossière du nombre de jetons (≈ 4 caractères par jeton)."""
+    return (len(text) + 3) // 4
+
+
+@instrument("compaction")
+def compact_text(text_content):
+    """
+    Retourne (texte compacté, rapport). Le rapport donne les tailles avant / après en
+    caractères et en jetons estimés, et le nombre de lignes retirées par motif.
+    Le séparateur de pages est conservé (découpage par morceaux).
+    """
+    text_content = text_content or ""
+    pages = [[_clean_line(line) for line in page.splitlines()] for page in text_content.split(PAGE_SEPARATOR)]
+
+    # Lignes présentes en haut ou en bas d'une grande part des pages : en-têtes et pieds de
+    # page. Une ligne répétée ailleurs (suite de description d'article) n'est jamais retirée.
+    seen_on_pages = Counter(line for page in pages for line in set(page) if line)
+    in_body = set()
+    for page in pages:
+        content = [line for line in page if line]
+        in_body.update(content[EDGE_LINES:-EDGE_LINES])
+    min_pages = max(REPEAT_MIN_PAGES, REPEAT_MIN_RATIO * len(pages))
+    repeated = {line for line, n in seen_on_pages.items()
+                if n >= min_pages and line not in in_body and not _has_figures(line)}
+
+    removed = {"repetees": 0, "numeros_de_page": 0, "mentions_legales": 0, "vides": 0}
+    kept_repeated = set()
+    compacted_pages = []
+    for page in pages:
+        kept = []
+        for line in page:
+            if not line:
+                removed["vides"] += 1
+            elif PAGE_NUMBER_RE.match(line):
+                removed["numeros_de_page"] += 1
+            elif line in repeated and line in kept_repeated:
+                removed["repetees"] += 1   # Seule la première occurrence est gardée
+            elif _is_boilerplate(line):
+                removed["mentions_legales"] += 1
+            else:
+                if line in repeated:
+                    kept_repeated.add(line)
+                kept.append(line)
+        compacted_pages.append("\n".join(kept))
+    compacted = PAGE_SEPARATOR.join(compacted_pages)
+
+    report = {
+        "chars_before": len(text_content),
+        "chars_after": len(compacted),
+        "tokens_before": estimate_tokens(text_content),
+        "tokens_after": estimate_tokens(compacted),
+        "lignes_retirees": removed,
+    }
+    annotate(chars_before=report["chars_before"], chars_after=report["chars_after"])
+    saved = 1 - report["chars_after"] / report["chars_before"] if report["chars_before"] else 0.0
+    print(f"INFO: Texte compacté : {report['chars_before']} -> {report['chars_after']} caractères "
+          f"(~{report['tokens_before']} -> ~{report['tokens_after']} jetons, -{saved:.0%}).")
+    return compacted, report
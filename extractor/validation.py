@@ -0,0 +1,253 @@
+# microflow_ai/extractor/validation.py
+# Contrôle arithmétique du JSON renvoyé par le modèle, et réparation ciblée.
+#
+# Vérifie (en vectorisé) quantité x prix unitaire = total de ligne, somme des lignes = total
+# HT et total TTC cohérent avec un taux de TVA. Les erreurs typiques d'extraction sont
+# corrigées sans appel au modèle (valeur manquante, virgule décalée, quantité mal lue) ;
+# seules les lignes encore incohérentes sont renvoyées au modèle, avec leur extrait de texte.
+
+import numpy as np
+
+from extractor.layout_parser import parse_number
+from extractor.llm_cache import normalize_text
+from extractor.pdf_reader import request_structured_data
+from monitoring.metrics import annotate, instrument
+
+# --- Configuration ---
+TOLERANCE_ABS = 0.011           # Écart toléré sur un montant (arrondis au centime)
+TOLERANCE_REL = 0.005
+TVA_RATES = (20.0, 10.0, 5.5, 2.1)
+DECIMAL_SHIFTS = (10.0, 100.0, 1000.0, 0.1, 0.01, 0.001)
+MAX_REPROMPT_LINES = 20         # Au-delà, une nouvelle extraction complète serait plus sûre
+NUMERIC_FIELDS = ("quantite", "prix_unitaire_ht", "total_ligne_ht")
+
+
+def _to_float(value):
+    number = value if isinstance(value, (int, float)) and not isinstance(value, bool) else parse_number(value)
+    return np.nan if number is None else float(number)
+
+
+def _column(items, field):
+    return np.array([_to_float(item.get(field)) for item in items], dtype=np.float64)
+
+
+def _close(a, b):
+    return np.abs(a - b) <= TOLERANCE_ABS + TOLERANCE_REL * np.abs(b)
+
+
+def line_consistency(items):
+    """(quantités, prix unitaires, totaux, masque des lignes cohérentes) des lignes d'articles."""
+    q, pu, t = (_column(items, field) for field in NUMERIC_FIELDS)
+    with np.errstate(invalid="ignore"):
+        ok = _close(q * pu, t)
+    return q, pu, t, ok
+
+
+def totals_consistency(line_totals, total_ht, total_ttc):
+    """(total HT cohérent avec les lignes, total TTC cohérent avec un taux de TVA)."""
+    ht = _to_float(total_ht)
+    ttc = _to_float(total_ttc)
+    ht_ok = not np.isnan(ht) and bool(_close(np.nansum(line_totals), ht))
+    if np.isnan(ht) or np.isnan(ttc) or ht <= 0:
+        return ht_ok, False
+    rate = (ttc / ht - 1) * 100
+    # Taux unique connu, ou mélange de taux (taux effectif entre le plus bas et le plus haut)
+    ttc_ok = any(_close(ht * (1 + r / 100), ttc) for r in TVA_RATES) or min(TVA_RATES) - 0.01 <= rate <= max(TVA_RATES) + 0.01
+    return ht_ok, bool(ttc_ok)
+
+
+def _source_numbers(text_content, item):
+    """
+    Nombres lus sur la ligne du texte source d'un article (et la suivante), hors ceux de sa
+    description : ensemble vide si l'article n'est pas retrouvé.
+    """
+    key = _description_key(item)
+    if not text_content or not key:
+        return set()
+    lines = normalize_text(text_content).split("\n")
+    in_description = {parse_number(token) for token in _description(item).split()}
+    for n, line in enumerate(lines):
+        if key in line.lower():
+            tokens = " ".join(lines[n:n + 2]).split()
+            return {parse_number(token) for token in tokens} - in_description - {None}
+    return set()
+
+
+def repair_lines(items, total_ht=None, text_content=None):
+    """
+    Corrige les lignes incohérentes quand la correction est sans ambiguïté.
+    Retourne (lignes corrigées, corrections, indices des lignes encore incohérentes).
+    Une quantité n'est corrigée que si la nouvelle valeur figure sur la ligne du texte
+    source (`text_content`) : une remise fournisseur explique aussi un total plus bas.
+    """
+    q, pu, t, ok = line_consistency(items)
+    new_q, new_pu, new_t = q.copy(), pu.copy(), t.copy()
+    reasons = np.full(len(items), None, dtype=object)
+    bad = ~ok
+    missing_q, missing_pu, missing_t = np.isnan(q), np.isnan(pu), np.isnan(t)
+
+    with np.errstate(invalid="ignore", divide="ignore"):
+        # 1. Une seule valeur manquante : elle se déduit des deux autres
+        m = bad & missing_t & ~missing_q & ~missing_pu
+        new_t[m] = np.round(q[m] * pu[m], 2)
+        reasons[m] = "total de ligne manquant"
+        m = bad & missing_pu & ~missing_q & ~missing_t & (q != 0)
+        new_pu[m] = np.round(t[m] / q[m], 4)
+        reasons[m] = "prix unitaire manquant"
+        m = bad & missing_q & ~missing_pu & ~missing_t & (pu != 0)
+        new_q[m] = np.round(t[m] / pu[m], 3)
+        reasons[m] = "quantité manquante"
+        bad &= ~(missing_q | missing_pu | missing_t) | np.isnan(new_q * new_pu * new_t)
+
+        # 2. Virgule décalée sur le prix unitaire (ex. 850 lu au lieu de 8,50)
+        shift = np.full(len(items), np.nan)
+        for factor in DECIMAL_SHIFTS:
+            shift[bad & np.isnan(shift) & _close(q * pu * factor, t)] = factor
+        shifted = ~np.isnan(shift)
+
+        # 3. Quantité mal lue : total / prix unitaire tombe sur une quantité entière, lue
+        # telle quelle dans le texte source
+        implied_q = t / pu
+        requantified = bad & (pu != 0) & (implied_q > 0) & (np.abs(implied_q - np.round(implied_q)) < 1e-6)
+        in_source = np.array([bool(requantified[i]) and float(np.round(implied_q[i])) in _source_numbers(text_content, item)
+                              for i, item in enumerate(items)], dtype=bool)
+
+        # Ligne expliquée par les deux hypothèses (ex. q=10, pu=5, t=5), ou quantité que rien
+        # ne confirme (remise ?) : on ne devine pas, elle est renvoyée au modèle
+        ambiguous = shifted & requantified
+        doubtful = ambiguous | (requantified & ~in_source)
+        m = shifted & ~ambiguous
+        new_pu[m] = np.round(pu[m] * shift[m], 4)
+        reasons[m] = "virgule décalée sur le prix unitaire"
+        bad &= ~m
+        m = requantified & in_source & ~ambiguous
+        new_q[m] = np.round(implied_q[m])
+        reasons[m] = "quantité corrigée d'après le total"
+        bad &= ~m
+
+        # 4. Total de ligne ou prix unitaire faux : c'est le total HT du devis qui tranche
+        ht = _to_float(total_ht)
+        fixable = bad & ~doubtful
+        if fixable.any() and not np.isnan(ht):
+            recomputed = np.where(fixable, np.round(q * pu, 2), new_t)
+            if _close(np.nansum(recomputed), ht) and not np.isnan(recomputed[fixable]).any():
+                new_t[fixable] = recomputed[fixable]
+                reasons[fixable] = "total de ligne recalculé (quantité x prix)"
+                bad &= ~fixable
+            elif _close(np.nansum(new_t), ht):
+                # Seulement avec un total et une quantité lus, et un prix au centime près
+                price = t / q
+                m = (fixable & np.isfinite(t) & np.isfinite(q) & (q != 0)
+                     & (np.abs(price * 100 - np.round(price * 100)) < 1e-6))
+                new_pu[m] = np.round(price[m], 2)
+                reasons[m] = "prix unitaire recalculé (total / quantité)"
+                bad &= ~m
+
+    repaired, corrections = [], []
+    for i, item in enumerate(items):
+        if reasons[i] is None or bad[i]:
+            repaired.append(item)
+            continue
+        fixed = dict(item)
+        for field, old, new in zip(NUMERIC_FIELDS, (q[i], pu[i], t[i]), (new_q[i], new_pu[i], new_t[i])):
+            if not (np.isnan(old) and np.isnan(new)) and old != new:
+                fixed[field] = float(new)
+                corrections.append({
+                    "ligne": i, "champ": field, "avant": item.get(field), "apres": float(new), "motif": reasons[i],
+                })
+        repaired.append(fixed)
+    return repaired, corrections, [int(i) for i in np.flatnonzero(bad)]
+
+
+def _description(item):
+    return " ".join(str(item.get("description") or "").lower().split())
+
+
+def _description_key(item):
+    return _description(item)[:20]
+
+
+def _source_excerpt(text_content, items, indices):
+    """Lignes du texte source où apparaissent les articles donnés (la ligne et la suivante)."""
+    lines = normalize_text(text_content).split("\n")
+    lowered = [line.lower() for line in lines]
+    excerpt = []
+    for i in indices:
+        key = _description_key(items[i])
+        for n, line in enumerate(lowered):
+            if key and key in line:
+                excerpt.extend(lines[n:n + 2])
+                break
+    return "\n".join(dict.fromkeys(excerpt))
+
+
+def reprompt_lines(items, indices, text_content, extract_fn=request_structured_data):
+    """
+    Ré-interroge le modèle sur les seules lignes en échec (extrait du texte source).
+    Retourne {indice: ligne réparée} pour les lignes devenues cohérentes.
+    """
+    excerpt = _source_excerpt(text_content, items, indices)
+    if not excerpt:
+        return {}
+    answer = extract_fn(excerpt) or {}
+    candidates = [c for c in answer.get("lignes_articles") or [] if isinstance(c, dict)]
+    failing = [_description(items[i]) for i in indices]
+    repaired = {}
+    for i, description in zip(indices, failing):
+        # Une seule réponse et une seule ligne en échec pour cette description, sinon la
+        # ligne reste à vérifier (jamais les montants d'un article voisin)
+        matches = [c for c in candidates if _description(c) == description]
+        if not description or len(matches) != 1 or failing.count(description) != 1:
+            continue
+        _, _, _, ok = line_consistency(matches)
+        if ok[0]:
+            repaired[i] = {**items[i], **{f: _to_float(matches[0].get(f)) for f in NUMERIC_FIELDS}}
+    return repaired
+
+
+@instrument("validation")
+def validate_and_repair(structured_data, text_content=None, extract_fn=request_structured_data):
+    """
+    Contrôle et répare le JSON structuré. Retourne une copie avec un rapport "_validation" :
+    corrections appliquées, lignes ré-analysées par le modèle, lignes encore à vérifier
+    et cohérence des totaux. Les lignes non réparées sont laissées telles quelles.
+    """
+    data = dict(structured_data)
+    items = [item for item in data.get("lignes_articles") or [] if isinstance(item, dict)]
+    ignored = len(data.get("lignes_articles") or []) - len(items)
+    if ignored:
+        print(f"AVERTISSEMENT: {ignored} ligne(s) d'articles mal formée(s) ignorée(s).")
+    items, corrections, unresolved = repair_lines(items, data.get("total_ht"), text_content)
+
+    reprompted = []
+    if unresolved and text_content and len(unresolved) <= MAX_REPROMPT_LINES:
+        try:
+            fixed = reprompt_lines(items, unresolved, text_content, extract_fn)
+        except Exception as e:
+            print(f"AVERTISSEMENT: Nouvelle analyse des lignes incohérentes impossible : {e}")
+            fixed = {}
+        for i, line in fixed.items():
+            items[i] = line
+        reprompted = sorted(fixed)
+        unresolved = [i for i in unresolved if i not in fixed]
+
+    _, _, line_totals, _ = line_consistency(items)
+    if data.get("total_ht") is None and len(items):
+        data["total_ht"] = round(float(np.nansum(line_totals)), 2)
+    ht_ok, ttc_ok = totals_consistency(line_totals, data.get("total_ht"), data.get("total_ttc"))
+
+    data["lignes_articles"] = items
+    data["_validation"] = {
+        "corrections": corrections,
+        "lignes_re_analysees": reprompted,
+        "lignes_a_verifier": unresolved,
+        "lignes_ignorees": ignored,
+        "total_ht_coherent": ht_ok,
+        "total_ttc_coherent": ttc_ok,
+    }
+    annotate(corrected_lines=len({c["ligne"] for c in corrections}), reprompted_lines=len(reprompted),
+             unresolved_lines=len(unresolved))
+    if corrections or reprompted or unresolved:
+        print(f"INFO: Contrôle arithmétique : {len({c['ligne'] for c in corrections})} ligne(s) corrigée(s), "
+              f"{len(reprompted)} ré-analysée(s), {len(unresolved)} à vérifier.")
+    return data
@@ -1,22 +1,183 @@
 # microflow_ai/generator/pdf_generator.py
-from fpdf import FPDF
+from fpdf import FPDF, __version__ as FPDF_VERSION
+from fpdf.fonts import TTFFont, SubsetMap
+from fontTools import ttLib
 import os
+import io
+import copy
+import math
+import threading
 from datetime import date
+from concurrent.futures import ProcessPoolExecutor
+
+from monitoring.metrics import annotate, instrument
+
+FONT_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'assets')
+DEJAVU_FONTS = {
+    "": "DejaVuSans.ttf",
+    "B": "DejaVuSans-Bold.ttf",
+    "I": "DejaVuSans-Oblique.ttf",
+    "BI": "DejaVuSans-BoldOblique.ttf",
+}
+
+# --- Cache des polices (par processus) ---
+# L'analyse d'un TTF (table des largeurs de ~6000 caractères) coûte plus cher que le rendu
+# d'un petit devis. On analyse chaque police une seule fois, puis chaque document reçoit une
+# copie légère qui partage les tables en lecture seule (largeurs, cmap, descripteur) mais
+# garde son propre état de sous-ensemble, car fpdf modifie la police lors de l'export.
+# La copie dépend des attributs internes de TTFFont : elle n'est utilisée qu'avec la série
+# de fpdf2 épinglée dans requirements.txt, sinon les polices sont chargées normalement.
+FONT_CACHE_FPDF_SERIES = "2.8."
+_FONT_CACHE_ENABLED = FPDF_VERSION.startswith(FONT_CACHE_FPDF_SERIES)
+_FONT_PROTOTYPES = {}
+_FONT_LOCK = threading.Lock()
+
+
+def _font_prototype(family, style, path):
+    key = (family, style, path)
+    if key not in _FONT_PROTOTYPES:
+        with _FONT_LOCK:
+            if key not in _FONT_PROTOTYPES:
+                loader = FPDF()
+                loader.add_font(family, style, path)
+                with open(path, "rb") as f:
+                    font_bytes = f.read()
+                _FONT_PROTOTYPES[key] = (loader.fonts[f"{family.lower()}{style}"], font_bytes)
+    return _FONT_PROTOTYPES[key]
+
+
+def _add_cached_font(pdf, family, style, path):
+    """Équivalent de `pdf.add_font(family, style, path)` sans réanalyser le fichier TTF."""
+    prototype, font_bytes = _font_prototype(family, style, path)
+    if getattr(prototype, "color_font", None) is not None:
+        raise TypeError("police couleur (liée au document)")
+    font = TTFFont.__new__(TTFFont)
+    for slot in TTFFont.__slots__:
+        if hasattr(prototype, slot):
+            value = getattr(prototype, slot)
+            # Tables modifiables (cw est un defaultdict : une simple lecture peut l'étendre)
+            if isinstance(value, (dict, list, set)):
+                value = copy.copy(value)
+            setattr(font, slot, value)
+    # État propre au document (le descripteur reçoit un numéro d'objet et un nom de sous-ensemble à l'export)
+    font.i = len(pdf.fonts) + 1
+    font.desc = copy.copy(prototype.desc)
+    font.ttfont = ttLib.TTFont(io.BytesIO(font_bytes), recalcTimestamp=False, lazy=True)
+    font.missing_glyphs = []
+    font.biggest_size_pt = 0
+    font.subset = SubsetMap(font)
+    if hasattr(prototype, "_hbfont"):
+        font._hbfont = None     # Police HarfBuzz construite à la demande, par document
+    pdf.fonts[font.fontkey] = font
+
+
+def warm_font_cache():
+    """Charge les polices DejaVu à l'avance (démarrage de l'application ou d'un worker)."""
+    for style, file_name in DEJAVU_FONTS.items():
+        _font_prototype("DejaVu", style, os.path.join(FONT_DIR, file_name))
+
+
+# --- Largeurs des caractères (par processus) ---
+# Pour couper les descriptions, chaque mot est mesuré avec une table caractère -> largeur
+# construite une fois par police, au lieu de `get_string_width` (normalisation et analyse
+# bidirectionnelle à chaque appel). Les largeurs des mots déjà vus sont aussi gardées.
+WORD_WIDTH_CACHE_SIZE = 50_000
+_GLYPH_WIDTHS = {}
+
+
+class GlyphWidths:
+    """Largeurs des caractères d'une police, en millièmes de la taille du corps."""
+
+    def __init__(self, font):
+        if isinstance(font, TTFFont):
+            self.chars = {chr(code): width for code, width in font.cw.items()}
+            self.missing = font.desc.missing_width
+        else:
+            self.chars = dict(font.cw)
+            self.missing = self.chars.get("?", 500)
+        self.words = {}
+
+    def width(self, text):
+        width = self.words.get(text)
+        if width is None:
+            chars, missing = self.chars, self.missing
+            width = sum(chars.get(c, missing) for c in text)
+            if len(self.words) < WORD_WIDTH_CACHE_SIZE:
+                self.words[text] = width
+        return width
+
+
+def _glyph_widths(font):
+    key = (font.fontkey, str(getattr(font, "ttffile", "")))
+    widths = _GLYPH_WIDTHS.get(key)
+    if widths is None:
+        widths = _GLYPH_WIDTHS[key] = GlyphWidths(font)
+    return widths
+
+
+def wrap_words(text, max_width, widths):
+    """
+    Découpe un texte en lignes d'au plus `max_width` (unités de `widths`), mot par mot ;
+    un mot plus long que la ligne est coupé entre deux caractères. Les retours à la ligne
+    du texte sont conservés.
+    """
+    space = widths.width(" ")
+    lines = []
+    for paragraph in str(text if text is not None else "").split("\n"):
+        current, current_width = [], 0
+        for word in paragraph.split():
+            word_width = widths.width(word)
+            if word_width > max_width:
+                if current:
+                    lines.append(" ".join(current))
+                piece, piece_width = "", 0
+                for char in word:
+                    char_width = widths.chars.get(char, widths.missing)
+                    if piece and piece_width + char_width > max_width:
+                        lines.append(piece)
+                        piece, piece_width = "", 0
+                    piece += char
+                    piece_width += char_width
+                current, current_width = [piece], piece_width
+            elif current and current_width + space + word_width > max_width:
+                lines.append(" ".join(current))
+                current, current_width = [word], word_width
+            else:
+                current_width += word_width + (space if current else 0)
+                current.append(word)
+        if current or not lines:
+            lines.append(" ".join(current))
+    return lines
+
 
 class QuotePDF(FPDF):
     def __init__(self, *args, **kwargs):
         super().__init__(*args, **kwargs)
-        font_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'assets')
         try:
-            self.add_font("DejaVu", "", os.path.join(font_path, "DejaVuSans.ttf"), uni=True)
-            self.add_font("DejaVu", "B", os.path.join(font_path, "DejaVuSans-Bold.ttf"), uni=True)
-            self.add_font("DejaVu", "I", os.path.join(font_path, "DejaVuSans-Oblique.ttf"), uni=True)
-            self.add_font("DejaVu", "BI", os.path.join(font_path, "DejaVuSans-BoldOblique.ttf"), uni=True)
             self.set_font("DejaVu", "", 10)
         except Exception as e:
             print(f"AVERTISSEMENT: Polices DejaVu non trouvées. Erreur: {e}. Utilisation de Helvetica.")
             self.set_font("Helvetica", "", 10)
 
+    def set_font(self, family=None, style="", size=0):
+        # Les styles DejaVu sont enregistrés à leur première utilisation : un style jamais
+        # utilisé (ex. gras italique) n'est ni chargé ni embarqué dans le PDF.
+        if family and family.lower() == "dejavu":
+            style_key = "".join(sorted(c for c in str(style).upper() if c in "BI"))
+            if f"dejavu{style_key}" not in self.fonts:
+                font_file = os.path.join(FONT_DIR, DEJAVU_FONTS[style_key])
+                if not _FONT_CACHE_ENABLED:
+                    self.add_font("DejaVu", style_key, font_file)
+                else:
+                    try:
+                        _add_cached_font(self, "DejaVu", style_key, font_file)
+                    except Exception as e:
+                        # Copie impossible (police ou version de fpdf2 inattendue) : chargement classique
+                        print(f"AVERTISSEMENT: Cache des polices indisponible ({e}).")
+                        self.fonts.pop(f"dejavu{style_key}", None)
+                        self.add_font("DejaVu", style_key, font_file)
+        super().set_font(family, style, size)
+
     def header(self):
         self.set_font(self.font_family, 'B', 20)
         self.cell(0, 15, 'DEVIS CLIENT', 0, 1, 'C')
@@ -41,45 +202,92 @@ class QuotePDF(FPDF):
         self.cell(0, 7, f"Numéro de devis: {quote_number or 'N/A'}", 0, 1)
         self.ln(10)
 
-    # **** NOUVELLE VERSION "SIMPLICITÉ RADICALE" DE LA FONCTION quote_table ****
-    def quote_table(self, lines, total_ht, total_ttc):
+    # --- Tableau des articles ---
+    # Mise en page faite ici plutôt que par multi_cell : les descriptions sont coupées avec
+    # les largeurs de caractères en cache, les sauts de page sont décidés ligne à ligne
+    # (en-têtes répétés, sous-total reporté d'une page à l'autre) et le coût reste linéaire.
+    TABLE_COL_WIDTHS = (100, 20, 35, 35)
+    TABLE_HEADERS = ('Description', 'Qté', 'Prix U. HT', 'Total HT')
+    TABLE_LINE_HEIGHT = 4.5     # Hauteur d'une ligne de texte (mm)
+    TABLE_ROW_PADDING = 0.75    # Marge verticale dans chaque ligne du tableau (mm)
+    TABLE_CARRY_HEIGHT = 6      # Hauteur des lignes "Report" / "Sous-total à reporter"
+
+    def wrap_text(self, text, width):
+        """Découpe `text` en lignes d'au plus `width` mm dans la police courante."""
+        widths = _glyph_widths(self.current_font)
+        max_width = (width - 2 * self.c_margin) * self.k * 1000 / self.font_size_pt
+        return wrap_words(text, max_width, widths)
+
+    def _table_header(self):
         self.set_font(self.font_family, 'B', 10)
-        col_widths = (100, 20, 35, 35)
-        headers = ['Description', 'Qté', 'Prix U. HT', 'Total HT']
-        
-        # Dessiner les en-têtes
-        for header, width in zip(headers, col_widths):
+        for header, width in zip(self.TABLE_HEADERS, self.TABLE_COL_WIDTHS):
             self.cell(width, 8, header, 1, 0, 'C')
         self.ln()
 
+    def _carry_row(self, label, cents):
+        self.set_font(self.font_family, 'I', 9)
+        self.cell(sum(self.TABLE_COL_WIDTHS[:3]), self.TABLE_CARRY_HEIGHT, label, 1, 0, 'R')
+        self.cell(self.TABLE_COL_WIDTHS[3], self.TABLE_CARRY_HEIGHT, f"{cents / 100:.2f} EUR", 1, 1, 'R')
+
+    def _table_row(self, desc_lines, values):
+        """Une ligne du tableau (ou la suite d'une description coupée par un saut de page)."""
+        # `text` (position absolue) au lieu de `cell` : pas de boîte à calculer pour chaque
+        # texte ; l'alignement à droite des montants utilise les largeurs en cache.
+        x, y = self.l_margin, self.y
+        line_height = self.TABLE_LINE_HEIGHT
+        height = len(desc_lines) * line_height + 2 * self.TABLE_ROW_PADDING
+        baseline = y + self.TABLE_ROW_PADDING + 0.5 * line_height + 0.3 * self.font_size
+        widths = _glyph_widths(self.current_font)
+        scale = self.font_size / 1000
+        col_x = x
+        for i, width in enumerate(self.TABLE_COL_WIDTHS):
+            self.rect(col_x, y, width, height)
+            if i == 0:
+                for n, text in enumerate(desc_lines):
+                    if text:
+                        self.text(col_x + self.c_margin, baseline + n * line_height, text)
+            elif values:
+                text = values[i - 1]
+                self.text(col_x + width - self.c_margin - widths.width(text) * scale, baseline, text)
+            col_x += width
+        self.set_xy(x, y + height)
+
+    def quote_table(self, lines, total_ht, total_ttc):
+        col_widths = self.TABLE_COL_WIDTHS
+        self._table_header()
+
         self.set_font(self.font_family, '', 9)
         if not lines:
             self.cell(sum(col_widths), 10, "Aucun article à afficher.", 1, 1, 'C')
         else:
+            auto_page_break, bottom_margin = self.auto_page_break, self.b_margin
+            self.set_auto_page_break(False)
+            subtotal_cents = 0
+            fresh_page = False
             for item in lines:
-                # --- NOUVELLE LOGIQUE D'AFFICHAGE LIGNE PAR LIGNE ---
-
-                # On nettoie les données, comme avant.
-                description = str(item.get('description', ''))
-                try:
-                    quantite = int(item.get('quantite', 0)) if float(item.get('quantite', 0)).is_integer() else float(item.get('quantite', 0))
-                    quantite_str = str(quantite)
-                except:
-                    quantite_str = str(item.get('quantite', ''))
-
-                try: prix_unitaire_str = f"{float(item.get('prix_unitaire_ht', 0)):.2f} EUR"
-                except: prix_unitaire_str = "N/A"
-                
-                try: total_ligne_str = f"{float(item.get('total_ligne_ht', 0)):.2f} EUR"
-                except: total_ligne_str = "N/A"
-
-                # On dessine chaque cellule une par une sur la même ligne.
-                # C'est moins flexible pour les descriptions très longues, mais 100x plus fiable.
-                self.cell(col_widths[0], 6, description, 1, 0, 'L')
-                self.cell(col_widths[1], 6, quantite_str, 1, 0, 'R')
-                self.cell(col_widths[2], 6, prix_unitaire_str, 1, 0, 'R')
-                self.cell(col_widths[3], 6, total_ligne_str, 1, 1, 'R') # Le '1' à la fin provoque un saut de ligne
-        
+                desc_lines = self.wrap_text(item.get('description', ''), col_widths[0])
+                values, line_cents = _format_row(item)
+                while desc_lines:
+                    # Lignes de texte qui tiennent encore sur la page, sous-total à reporter compris
+                    available = self.page_break_trigger - self.y - self.TABLE_CARRY_HEIGHT - 2 * self.TABLE_ROW_PADDING
+                    fit = int(available // self.TABLE_LINE_HEIGHT)
+                    # Une ligne n'est coupée que si elle ne tient pas sur une page entière
+                    if fit < len(desc_lines) and not (fresh_page and fit >= 1):
+                        self._carry_row("Sous-total à reporter", subtotal_cents)
+                        self.add_page()
+                        self._table_header()
+                        self._carry_row("Report", subtotal_cents)
+                        self.set_font(self.font_family, '', 9)
+                        fresh_page = True
+                        continue
+                    chunk, desc_lines = desc_lines[:fit], desc_lines[fit:]
+                    self._table_row(chunk, values)
+                    fresh_page = False
+                    if values:
+                        subtotal_cents += line_cents
+                        values = None   # Suite de la description : colonnes des montants vides
+            self.set_auto_page_break(auto_page_break, margin=bottom_margin)
+
         self.ln(5)
         self.set_font(self.font_family, 'B', 10)
         try:
@@ -89,6 +297,9 @@ class QuotePDF(FPDF):
         except (ValueError, TypeError):
             total_ht_val, total_ttc_val, tva_amount = 0, 0, 0
 
+        # Le bloc des totaux n'est jamais coupé par un saut de page
+        if self.y + 3 * 8 > self.page_break_trigger:
+            self.add_page()
         self.cell(sum(col_widths[:3]), 8, 'TOTAL HT', 1, 0, 'R')
         self.cell(col_widths[3], 8, f"{total_ht_val:.2f} EUR", 1, 1, 'R')
         self.cell(sum(col_widths[:3]), 8, 'TVA (Calculée)', 1, 0, 'R') # Libellé plus clair
@@ -97,16 +308,97 @@ class QuotePDF(FPDF):
         self.cell(sum(col_widths[:3]), 8, 'TOTAL TTC', 1, 0, 'R')
         self.cell(col_widths[3], 8, f"{total_ttc_val:.2f} EUR", 1, 1, 'R')
 
-def generate_pdf(data, output_path):
+
+def _finite(value, field, item):
+    """Valeur en flottant, ou None si elle est infinie ou NaN (signalé ; la cellule affiche N/A)."""
+    number = float(value)
+    if math.isfinite(number):
+        return number
+    print(f"AVERTISSEMENT: Valeur non finie ({field}) sur la ligne « {item.get('description', '')} ».")
+    return None
+
+
+def _format_row(item):
+    """Textes des colonnes Qté / Prix U. HT / Total HT, et total de la ligne en centimes."""
+    try:
+        quantite = _finite(item.get('quantite', 0), 'quantite', item)
+        if quantite is None:
+            quantite_str = "N/A"
+        else:
+            quantite_str = str(int(quantite)) if quantite.is_integer() else str(quantite)
+    except (TypeError, ValueError):
+        quantite_str = str(item.get('quantite', ''))
+    try:
+        prix_unitaire = _finite(item.get('prix_unitaire_ht', 0), 'prix_unitaire_ht', item)
+        prix_unitaire_str = "N/A" if prix_unitaire is None else f"{prix_unitaire:.2f} EUR"
+    except (TypeError, ValueError):
+        prix_unitaire_str = "N/A"
+    try:
+        total_ligne = _finite(item.get('total_ligne_ht', 0), 'total_ligne_ht', item)
+        if total_ligne is None:
+            total_ligne_str, line_cents = "N/A", 0
+        else:
+            total_ligne_str, line_cents = f"{total_ligne:.2f} EUR", round(total_ligne * 100)
+    except (TypeError, ValueError):
+        total_ligne_str, line_cents = "N/A", 0
+    return (quantite_str, prix_unitaire_str, total_ligne_str), line_cents
+
+
+@instrument("pdf_rendering")
+def generate_pdf(data, output_path=None):
+    """
+    Génère le devis client. `output_path` peut être un chemin (retourne True/False),
+    un tampon binaire comme BytesIO (retourne True/False), ou None : les octets du PDF
+    sont alors retournés directement (None en cas d'erreur).
+    """
     try:
         pdf = QuotePDF()
         pdf.add_page()
         pdf.customer_block(data.get('nom_client'))
         pdf.quote_details(data.get('date_devis'), data.get('numero_devis'))
         pdf.quote_table(data.get('lignes_articles'), data.get('total_ht'), data.get('total_ttc'))
+        annotate(pages=pdf.pages_count)
+        if output_path is None:
+            return bytes(pdf.output())
+        if hasattr(output_path, "write"):
+            output_path.write(pdf.output())
+            print("INFO: PDF généré avec succès en mémoire.")
+            return True
         pdf.output(output_path)
         print(f"INFO: PDF généré avec succès à {output_path}")
         return True
     except Exception as e:
+        annotate(failures=1)
         print(f"ERREUR Critique lors de la génération PDF : {e}")
-        return False
\ No newline at end of file
+        return None if output_path is None else False
+
+
+def _render_one(item):
+    data, output_path = item
+    return generate_pdf(data, output_path) if output_path else generate_pdf(data)
+
+
+def generate_pdfs(batch, output_dir=None, max_workers=None):
+    """
+    Génère plusieurs devis en parallèle sur un pool de processus (chaque processus garde
+    son propre cache de polices). `batch` est une liste de données de devis. Retourne,
+    dans le même ordre, les octets de chaque PDF, ou leurs chemins si `output_dir` est
+    fourni (None pour un devis en erreur).
+    """
+    batch = list(batch)
+    if not batch:
+        return []
+    if output_dir:
+        os.makedirs(output_dir, exist_ok=True)
+        paths = [os.path.join(output_dir, f"Devis_Client_{i + 1:05d}.pdf") for i in range(len(batch))]
+    else:
+        paths = [None] * len(batch)
+
+    workers = max_workers or os.cpu_count() or 1
+    chunksize = max(1, len(batch) // (workers * 4))
+    with ProcessPoolExecutor(max_workers=workers, initializer=warm_font_cache) as pool:
+        results = list(pool.map(_render_one, zip(batch, paths), chunksize=chunksize))
+
+    if output_dir:
+        return [path if ok else None for path, ok in zip(paths, results)]
+    return results
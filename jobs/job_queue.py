@@ -0,0 +1,134 @@
+# microflow_ai/jobs/job_queue.py
+# File de tâches en arrière-plan, partagée par toutes les sessions du serveur.
+#
+# Les analyses longues (extraction, appel au LLM) ne tournent plus dans le thread du script
+# Streamlit : elles sont confiées à un pool de threads borné, et la session ne garde que
+# l'identifiant de la tâche. Une actualisation de la page ou un nouvel envoi du même fichier
+# retrouve la tâche en cours au lieu d'en relancer une. Le nombre d'appels LLM simultanés
+# est plafonné pour tout le serveur.
+
+import time
+import uuid
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
+
+# --- Configuration ---
+MAX_WORKERS = 8             # Tâches exécutées en même temps (les autres attendent leur tour)
+MAX_LLM_JOBS = 4            # Tâches en train d'interroger le LLM en même temps
+JOB_TTL_SECONDS = 15 * 60   # Durée de conservation d'une tâche terminée
+
+PENDING = "en_attente"
+RUNNING = "en_cours"
+DONE = "terminee"
+FAILED = "erreur"
+
+
+class Job:
+    def __init__(self, queue, key):
+        self.id = uuid.uuid4().hex[:12]
+        self.key = key
+        self.status = PENDING
+        self.progress = 0.0
+        self.message = "En attente d'un emplacement libre..."
+        self.lines = []         # Lignes d'articles déjà reçues (affichage au fil de l'eau)
+        self.result = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._queue = queue
+
+    @property
+    def finished(self):
+        return self.status in (DONE, FAILED)
+
+    def update(self, progress=None, message=None):
+        """Appelé par la tâche elle-même pour signaler son avancement."""
+        if progress is not None:
+            self.progress = max(0.0, min(1.0, progress))
+        if message is not None:
+            self.message = message
+
+    @contextmanager
+    def llm_slot(self):
+        """Attend une place parmi les appels LLM autorisés sur le serveur."""
+        if not self._queue.llm_semaphore.acquire(blocking=False):
+            self.update(message="En attente du service IA (serveur occupé)...")
+            self._queue.llm_semaphore.acquire()
+        try:
+            yield
+        finally:
+            self._queue.llm_semaphore.release()
+
+    def snapshot(self):
+        return {
+            "id": self.id,
+            "status": self.status,
+            "progress": self.progress,
+            "message": self.message,
+            "nb_lignes": len(self.lines),
+            "error": self.error,
+        }
+
+
+class JobQueue:
+    def __init__(self, max_workers=MAX_WORKERS, max_llm_jobs=MAX_LLM_JOBS, ttl=JOB_TTL_SECONDS):
+        self.ttl = ttl
+        self.llm_semaphore = threading.BoundedSemaphore(max_llm_jobs)
+        self._pool = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix="job")
+        self._lock = threading.Lock()
+        self._jobs = {}         # id -> Job
+        self._by_key = {}       # clé (ex. empreinte du fichier) -> id de la tâche en cours ou réussie
+
+    def submit(self, key, fn, *args, **kwargs):
+        """
+        Lance `fn(job, *args, **kwargs)` en arrière-plan et retourne l'identifiant de la tâche.
+        Si une tâche de même clé est en cours (ou a réussi récemment), son identifiant est
+        retourné au lieu d'en lancer une nouvelle.
+        """
+        self._cleanup()
+        with self._lock:
+            existing = self._jobs.get(self._by_key.get(key))
+            if existing is not None and existing.status != FAILED:
+                return existing.id
+            job = Job(self, key)
+            self._jobs[job.id] = job
+            self._by_key[key] = job.id
+        self._pool.submit(self._run, job, fn, args, kwargs)
+        return job.id
+
+    def _run(self, job, fn, args, kwargs):
+        job.status = RUNNING
+        job.update(message="Analyse en cours...")
+        try:
+            job.result = fn(job, *args, **kwargs)
+            job.status = DONE
+            job.update(progress=1.0, message="Analyse terminée.")
+        except Exception as e:
+            print(f"ERREUR TÂCHE {job.id}: {e}")
+            job.error = str(e) or type(e).__name__
+            job.status = FAILED
+        finally:
+            job.finished_at = time.time()
+
+    def get(self, job_id):
+        with self._lock:
+            return self._jobs.get(job_id)
+
+    def stats(self):
+        with self._lock:
+            jobs = list(self._jobs.values())
+        return {status: sum(1 for j in jobs if j.status == status) for status in (PENDING, RUNNING, DONE, FAILED)}
+
+    def _cleanup(self):
+        """Oublie les tâches terminées depuis plus de `ttl` secondes."""
+        limit = time.time() - self.ttl
+        with self._lock:
+            expired = [j for j in self._jobs.values() if j.finished and j.finished_at < limit]
+            for job in expired:
+                del self._jobs[job.id]
+                if self._by_key.get(job.key) == job.id:
+                    del self._by_key[job.key]
+
+    def shutdown(self):
+        self._pool.shutdown(wait=False, cancel_futures=True)
@@ -0,0 +1,65 @@
+# microflow_ai/jobs/quote_analysis.py
+# Analyse d'un devis fournisseur importé, exécutée comme tâche de fond (voir job_queue.py).
+# Même enchaînement que l'étape d'import de l'application, sans aucun appel à Streamlit.
+
+import hashlib
+
+from extractor.pdf_reader import (
+    PROMPT_VERSION, LLMConfigurationError, extract_text_and_layout, request_structured_data_stream,
+)
+from extractor.layout_parser import try_fast_path, learn_from_extraction
+from extractor.chunked_extraction import CHUNK_MAX_CHARS, structure_data_chunked
+from extractor.text_compactor import compact_text
+from extractor.similarity_index import try_delta_extraction, remember_extraction
+from extractor.validation import validate_and_repair
+
+
+def analysis_key(pdf_bytes):
+    """Clé de déduplication : deux imports du même fichier partagent la même tâche."""
+    return f"analyse:{PROMPT_VERSION}:{hashlib.sha256(pdf_bytes).hexdigest()}"
+
+
+def analyze_quote(job, pdf_bytes):
+    """Retourne le JSON structuré du devis ; lève une exception au message affichable."""
+    job.update(progress=0.05, message="Lecture du PDF...")
+    # Lecture dans le processus de l'app, page par page : pas de processus forké depuis
+    # le serveur Streamlit (le mode multi-processus est réservé à la ligne de commande)
+    raw_text, layout = extract_text_and_layout(pdf_bytes, workers=1)
+    if not raw_text:
+        raise ValueError("Impossible d'extraire le texte de ce PDF.")
+
+    # Fournisseur connu : lecture directe avec son gabarit, sans appel au LLM
+    job.update(progress=0.15, message="Recherche d'un gabarit fournisseur...")
+    structured_data = try_fast_path(layout)
+    if structured_data is not None:
+        return structured_data
+
+    raw_text, _ = compact_text(raw_text)
+    try:
+        with job.llm_slot():
+            # Devis proche d'un devis déjà analysé : seules les zones modifiées sont ré-analysées
+            job.update(progress=0.2, message="Comparaison avec les devis déjà analysés...")
+            structured_data = try_delta_extraction(raw_text)
+            job.update(progress=0.25, message="Analyse du devis par l'IA...")
+            if structured_data is not None:
+                job.lines.extend(structured_data.get('lignes_articles') or [])
+            elif len(raw_text) > CHUNK_MAX_CHARS:
+                structured_data = structure_data_chunked(raw_text)
+            else:
+                def on_line(line):
+                    job.lines.append(line)
+                    # Avancement indicatif : on ne connaît pas le nombre de lignes à l'avance
+                    job.update(progress=min(0.9, 0.3 + 0.02 * len(job.lines)))
+                structured_data = request_structured_data_stream(raw_text, on_line=on_line)
+            if structured_data:
+                # Lignes incohérentes : corrigées si possible, sinon ré-analysées une à une
+                job.update(progress=0.92, message="Contrôle des montants...")
+                structured_data = validate_and_repair(structured_data, raw_text)
+    except LLMConfigurationError:
+        raise ValueError("Le service IA n'est pas configuré (clé API manquante).")
+    if not structured_data:
+        raise ValueError("L'IA n'a pas pu structurer les données. Veuillez réessayer avec un autre document.")
+
+    remember_extraction(raw_text, structured_data)
+    learn_from_extraction(layout, structured_data)
+    return structured_data
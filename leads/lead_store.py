@@ -0,0 +1,309 @@
+# microflow_ai/leads/lead_store.py
+# Registre local des leads (DuckDB, indexé par email) avec synchronisation différée
+# ("write-behind") vers la feuille Google Sheets.
+#
+# Une connexion ne lit plus toute la feuille : l'email est cherché dans l'index local.
+# Chaque création ou mise à jour est ajoutée à une file d'attente durable (table outbox),
+# vidée par lots en arrière-plan vers la feuille. Les écritures locales sont sérialisées,
+# et le thread de synchronisation fusionne les lots dans la feuille : plus d'écrasement
+# entre deux connexions simultanées.
+
+import os
+import csv
+import json
+import time
+import atexit
+import threading
+from datetime import datetime
+
+import duckdb
+
+# --- Configuration ---
+DB_PATH = os.path.join("data", "leads.duckdb")
+WORKSHEET = "Feuille1"
+SHEET_COLUMNS = ["prenom", "email", "metier", "date_inscription"]
+FLUSH_INTERVAL_SECONDS = 10
+MAX_BATCH_SIZE = 500
+MAX_RETRY_DELAY_SECONDS = 300
+
+
+def normalize_email(email):
+    return str(email or "").strip().lower()
+
+
+def _clean(value):
+    """Cellule de feuille -> chaîne (les cellules vides de pandas arrivent en NaN)."""
+    if value is None or (isinstance(value, float) and value != value):
+        return ""
+    return str(value).strip()
+
+
+# --- Backends de la feuille ---
+class GSheetsBackend:
+    """Feuille Google Sheets via `st.connection("gsheets", type=GSheetsConnection)`."""
+
+    def __init__(self, conn, worksheet=WORKSHEET):
+        self.conn = conn
+        self.worksheet = worksheet
+
+    def read_all(self):
+        df = self.conn.read(worksheet=self.worksheet, use_headers=True, ttl=0).dropna(how="all")
+        return df.to_dict("records")
+
+    def upsert_many(self, rows):
+        # L'API de la connexion ne permet que la réécriture complète de la feuille : on relit la
+        # feuille une fois par lot, on y fusionne toutes les modifications, puis on réécrit.
+        import pandas as pd
+
+        merged = _merge_rows(self.read_all(), rows)
+        self.conn.update(worksheet=self.worksheet, data=pd.DataFrame(merged, columns=SHEET_COLUMNS))
+
+
+class LocalSheetBackend:
+    """
+    Remplaçant local de la feuille, pour les tests et le développement sans Google.
+    Conserve les lignes en mémoire, et dans un CSV si `path` est fourni.
+    """
+
+    def __init__(self, path=None):
+        self.path = path
+        self.rows = []
+        self.write_count = 0
+        self._lock = threading.Lock()
+        if path and os.path.exists(path):
+            with open(path, "r", encoding="utf-8", newline="") as f:
+                self.rows = list(csv.DictReader(f))
+
+    def read_all(self):
+        with self._lock:
+            return [dict(row) for row in self.rows]
+
+    def upsert_many(self, rows):
+        with self._lock:
+            self.rows = _merge_rows(self.rows, rows)
+            self.write_count += 1
+            if self.path:
+                tmp_path = f"{self.path}.tmp"
+                with open(tmp_path, "w", encoding="utf-8", newline="") as f:
+                    writer = csv.DictWriter(f, fieldnames=SHEET_COLUMNS, extrasaction="ignore")
+                    writer.writeheader()
+                    writer.writerows(self.rows)
+                os.replace(tmp_path, self.path)
+
+
+def _merge_rows(existing_rows, updates):
+    """
+    Applique des lignes (clé : email) à une liste de lignes de feuille, sans perdre les autres.
+    La date d'inscription d'un lead déjà présent n'est jamais remplacée.
+    """
+    merged = [{col: _clean(row.get(col)) for col in SHEET_COLUMNS} for row in existing_rows]
+    index = {normalize_email(row["email"]): i for i, row in enumerate(merged)}
+    for update in updates:
+        key = normalize_email(update.get("email"))
+        row = {col: _clean(update.get(col)) for col in SHEET_COLUMNS}
+        if key in index:
+            current = merged[index[key]]
+            for col in SHEET_COLUMNS:
+                if row[col] and not (col == "date_inscription" and current[col]):
+                    current[col] = row[col]
+        else:
+            index[key] = len(merged)
+            merged.append(row)
+    return merged
+
+
+# --- Registre local ---
+class LeadStore:
+    def __init__(self, backend, db_path=DB_PATH, flush_interval=FLUSH_INTERVAL_SECONDS,
+                 max_batch_size=MAX_BATCH_SIZE, start_sync=True):
+        self.backend = backend
+        self.flush_interval = flush_interval
+        self.max_batch_size = max_batch_size
+        if db_path != ":memory:":
+            os.makedirs(os.path.dirname(db_path) or ".", exist_ok=True)
+        self._db = duckdb.connect(db_path)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._wake = threading.Event()
+        self._stop = threading.Event()
+        self._thread = None
+        self._imported = False      # Feuille lue au moins une fois (sinon nouvel essai avant l'envoi)
+        self._create_tables()
+        self.import_from_backend()
+        if start_sync:
+            self.start()
+
+    def _create_tables(self):
+        with self._lock:
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS leads (
+                    email VARCHAR PRIMARY KEY,
+                    prenom VARCHAR,
+                    metier VARCHAR,
+                    date_inscription VARCHAR
+                )
+            """)
+            self._db.execute("CREATE SEQUENCE IF NOT EXISTS outbox_seq")
+            self._db.execute("""
+                CREATE TABLE IF NOT EXISTS outbox (
+                    id BIGINT PRIMARY KEY DEFAULT nextval('outbox_seq'),
+                    payload VARCHAR,
+                    created_at TIMESTAMP DEFAULT current_timestamp
+                )
+            """)
+
+    def import_from_backend(self):
+        """
+        Charge dans l'index les leads de la feuille absents localement (une lecture au démarrage,
+        renouvelée avant le premier envoi si elle a échoué). Les leads créés localement entre-temps
+        reprennent la date d'inscription de la feuille.
+        """
+        try:
+            rows = self.backend.read_all()
+        except Exception as e:
+            print(f"AVERTISSEMENT: Lecture initiale de la feuille impossible : {e}")
+            return 0
+        self._imported = True
+        records = [
+            (normalize_email(r.get("email")), _clean(r.get("prenom")), _clean(r.get("metier")), _clean(r.get("date_inscription")))
+            for r in rows if normalize_email(r.get("email"))
+        ]
+        if not records:
+            return 0
+        with self._lock:
+            before = self._db.execute("SELECT count(*) FROM leads").fetchone()[0]
+            self._db.executemany(
+                "INSERT INTO leads VALUES (?, ?, ?, ?) ON CONFLICT (email) DO UPDATE SET date_inscription = "
+                "CASE WHEN excluded.date_inscription <> '' THEN excluded.date_inscription ELSE leads.date_inscription END",
+                records,
+            )
+            after = self._db.execute("SELECT count(*) FROM leads").fetchone()[0]
+        return after - before
+
+    def get(self, email):
+        with self._lock:
+            row = self._db.execute(
+                "SELECT email, prenom, metier, date_inscription FROM leads WHERE email = ?",
+                [normalize_email(email)],
+            ).fetchone()
+        return dict(zip(["email", "prenom", "metier", "date_inscription"], row)) if row else None
+
+    def upsert(self, name, email, profession):
+        """
+        Crée ou met à jour un lead localement et met la modification en file d'attente.
+        Retourne (created, updated_fields).
+        """
+        key = normalize_email(email)
+        name, profession = _clean(name), _clean(profession)
+        with self._lock:
+            self._db.execute("BEGIN TRANSACTION")
+            try:
+                row = self._db.execute("SELECT prenom, metier FROM leads WHERE email = ?", [key]).fetchone()
+                if row is None:
+                    created, updated_fields = True, []
+                    payload = {
+                        "prenom": name, "email": key, "metier": profession,
+                        "date_inscription": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+                    }
+                    self._db.execute(
+                        "INSERT INTO leads VALUES (?, ?, ?, ?)",
+                        [key, payload["prenom"], payload["metier"], payload["date_inscription"]],
+                    )
+                else:
+                    created, updated_fields = False, []
+                    payload = {"email": key}
+                    if name and row[0] != name:
+                        payload["prenom"] = name
+                        updated_fields.append("prénom")
+                    if profession and row[1] != profession:
+                        payload["metier"] = profession
+                        updated_fields.append("métier")
+                    if updated_fields:
+                        self._db.execute(
+                            "UPDATE leads SET prenom = ?, metier = ? WHERE email = ?",
+                            [payload.get("prenom", row[0]), payload.get("metier", row[1]), key],
+                        )
+                if created or updated_fields:
+                    self._db.execute("INSERT INTO outbox (payload) VALUES (?)", [json.dumps(payload, ensure_ascii=False)])
+                self._db.execute("COMMIT")
+            except Exception:
+                self._db.execute("ROLLBACK")
+                raise
+        if created or updated_fields:
+            self._wake.set()
+        return created, updated_fields
+
+    def pending_count(self):
+        with self._lock:
+            return self._db.execute("SELECT count(*) FROM outbox").fetchone()[0]
+
+    def flush(self):
+        """Envoie à la feuille les modifications en attente (un lot). Retourne le nombre envoyé."""
+        with self._flush_lock:
+            return self._flush_batch()
+
+    def _flush_batch(self):
+        if not self._imported:
+            # Index vide après un échec au démarrage : on relit la feuille avant d'y écrire
+            self.import_from_backend()
+            if not self._imported:
+                raise RuntimeError("feuille toujours illisible, envoi reporté")
+        with self._lock:
+            pending = self._db.execute(
+                "SELECT id, payload FROM outbox ORDER BY id LIMIT ?", [self.max_batch_size]
+            ).fetchall()
+        if not pending:
+            return 0
+        # Plusieurs modifications du même email sont fusionnées dans l'ordre d'arrivée
+        updates = {}
+        for _, payload in pending:
+            data = json.loads(payload)
+            updates.setdefault(data["email"], {}).update(data)
+        self.backend.upsert_many(list(updates.values()))
+        with self._lock:
+            self._db.execute("DELETE FROM outbox WHERE id <= ?", [pending[-1][0]])
+        print(f"INFO: {len(pending)} modification(s) de leads synchronisée(s) avec la feuille.")
+        return len(pending)
+
+    def flush_all(self):
+        total = 0
+        while True:
+            sent = self.flush()
+            total += sent
+            if sent < self.max_batch_size:
+                return total
+
+    def _sync_loop(self):
+        delay = self.flush_interval
+        retry_at = 0.0      # Après un échec : pas de nouvel envoi avant cette échéance
+        while not self._stop.is_set():
+            self._wake.wait(timeout=delay)
+            self._wake.clear()
+            # On laisse quelques connexions s'accumuler pour envoyer un seul lot ; une nouvelle
+            # connexion n'écourte pas l'attente imposée après un échec
+            self._stop.wait(timeout=max(min(1.0, self.flush_interval), retry_at - time.monotonic()))
+            try:
+                self.flush_all()
+                delay, retry_at = self.flush_interval, 0.0
+            except Exception as e:
+                delay = min(delay * 2, MAX_RETRY_DELAY_SECONDS)
+                retry_at = time.monotonic() + delay
+                print(f"ERREUR SYNCHRONISATION LEADS: {e} (nouvel essai dans {delay} s)")
+
+    def start(self):
+        if self._thread is None:
+            self._thread = threading.Thread(target=self._sync_loop, name="lead-sync", daemon=True)
+            self._thread.start()
+            atexit.register(self.close)
+
+    def close(self):
+        """Arrête la synchronisation en arrière-plan après un dernier envoi."""
+        self._stop.set()
+        self._wake.set()
+        if self._thread is not None:
+            self._thread.join(timeout=5)
+            self._thread = None
+        try:
+            self.flush_all()
+        except Exception as e:
+            print(f"AVERTISSEMENT: Leads non synchronisés à l'arrêt (conservés localement) : {e}")
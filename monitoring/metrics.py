@@ -0,0 +1,271 @@
+# microflow_ai/monitoring/metrics.py
+# Mesures par étape du traitement d'un devis (extraction PDF, LLM, tarification, rendu).
+#
+# Chaque étape est enveloppée dans un "span" : sa durée alimente un histogramme par étape,
+# et ses attributs numériques (pages, caractères, jetons, accès cache...) des compteurs.
+# Coût d'un span : deux lectures d'horloge, un verrou et une recherche dichotomique.
+#
+# Export au choix : texte au format Prometheus, fichier JSONL (un événement par span) ou
+# panneau de débogage dans l'application (`summary()` et `recent_spans()`).
+#
+# Variables d'environnement :
+#   MICROFLOW_METRICS=0              désactive la collecte
+#   MICROFLOW_METRICS_JSONL=chemin   ajoute chaque span au fichier JSONL donné
+
+import os
+import json
+import time
+import bisect
+import functools
+import threading
+import contextvars
+from collections import deque
+from contextlib import contextmanager
+
+# --- Configuration ---
+ENABLED = os.environ.get("MICROFLOW_METRICS", "1") != "0"
+JSONL_PATH = os.environ.get("MICROFLOW_METRICS_JSONL")
+PREFIX = "microflow_"
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0, 120.0)
+RECENT_SPANS = 200
+
+_current_span = contextvars.ContextVar("microflow_span", default=None)
+
+
+class Histogram:
+    __slots__ = ("buckets", "counts", "sum", "count", "max")
+
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)  # Dernière case : +Inf
+        self.sum = 0.0
+        self.count = 0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+        if value > self.max:
+            self.max = value
+
+    def quantile(self, q):
+        """Quantile approché (borne supérieure de la case qui le contient)."""
+        if not self.count:
+            return 0.0
+        rank, seen = q * self.count, 0
+        for bound, n in zip(self.buckets, self.counts):
+            seen += n
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+
+class Span:
+    __slots__ = ("stage", "attributes")
+
+    def __init__(self, stage, attributes):
+        self.stage = stage
+        self.attributes = attributes
+
+    def set(self, **attributes):
+        self.attributes.update(attributes)
+
+    def add(self, **attributes):
+        """Cumule des valeurs numériques (ex. jetons de plusieurs appels dans la même étape)."""
+        for key, value in attributes.items():
+            self.attributes[key] = self.attributes.get(key, 0) + value
+
+
+class _NoopSpan:
+    def set(self, **attributes):
+        pass
+
+    def add(self, **attributes):
+        pass
+
+
+_NOOP_SPAN = _NoopSpan()
+
+
+class MetricsRegistry:
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.counters = {}      # (nom, étiquettes) -> valeur
+        self.histograms = {}    # (nom, étiquettes) -> Histogram
+        self.recent = deque(maxlen=RECENT_SPANS)
+        self.sinks = []
+
+    def inc(self, name, value=1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+
+    def observe(self, name, value, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def record_span(self, stage, duration, error=None, attributes=None):
+        """Enregistre une étape terminée : histogramme de durée, compteurs et événement."""
+        attributes = attributes or {}
+        labels = (("stage", stage),)
+        event = {"ts": round(time.time(), 3), "stage": stage, "duration_s": round(duration, 6), "error": error}
+        event.update(attributes)
+        with self._lock:
+            histogram = self.histograms.get(("stage_duration_seconds", labels))
+            if histogram is None:
+                histogram = self.histograms[("stage_duration_seconds", labels)] = Histogram()
+            histogram.observe(duration)
+            if error:
+                key = ("stage_errors_total", labels)
+                self.counters[key] = self.counters.get(key, 0) + 1
+            for name, value in attributes.items():
+                if isinstance(value, (int, float)):
+                    key = (f"{name}_total", labels)
+                    self.counters[key] = self.counters.get(key, 0) + value
+            self.recent.append(event)
+            sinks = list(self.sinks)
+        for sink in sinks:
+            try:
+                sink(event)
+            except Exception as e:
+                print(f"AVERTISSEMENT: Export des mesures impossible : {e}")
+
+    def add_sink(self, sink):
+        """Ajoute un exportateur appelé avec chaque événement de span (dict)."""
+        with self._lock:
+            self.sinks.append(sink)
+
+    def summary(self):
+        """Une ligne par étape : nombre, durées moyenne / p50 / p95 / max, erreurs."""
+        with self._lock:
+            errors = {dict(labels).get("stage"): v for (name, labels), v in self.counters.items()
+                      if name == "stage_errors_total"}
+            rows = []
+            for (name, labels), h in sorted(self.histograms.items()):
+                if name != "stage_duration_seconds":
+                    continue
+                stage = dict(labels)["stage"]
+                rows.append({
+                    "étape": stage,
+                    "appels": h.count,
+                    "moyenne_s": round(h.sum / h.count, 4) if h.count else 0.0,
+                    "p50_s": round(h.quantile(0.5), 4),
+                    "p95_s": round(h.quantile(0.95), 4),
+                    "max_s": round(h.max, 4),
+                    "erreurs": errors.get(stage, 0),
+                })
+            return rows
+
+    def recent_spans(self):
+        with self._lock:
+            return list(self.recent)
+
+    def render_prometheus(self):
+        """Toutes les mesures au format texte d'exposition Prometheus."""
+        def fmt_labels(labels, extra=()):
+            items = list(labels) + list(extra)
+            if not items:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in items) + "}"
+
+        out = []
+        with self._lock:
+            for name in sorted({n for n, _ in self.counters}):
+                out.append(f"# TYPE {PREFIX}{name} counter")
+                for (n, labels), value in sorted(self.counters.items()):
+                    if n == name:
+                        out.append(f"{PREFIX}{name}{fmt_labels(labels)} {value}")
+            for name in sorted({n for n, _ in self.histograms}):
+                out.append(f"# TYPE {PREFIX}{name} histogram")
+                for (n, labels), h in sorted(self.histograms.items()):
+                    if n != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(h.buckets, h.counts):
+                        cumulative += count
+                        out.append(f"{PREFIX}{name}_bucket{fmt_labels(labels, [('le', bound)])} {cumulative}")
+                    out.append(f"{PREFIX}{name}_bucket{fmt_labels(labels, [('le', '+Inf')])} {h.count}")
+                    out.append(f"{PREFIX}{name}_sum{fmt_labels(labels)} {h.sum}")
+                    out.append(f"{PREFIX}{name}_count{fmt_labels(labels)} {h.count}")
+        return "\n".join(out) + "\n"
+
+    def write_prometheus(self, path):
+        """Écrit l'export Prometheus de façon atomique (collecteur textfile de node_exporter)."""
+        tmp_path = f"{path}.tmp"
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.write(self.render_prometheus())
+        os.replace(tmp_path, path)
+
+    def reset(self):
+        with self._lock:
+            self.counters.clear()
+            self.histograms.clear()
+            self.recent.clear()
+
+
+class JsonlSink:
+    """Exportateur : un événement JSON par ligne, ajouté au fichier donné."""
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._file = open(path, "a", encoding="utf-8", buffering=1)
+
+    def __call__(self, event):
+        line = json.dumps(event, ensure_ascii=False, default=str)
+        with self._lock:
+            self._file.write(line + "\n")
+
+
+REGISTRY = MetricsRegistry()
+if ENABLED and JSONL_PATH:
+    REGISTRY.add_sink(JsonlSink(JSONL_PATH))
+
+
+@contextmanager
+def span(stage, **attributes):
+    """Mesure le bloc comme une étape ; `sp.set(...)` / `sp.add(...)` y ajoutent des attributs."""
+    if not ENABLED:
+        yield _NOOP_SPAN
+        return
+    current = Span(stage, attributes)
+    token = _current_span.set(current)
+    error = None
+    start = time.perf_counter()
+    try:
+        yield current
+    except BaseException as e:
+        error = type(e).__name__
+        raise
+    finally:
+        duration = time.perf_counter() - start
+        _current_span.reset(token)
+        REGISTRY.record_span(stage, duration, error, current.attributes)
+
+
+def instrument(stage):
+    """Décorateur : chaque appel de la fonction est mesuré comme l'étape `stage`."""
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            with span(stage):
+                return func(*args, **kwargs)
+        return wrapper
+    return decorator
+
+
+def annotate(**attributes):
+    """Cumule des attributs numériques sur l'étape en cours (sans effet hors d'une étape)."""
+    current = _current_span.get()
+    if current is not None:
+        current.add(**attributes)
+
+
+def get_registry():
+    return REGISTRY
@@ -0,0 +1,53 @@
+# microflow_ai/pricing/adjustments.py
+# Ajustements du devis client : marge sur fournitures et main d'œuvre.
+
+import math
+
+from monitoring.metrics import annotate, instrument
+from pricing.pricing_engine import DEFAULT_TVA_RATE, labour_line, price_lines, quote_totals
+
+TVA_RATE = DEFAULT_TVA_RATE / 100
+
+
+def _records(df):
+    """DataFrame -> liste de dicts, sans les cellules vides ajoutées par l'alignement des colonnes."""
+    columns = list(df.columns)
+    records = [dict(zip(columns, row)) for row in zip(*(df[c].tolist() for c in columns))]
+    for column in (c for c in columns if df[c].isna().any()):
+        for record in records:
+            value = record[column]
+            if value is None or (isinstance(value, float) and math.isnan(value)):
+                del record[column]
+    return records
+
+
+@instrument("pricing")
+def apply_adjustments(raw_data, margin_percentage, mo_desc=None, mo_hours=0, mo_rate=0,
+                      category_margins=None, global_discount_pct=0.0):
+    """Applique la marge aux lignes extraites et ajoute la ligne de main d'œuvre."""
+    lines = list(raw_data.get('lignes_articles') or [])
+    mo_line = labour_line(mo_desc, mo_hours, mo_rate)
+    if mo_line:
+        lines.append(mo_line)
+
+    final_lines = _records(price_lines(lines, margin_percentage, category_margins=category_margins))
+    annotate(lines=len(final_lines))
+    final_quote_data = {
+        "lignes_articles": final_lines,
+        "nom_client": raw_data.get('nom_client'),
+        "date_devis": raw_data.get('date_devis'),
+        "numero_devis": raw_data.get('numero_devis'),
+    }
+    if global_discount_pct:
+        final_quote_data["remise_globale_pct"] = global_discount_pct
+    return final_quote_data
+
+
+def compute_totals(final_quote_data, tva_rate=TVA_RATE):
+    """Retourne (total_ht, total_ttc) du devis final (TVA calculée par taux)."""
+    totals = quote_totals(
+        final_quote_data.get('lignes_articles') or [],
+        global_discount_pct=final_quote_data.get('remise_globale_pct') or 0.0,
+        default_tva=tva_rate * 100,
+    )
+    return totals["total_ht"], totals["total_ttc"]
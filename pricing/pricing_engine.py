@@ -0,0 +1,157 @@
+# microflow_ai/pricing/pricing_engine.py
+# Moteur de tarification vectorisé (NumPy/pandas) des lignes d'un devis.
+#
+# Tous les montants sont calculés en entiers (centimes, ou dix-millièmes d'euro pour les
+# prix unitaires fournisseurs) avec un arrondi commercial "au demi supérieur" : pas d'écart
+# de centime dû aux flottants, et un devis de 10 000 lignes se recalcule en quelques ms.
+
+import re
+
+import numpy as np
+import pandas as pd
+
+# --- Configuration ---
+DEFAULT_TVA_RATE = 20.0
+LINE_TYPE_SUPPLY = "fourniture"
+LINE_TYPE_LABOUR = "main_oeuvre"
+
+PRICE_SCALE = 10_000    # Prix unitaires fournisseurs : 1/10 000 d'euro
+QTY_SCALE = 1_000       # Quantités : 1/1000 d'unité
+RATE_SCALE = 10_000     # Pourcentages : 1/100 de point de base (30 % -> 300 000 / 1 000 000)
+PCT = 100 * RATE_SCALE
+
+
+def _round_div(numerator, denominator):
+    """Division entière arrondie au demi le plus éloigné de zéro (vectorisée)."""
+    numerator = np.asarray(numerator, dtype=np.int64)
+    half = denominator // 2
+    return np.sign(numerator) * ((np.abs(numerator) + half) // denominator)
+
+
+def _to_scaled(values, scale):
+    """
+    Convertit une colonne (nombres, chaînes, None) en entiers mis à l'échelle ; NaN -> masque.
+    Les chaînes à la française ("2,5", "1 200,00") sont lues.
+    """
+    values = values.map(lambda v: re.sub(r"[\s\xa0\u202f]", "", v).replace(",", ".") if isinstance(v, str) else v)
+    numeric = pd.to_numeric(values, errors="coerce").to_numpy(dtype=np.float64)
+    valid = ~np.isnan(numeric)
+    scaled = np.zeros(len(numeric), dtype=np.int64)
+    scaled[valid] = np.rint(numeric[valid] * scale).astype(np.int64)
+    return scaled, valid
+
+
+def _column(df, name, default):
+    if name in df.columns:
+        return df[name]
+    return pd.Series([default] * len(df), index=df.index, dtype=object)
+
+
+def to_frame(lines):
+    """Lignes d'articles (liste de dicts ou DataFrame) -> DataFrame."""
+    if isinstance(lines, pd.DataFrame):
+        return lines.copy()
+    return pd.DataFrame(list(lines or []))
+
+
+def price_lines(lines, margin_pct=0.0, category_margins=None, default_tva=DEFAULT_TVA_RATE):
+    """
+    Applique les marges et remises à un ensemble de lignes et recalcule les totaux de ligne.
+
+    Colonnes reconnues : "prix_unitaire_ht" (prix fournisseur), "quantite" (1 si absente),
+    "categorie", "marge_pct" (marge propre à la ligne), "remise_pct", "taux_tva",
+    "type" ("fourniture" ou "main_oeuvre" : la main d'œuvre ne reçoit pas de marge).
+    Priorité des marges : marge de la ligne > marge de la catégorie > `margin_pct`.
+
+    Retourne un nouveau DataFrame (prix et totaux arrondis au centime). Les lignes dont le
+    prix ou la quantité ne sont pas numériques sont conservées telles quelles.
+    """
+    df = to_frame(lines)
+    n = len(df)
+    if n == 0:
+        return df
+
+    price, price_ok = _to_scaled(_column(df, "prix_unitaire_ht", None), PRICE_SCALE)
+    quantities = _column(df, "quantite", None)
+    qty, qty_ok = _to_scaled(quantities, QTY_SCALE)
+    qty_missing = (quantities.isna() | (quantities.astype(str).str.strip() == "")).to_numpy()
+    qty[qty_missing] = QTY_SCALE
+    # Quantité illisible ("2 ml", "forfait") : la ligne n'est pas recalculée
+    priced_ok = price_ok & (qty_ok | qty_missing)
+    if (price_ok & ~priced_ok).any():
+        print(f"AVERTISSEMENT: {int((price_ok & ~priced_ok).sum())} ligne(s) à la quantité illisible laissée(s) telle(s) quelle(s).")
+
+    # Marge applicable à chaque ligne
+    margin = np.full(n, int(round(margin_pct * RATE_SCALE)), dtype=np.int64)
+    if category_margins and "categorie" in df.columns:
+        categories = df["categorie"].astype(str)
+        for category, pct in category_margins.items():
+            margin[(categories == str(category)).to_numpy()] = int(round(pct * RATE_SCALE))
+    line_margin, line_margin_ok = _to_scaled(_column(df, "marge_pct", None), RATE_SCALE)
+    margin[line_margin_ok] = line_margin[line_margin_ok]
+    is_labour = (_column(df, "type", LINE_TYPE_SUPPLY).astype(str) == LINE_TYPE_LABOUR).to_numpy()
+    margin[is_labour] = 0
+
+    discount, discount_ok = _to_scaled(_column(df, "remise_pct", None), RATE_SCALE)
+    discount[~discount_ok] = 0
+
+    # Prix unitaire client au centime, puis total de ligne au centime
+    unit_cents = _round_div(price * (PCT + margin), PRICE_SCALE // 100 * PCT)
+    total_cents = _round_div(unit_cents * qty, QTY_SCALE)
+    total_cents = _round_div(total_cents * (PCT - discount), PCT)
+
+    priced = df.copy()
+    new_unit = pd.Series(unit_cents / 100, index=df.index)
+    new_total = pd.Series(total_cents / 100, index=df.index)
+    priced["prix_unitaire_ht"] = new_unit.where(priced_ok, _column(df, "prix_unitaire_ht", None))
+    priced["total_ligne_ht"] = new_total.where(priced_ok, _column(df, "total_ligne_ht", None))
+    if "taux_tva" not in priced.columns:
+        priced["taux_tva"] = default_tva
+    return priced
+
+
+def quote_totals(lines, global_discount_pct=0.0, default_tva=DEFAULT_TVA_RATE):
+    """
+    Totaux du devis à partir des totaux de ligne. La TVA est calculée par taux sur la base
+    HT de chaque taux (après remise globale), puis arrondie au centime.
+
+    Retourne {"total_ht", "remise_globale", "total_tva", "total_ttc", "tva_par_taux"}.
+    """
+    df = to_frame(lines)
+    if len(df) == 0:
+        return {"total_ht": 0.0, "remise_globale": 0.0, "total_tva": 0.0, "total_ttc": 0.0, "tva_par_taux": {}}
+
+    totals, totals_ok = _to_scaled(_column(df, "total_ligne_ht", None), 100)
+    totals[~totals_ok] = 0
+    rates = pd.to_numeric(_column(df, "taux_tva", default_tva), errors="coerce").fillna(default_tva).to_numpy()
+    rates_scaled = np.rint(rates * RATE_SCALE).astype(np.int64)
+
+    discount = int(round(global_discount_pct * RATE_SCALE))
+    unique_rates, groups = np.unique(rates_scaled, return_inverse=True)
+    base_per_rate = np.bincount(groups, weights=totals, minlength=len(unique_rates)).round().astype(np.int64)
+    base_per_rate = _round_div(base_per_rate * (PCT - discount), PCT)
+    tva_per_rate = _round_div(base_per_rate * unique_rates, PCT)
+
+    gross_ht = int(totals.sum())
+    total_ht = int(base_per_rate.sum())
+    total_tva = int(tva_per_rate.sum())
+    return {
+        "total_ht": total_ht / 100,
+        "remise_globale": (gross_ht - total_ht) / 100,
+        "total_tva": total_tva / 100,
+        "total_ttc": (total_ht + total_tva) / 100,
+        "tva_par_taux": {int(r) / RATE_SCALE: int(t) / 100 for r, t in zip(unique_rates, tva_per_rate)},
+    }
+
+
+def labour_line(description, hours, hourly_rate, tva_rate=DEFAULT_TVA_RATE):
+    """Ligne de main d'œuvre (sans marge), ou None si elle est vide."""
+    if not description or hours <= 0 or hourly_rate <= 0:
+        return None
+    return {
+        "description": description,
+        "quantite": hours,
+        "prix_unitaire_ht": hourly_rate,
+        "type": LINE_TYPE_LABOUR,
+        "taux_tva": tva_rate,
+    }
@@ -0,0 +1,120 @@
+# microflow_ai/ui/quote_views.py
+# Tableaux et totaux des étapes d'ajustement et d'aperçu, mémorisés entre les réexécutions.
+#
+# Streamlit réexécute tout le script à chaque interaction : reconstruire le DataFrame, le
+# mettre en forme et recalculer les totaux d'un devis de plusieurs centaines de lignes
+# ralentissait chaque clic. Ces vues dérivées sont calculées une seule fois par contenu de
+# devis (empreinte du JSON) et gardées dans un petit cache LRU propre à chaque session.
+# Les montants sont mis en forme une fois pour toutes (chaînes) : plus de Styler à recalculer.
+
+import json
+import hashlib
+from collections import OrderedDict
+
+import pandas as pd
+
+from pricing.adjustments import compute_totals
+
+# --- Configuration ---
+MAX_VIEWS_PER_SESSION = 4       # Devis mémorisés par session (brut, ajusté, précédents)
+PAGE_SIZE = 50                  # Lignes par page au-delà de PAGINATE_ABOVE_ROWS
+PAGINATE_ABOVE_ROWS = 100
+MONEY_COLUMNS = ("prix_unitaire_ht", "total_ligne_ht")
+HIDDEN_COLUMNS = ("taux_tva", "type")   # Colonnes de calcul ajoutées par la tarification
+NA_REP = "-"
+
+
+def content_hash(data):
+    """Empreinte du contenu d'un devis (JSON canonique) : clé du cache des vues."""
+    payload = json.dumps(data, sort_keys=True, ensure_ascii=False, default=str)
+    return hashlib.blake2b(payload.encode("utf-8"), digest_size=16).hexdigest()
+
+
+def _format_money(column):
+    values = pd.to_numeric(column, errors="coerce")
+    formatted = values.map(lambda v: f"{v:.2f} €", na_action="ignore")
+    # Valeur non numérique (texte laissé par le modèle) : affichée telle quelle
+    return formatted.where(values.notna(), column.astype(object).where(column.notna(), NA_REP))
+
+
+class QuoteView:
+    """Vues dérivées d'un devis, calculées à la première demande puis conservées."""
+
+    def __init__(self, data, page_size=PAGE_SIZE):
+        self.data = data
+        self.page_size = page_size
+        self._frame = None
+        self._display = None
+        self._totals = None
+
+    @property
+    def frame(self):
+        """Lignes d'articles (valeurs d'origine)."""
+        if self._frame is None:
+            self._frame = pd.DataFrame(self.data.get("lignes_articles") or [])
+        return self._frame
+
+    @property
+    def display(self):
+        """
+        Lignes d'articles prêtes à afficher (montants en euros, valeurs manquantes en "-"),
+        sans les colonnes de calcul.
+        """
+        if self._display is None:
+            frame = self.frame.drop(columns=[c for c in HIDDEN_COLUMNS if c in self.frame.columns])
+            df = frame.astype(object).where(frame.notna(), NA_REP)
+            for column in MONEY_COLUMNS:
+                if column in df.columns:
+                    df[column] = _format_money(self.frame[column])
+            self._display = df
+        return self._display
+
+    @property
+    def totals(self):
+        """(total HT, total TTC), voir `compute_totals`."""
+        if self._totals is None:
+            self._totals = compute_totals(self.data)
+        return self._totals
+
+    @property
+    def row_count(self):
+        return len(self.frame)
+
+    @property
+    def page_count(self):
+        if self.row_count <= PAGINATE_ABOVE_ROWS:
+            return 1
+        return -(-self.row_count // self.page_size)
+
+    def page(self, number):
+        """Page `number` (à partir de 1) du tableau affiché ; tout le tableau s'il est court."""
+        if self.page_count == 1:
+            return self.display
+        start = (min(max(number, 1), self.page_count) - 1) * self.page_size
+        return self.display.iloc[start:start + self.page_size]
+
+
+class QuoteViewCache:
+    """Cache LRU des vues, à conserver dans `st.session_state` (mémoire bornée par session)."""
+
+    def __init__(self, max_views=MAX_VIEWS_PER_SESSION):
+        self.max_views = max_views
+        self._views = OrderedDict()     # empreinte -> QuoteView
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, data):
+        key = content_hash(data)
+        view = self._views.get(key)
+        if view is not None:
+            self._views.move_to_end(key)
+            self.hits += 1
+            return view
+        self.misses += 1
+        view = self._views[key] = QuoteView(data)
+        while len(self._views) > self.max_views:
+            self._views.popitem(last=False)
+        return view
+
+    def clear(self):
+        self._views.clear()